@@ -0,0 +1,100 @@
+import re
+import zlib
+from collections import namedtuple
+
+from segmentation import TTS_MAX_INPUT, Segment, split_page
+
+# Dialogue attribution for multi-voice narration. Quoted speech is attributed
+# to the character named in the surrounding clause ("...," said Goku / Goku
+# shouted, "..."), or for a pronoun tag ("...," he said) to the character
+# mentioned last before the quote. Everything else, and any quote without a
+# speaker, is read by the narrator.
+
+OPENAI_VOICES = ['alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer']
+
+Span = namedtuple('Span', ['speaker', 'text'])
+
+QUOTE = re.compile(r'"([^"]+)"|“([^”]+)”')
+CLAUSE_END = re.compile(r'[,;.!?\n"“”]')
+PRONOUN_TAG = re.compile(r'^(he|she|they)\b', re.IGNORECASE)
+
+
+# Regexes for the names a character can be referred to by: the full name and,
+# for multi-word names, the first word
+def name_patterns(characters):
+    patterns = []
+    for character in characters:
+        name = str(character).strip()
+        if not name:
+            continue
+        aliases = {name}
+        first = name.split()[0]
+        if first != name and len(first) >= 3:
+            aliases.add(first)
+        for alias in sorted(aliases, key=len, reverse=True):
+            patterns.append((re.compile(r'\b' + re.escape(alias) + r'\b', re.IGNORECASE), name))
+    return patterns
+
+# Speaker named in a clause; the first mention after a quote, or the last one
+# before it
+def find_speaker(clause, patterns, last=False):
+    found = None
+    for pattern, name in patterns:
+        for match in pattern.finditer(clause):
+            if found is None or (match.start() > found[0] if last else match.start() < found[0]):
+                found = (match.start(), name)
+    return found[1] if found else None
+
+# Split one page into narrator and character spans
+def parse_dialogue(text, characters):
+    patterns = name_patterns(characters)
+    spans = []
+    position = 0
+    for match in QUOTE.finditer(text):
+        narration = text[position:match.start()]
+        after = text[match.end():].lstrip(' ,;:—-')
+        clause_end = CLAUSE_END.search(after)
+        after_clause = after[:clause_end.start()] if clause_end else after
+        before_clause = re.split(r'[.!?\n]', narration)[-1]
+
+        speaker = find_speaker(after_clause, patterns) or find_speaker(before_clause, patterns, last=True)
+        if speaker is None and PRONOUN_TAG.match(after_clause.strip()):
+            speaker = find_speaker(text[:match.start()], patterns, last=True)
+        spans.append(Span(None, narration))
+        spans.append(Span(speaker, match.group(1) or match.group(2)))
+        position = match.end()
+    spans.append(Span(None, text[position:]))
+
+    return [Span(span.speaker, span.text.strip()) for span in spans if re.search(r'\w', span.text)]
+
+# Voice for a speaker: the mapped character voice, or a stable pick from the
+# voices other than the narrator's for characters without one (or whose voice
+# is the narrator's)
+def speaker_voice(speaker, narrator_voice, character_voices):
+    if speaker is None:
+        return narrator_voice
+    voice = character_voices.get(speaker.lower())
+    if voice and voice != narrator_voice:
+        return voice
+    pool = [voice for voice in OPENAI_VOICES if voice != narrator_voice]
+    return pool[zlib.crc32(speaker.lower().encode('utf-8')) % len(pool)]
+
+# Voice-tagged TTS segments for a story. Consecutive spans read by the same
+# voice are merged so each voice change costs one extra request, not one per span.
+def segment_dialogue(pages, characters, narrator_voice, character_voices, limit=TTS_MAX_INPUT):
+    segments = []
+    voices = {}
+    for page, text in enumerate(pages):
+        runs = []
+        for span in parse_dialogue(text, characters):
+            voice = speaker_voice(span.speaker, narrator_voice, character_voices)
+            if span.speaker:
+                voices[span.speaker] = voice
+            if runs and runs[-1][0] == voice:
+                runs[-1][1].append(span.text)
+            else:
+                runs.append((voice, [span.text]))
+
+        for voice, texts in runs:
+            segments.extend(Segment(page, piece, voice) for piece in split_page(" ".join(texts), limit))
+    return segments, voices
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# HLS delivery outputs for a narration: AAC renditions at several bitrates cut
+# into short segments, a master playlist over them, and a low-bitrate mono MP3
+# preview. All renditions come from one ffmpeg run, so the source is decoded once.
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.mp3': 'audio/mpeg'
+}
+
+
+# Parse a comma-separated list of bitrates in kbps, e.g. "48,96,160"
+def parse_bitrates(value):
+    return sorted({int(part) for part in value.split(',') if part.strip()})
+
+def master_playlist(bitrates):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for kbps in bitrates:
+        # Allow ~10% for MPEG-TS overhead on top of the audio bitrate
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={int(kbps * 1100)},CODECS="mp4a.40.2"')
+        lines.append(f"{kbps}k/index.m3u8")
+    return "\n".join(lines) + "\n"
+
+def ffmpeg_command(work_dir, bitrates, segment_seconds, preview_bitrate):
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', 'pipe:0']
+    for kbps in bitrates:
+        rendition = os.path.join(work_dir, 'hls', f'{kbps}k')
+        os.makedirs(rendition, exist_ok=True)
+        command += [
+            '-map', '0:a', '-c:a', 'aac', '-b:a', f'{kbps}k',
+            '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(rendition, 'segment_%03d.ts'),
+            os.path.join(rendition, 'index.m3u8')
+        ]
+    command += [
+        '-map', '0:a', '-ac', '1', '-c:a', 'libmp3lame', '-b:a', f'{preview_bitrate}k',
+        os.path.join(work_dir, 'preview.mp3')
+    ]
+    return command
+
+# Render the HLS renditions and preview for an MP3 into work_dir
+def render(audio, work_dir, bitrates, segment_seconds=6, preview_bitrate=32, timeout=300):
+    subprocess.run(
+        ffmpeg_command(work_dir, bitrates, segment_seconds, preview_bitrate),
+        input=audio, check=True, capture_output=True, timeout=timeout
+    )
+    with open(os.path.join(work_dir, 'hls', 'master.m3u8'), 'w') as f:
+        f.write(master_playlist(bitrates))
+
+# URLs of a narration's master playlist, each rendition and the preview under
+# prefix (stories/{story_id}/)
+def delivery_urls(prefix, url_for, bitrates):
+    return {
+        "master_url": url_for(prefix + 'hls/master.m3u8'),
+        "variants": [
+            {"bitrate_kbps": kbps, "url": url_for(prefix + f'hls/{kbps}k/index.m3u8')} for kbps in bitrates
+        ],
+        "preview_url": url_for(prefix + 'preview.mp3')
+    }
+
+# Render a narration's delivery outputs and upload them in parallel under
+# prefix. The master playlist goes up last, so once it exists every rendition
+# is complete. Returns delivery_urls.
+def publish(audio, prefix, store, url_for, bitrates, segment_seconds=6, preview_bitrate=32, upload_concurrency=8):
+    work_dir = tempfile.mkdtemp(prefix='narration-hls-')
+    master = os.path.join(work_dir, 'hls', 'master.m3u8')
+    try:
+        render(audio, work_dir, bitrates, segment_seconds, preview_bitrate)
+
+        uploads = []
+        for root, _, files in os.walk(work_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                key = prefix + os.path.relpath(path, work_dir).replace(os.sep, '/')
+                uploads.append((path, key, CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')))
+
+        def upload(item):
+            path, key, content_type = item
+            with open(path, 'rb') as f:
+                store.put(key, f.read(), content_type=content_type)
+
+        with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+            # list() so the first failed upload raises here
+            list(executor.map(upload, [item for item in uploads if item[0] != master]))
+        upload(next(item for item in uploads if item[0] == master))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return delivery_urls(prefix, url_for, bitrates)
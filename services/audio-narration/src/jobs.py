@@ -0,0 +1,262 @@
+import hmac
+import json
+import time
+import uuid
+import queue
+import socket
+import hashlib
+import logging
+import ipaddress
+import threading
+from urllib.parse import urlsplit
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+# Parse a comma-separated list of host names
+def parse_hosts(value):
+    return [host.strip().lower() for host in (value or '').split(',') if host.strip()]
+
+# Raise ValueError unless a webhook URL is safe for the job worker to POST to:
+# an http(s) URL whose host is in allowed_hosts (or a subdomain of one) when an
+# allowlist is configured, and otherwise one that resolves only to public
+# addresses, so jobs cannot reach cluster-internal or metadata endpoints
+def check_webhook_url(url, allowed_hosts=None):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("webhook_url must be an http(s) URL")
+    host = parts.hostname.lower()
+
+    if allowed_hosts:
+        if not any(host == allowed or host.endswith('.' + allowed) for allowed in allowed_hosts):
+            raise ValueError(f"webhook_url host {host} is not allowed")
+        return
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"webhook_url host {host} does not resolve")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"webhook_url host {host} resolves to a non-public address")
+
+
+# Narration job queue. Jobs are recorded and queued in Redis when it is
+# available, so any replica can report on a job and workers on any replica can
+# pick it up; otherwise an in-process queue and dict stand in. Each job runs
+# run(request_data) on a worker thread and, if a webhook_url was given, the
+# finished job record is POSTed to it.
+#
+# In Redis, a worker moves the job id from the queue to a processing list and
+# holds a lease on it, renewed while the job runs. Jobs whose lease lapses
+# (their worker's pod died) are put back on the queue, up to max_attempts runs.
+class JobQueue:
+    def __init__(self, redis_client, run, workers=4, job_ttl=86400, webhook_timeout=10,
+                 webhook_retries=3, webhook_secret=None, webhook_allowed_hosts=None, lease_ttl=60,
+                 max_attempts=3, on_finish=None, prefix='narration:jobs:'):
+        self.redis_client = redis_client
+        self.run = run
+        self.workers = workers
+        self.job_ttl = job_ttl
+        self.webhook_timeout = webhook_timeout
+        self.webhook_retries = webhook_retries
+        self.webhook_secret = webhook_secret
+        self.webhook_allowed_hosts = webhook_allowed_hosts
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.on_finish = on_finish or (lambda job: None)
+        self.prefix = prefix
+        self.local_queue = queue.Queue()
+        self.local_jobs = {}
+        self.lock = threading.Lock()
+        # Processing entries seen without a lease on the last reclaim pass
+        self.unleased = set()
+
+    def _save(self, job):
+        if self.redis_client is not None:
+            self.redis_client.set(self.prefix + job["job_id"], json.dumps(job), ex=self.job_ttl)
+        else:
+            with self.lock:
+                self.local_jobs[job["job_id"]] = job
+
+    def get(self, job_id):
+        if self.redis_client is not None:
+            stored = self.redis_client.get(self.prefix + job_id)
+            return json.loads(stored) if stored else None
+        with self.lock:
+            job = self.local_jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _update(self, job, **changes):
+        job.update(changes)
+        self._save(job)
+        return job
+
+    # Record and enqueue a job for an already validated request
+    def submit(self, data, webhook_url=None):
+        job = {
+            "job_id": str(uuid.uuid4()),
+            "status": "queued",
+            "story_id": data.get("story_id"),
+            "created_at": time.time(),
+            "webhook_url": webhook_url,
+            "request": data
+        }
+        self._save(job)
+        if self.redis_client is not None:
+            self.redis_client.lpush(self.prefix + 'queue', job["job_id"])
+        else:
+            self.local_queue.put(job["job_id"])
+        return job
+
+    def _lease_key(self, job_id):
+        return f"{self.prefix}lease:{job_id}"
+
+    # Oldest queued job id, moved to the processing list and leased
+    def _next_job_id(self):
+        if self.redis_client is not None:
+            job_id = self.redis_client.brpoplpush(self.prefix + 'queue', self.prefix + 'processing', timeout=5)
+            if job_id is None:
+                return None
+            job_id = job_id.decode('utf-8') if isinstance(job_id, bytes) else job_id
+            self.redis_client.set(self._lease_key(job_id), 1, ex=self.lease_ttl)
+            return job_id
+        return self.local_queue.get()
+
+    def _release(self, job_id):
+        if self.redis_client is not None:
+            self.redis_client.lrem(self.prefix + 'processing', 1, job_id)
+            self.redis_client.delete(self._lease_key(job_id))
+
+    # Keep a running job's lease alive until done is set
+    def _renew_lease(self, job_id, done):
+        while not done.wait(self.lease_ttl / 3):
+            try:
+                self.redis_client.set(self._lease_key(job_id), 1, ex=self.lease_ttl)
+            except Exception as e:
+                logger.warning(f"Lease renewal for job {job_id} failed: {e}")
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        if self.redis_client is not None:
+            threading.Thread(target=self._reclaimer, daemon=True).start()
+        logger.info(f"Started {self.workers} narration job workers ({'redis' if self.redis_client is not None else 'local'} queue)")
+
+    def _worker(self):
+        while True:
+            try:
+                job_id = self._next_job_id()
+                if job_id is not None:
+                    self._process(job_id)
+            except Exception as e:
+                logger.error(f"Narration job worker error: {e}")
+                time.sleep(1)
+
+    def _process(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            logger.warning(f"Narration job {job_id} expired before it ran")
+            self._release(job_id)
+            return
+
+        done = threading.Event()
+        if self.redis_client is not None:
+            threading.Thread(target=self._renew_lease, args=(job_id, done), daemon=True).start()
+        try:
+            self._update(job, status="running", started_at=time.time(), attempts=job.get("attempts", 0) + 1)
+            try:
+                result = self.run(job["request"])
+                self._update(job, status="succeeded", result=result, finished_at=time.time())
+            except Exception as e:
+                logger.exception(f"Narration job {job_id} failed")
+                self._update(job, status="failed", error=str(e), finished_at=time.time())
+        finally:
+            done.set()
+            self._release(job_id)
+
+        self._finish(job)
+
+    def _finish(self, job):
+        self.on_finish(job)
+        if job.get("webhook_url"):
+            self._update(job, webhook=self._deliver(job))
+
+    def _reclaimer(self):
+        while True:
+            time.sleep(self.lease_ttl)
+            try:
+                self.reclaim()
+            except Exception as e:
+                logger.error(f"Narration job reclaim error: {e}")
+
+    # Requeue processing jobs whose lease has lapsed. An entry must be found
+    # without a lease on two passes in a row, so a job popped just before a
+    # pass, whose lease is not set yet, is left alone.
+    def reclaim(self):
+        processing = self.prefix + 'processing'
+        unleased = set()
+        for job_id in self.redis_client.lrange(processing, 0, -1):
+            job_id = job_id.decode('utf-8') if isinstance(job_id, bytes) else job_id
+            if self.redis_client.exists(self._lease_key(job_id)):
+                continue
+            if job_id not in self.unleased:
+                unleased.add(job_id)
+                continue
+            # Only the replica whose LREM removes the entry requeues it
+            if not self.redis_client.lrem(processing, 1, job_id):
+                continue
+
+            job = self.get(job_id)
+            if job is None:
+                continue
+            if job.get("attempts", 0) >= self.max_attempts:
+                logger.error(f"Narration job {job_id} lost its worker {job['attempts']} times; giving up")
+                self._update(job, status="failed", error="Worker lost while running the job", finished_at=time.time())
+                self._finish(job)
+            else:
+                logger.warning(f"Requeueing narration job {job_id} after its worker was lost")
+                self._update(job, status="queued")
+                self.redis_client.lpush(self.prefix + 'queue', job_id)
+        self.unleased = unleased
+
+    # POST the finished job to its webhook, retrying with backoff. The body is
+    # signed with WEBHOOK_SECRET when one is configured.
+    def _deliver(self, job):
+        body = json.dumps(public_job(job)).encode('utf-8')
+        headers = {"Content-Type": "application/json"}
+        if self.webhook_secret:
+            signature = hmac.new(self.webhook_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+            headers["X-Storyverse-Signature"] = f"sha256={signature}"
+
+        error = None
+        for attempt in range(1, self.webhook_retries + 1):
+            try:
+                # Checked again here: the host may resolve differently than at submission
+                check_webhook_url(job["webhook_url"], self.webhook_allowed_hosts)
+            except ValueError as e:
+                error = str(e)
+                break
+            try:
+                # Redirects are not followed, so they cannot lead to an internal address
+                response = requests.post(job["webhook_url"], data=body, headers=headers, timeout=self.webhook_timeout,
+                                         allow_redirects=False)
+                if response.status_code < 300:
+                    return {"delivered": True, "attempts": attempt}
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt < self.webhook_retries:
+                time.sleep(2 ** (attempt - 1))
+
+        logger.warning(f"Webhook delivery for job {job['job_id']} failed: {error}")
+        return {"delivered": False, "attempts": attempt, "error": error}
+
+
+# Job record as returned to clients, without the original request body
+def public_job(job):
+    return {key: value for key, value in job.items() if key != "request"}
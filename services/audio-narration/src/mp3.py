@@ -0,0 +1,281 @@
+from collections import namedtuple
+
+# MPEG audio frame parsing, just enough to work with MP3 files at the frame
+# level without decoding them.
+
+FrameHeader = namedtuple('FrameHeader', [
+    'version', 'layer', 'bitrate', 'sample_rate', 'padding', 'channels', 'samples', 'length', 'crc'
+])
+
+AudioInfo = namedtuple('AudioInfo', ['duration', 'bitrate', 'sample_rate', 'channels', 'frames', 'vbr'])
+
+# Xing header flag for a stored frame count
+XING_FRAMES = 0x1
+
+# Bitrates in kbps by (MPEG-1?, layer)
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+
+SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000]
+}
+
+VERSIONS = {0b00: 2.5, 0b10: 2, 0b11: 1}
+LAYERS = {0b01: 3, 0b10: 2, 0b11: 1}
+
+
+# Parse the 4-byte frame header at offset, or return None if there is no
+# valid frame there
+def parse_frame_header(data, offset=0):
+    if offset + 4 > len(data) or data[offset] != 0xFF or (data[offset + 1] & 0xE0) != 0xE0:
+        return None
+
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    version = VERSIONS.get((b1 >> 3) & 0b11)
+    layer = LAYERS.get((b1 >> 1) & 0b11)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0b11
+    if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    bitrate = BITRATES[(version == 1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 1
+    channels = 1 if (b3 >> 6) == 0b11 else 2
+    crc = (b1 & 1) == 0
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return FrameHeader(version, layer, bitrate, sample_rate, padding, channels, samples, length, crc)
+
+# Offset of the Xing/Info tag inside a Layer III frame (after the side info)
+def xing_offset(header):
+    if header.version == 1:
+        return 4 + (32 if header.channels == 2 else 17)
+    return 4 + (17 if header.channels == 2 else 9)
+
+# Length of a leading ID3v2 tag, 0 if there is none
+def id3v2_length(data):
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+# Offset of the first audio frame, skipping ID3v2 and any junk before it
+def first_frame_offset(data):
+    offset = id3v2_length(data)
+    while offset < len(data) - 4:
+        header = parse_frame_header(data, offset)
+        if header and header.length > 0:
+            # Require a second frame right after to avoid false sync
+            following = parse_frame_header(data, offset + header.length)
+            if following or offset + header.length >= len(data):
+                return offset
+        offset += 1
+    return None
+
+# True if the frame at offset is a Xing/Info or VBRI header frame rather than audio
+def is_info_frame(data, offset, header):
+    tag_at = offset + xing_offset(header)
+    return data[tag_at:tag_at + 4] in (b'Xing', b'Info') or data[offset + 36:offset + 40] == b'VBRI'
+
+# Audio frames of one MP3 file with ID3v1/ID3v2 tags and the Xing/Info/VBRI
+# header frame removed, so several files can be concatenated into one stream
+def strip_to_frames(data):
+    start = first_frame_offset(data)
+    if start is None:
+        return b''
+
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+
+    header = parse_frame_header(data, start)
+    if header and is_info_frame(data, start, header):
+        start += header.length
+
+    return bytes(data[start:end])
+
+# strip_to_frames for an MP3 that arrives in chunks. feed() returns the audio
+# frames that can be passed on so far and close() the rest; only the bytes up
+# to the first audio frame and a possible trailing ID3v1 tag are held back.
+class FrameStripper:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.started = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if not self.started:
+            start = self._first_audio_frame()
+            if start is None:
+                return b''
+            del self.buffer[:start]
+            self.started = True
+
+        if len(self.buffer) <= 128:
+            return b''
+        frames = bytes(self.buffer[:-128])
+        del self.buffer[:-128]
+        return frames
+
+    def close(self):
+        if not self.started:
+            # Too short to confirm a frame sync while streaming
+            return strip_to_frames(bytes(self.buffer))
+        if len(self.buffer) == 128 and self.buffer[:3] == b'TAG':
+            return b''
+        return bytes(self.buffer)
+
+    # Offset of the first frame after the ID3v2 tag and Xing/Info/VBRI frame,
+    # or None until enough has arrived to tell
+    def _first_audio_frame(self):
+        data = self.buffer
+        if len(data) < 10:
+            return None
+        offset = id3v2_length(data)
+        while offset + 4 <= len(data):
+            header = parse_frame_header(data, offset)
+            if header and header.length > 0:
+                if offset + header.length + 4 > len(data):
+                    return None
+                # Require a second frame right after to avoid false sync
+                if parse_frame_header(data, offset + header.length):
+                    return offset + header.length if is_info_frame(data, offset, header) else offset
+            offset += 1
+        return None
+
+# Concatenate MP3 files into a single stream of frames
+def concatenate(parts):
+    return b''.join(strip_to_frames(part) for part in parts)
+
+# Walk the audio frames of an MP3, yielding (offset, header) for each. Bytes
+# that do not start a frame are skipped until the stream resynchronizes.
+def iter_frames(data):
+    offset = first_frame_offset(data)
+    if offset is None:
+        return
+    end = len(data)
+    while offset + 4 <= end:
+        header = parse_frame_header(data, offset)
+        if header is None or header.length <= 0:
+            offset += 1
+            continue
+        if offset + header.length > end:
+            break
+        yield offset, header
+        offset += header.length
+
+# Frame count from a Xing/Info or VBRI header frame, or None
+def info_frame_count(data, offset, header):
+    tag_at = offset + xing_offset(header)
+    if data[tag_at:tag_at + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(data[tag_at + 4:tag_at + 8], 'big')
+        if flags & XING_FRAMES:
+            return int.from_bytes(data[tag_at + 8:tag_at + 12], 'big')
+    elif data[offset + 36:offset + 40] == b'VBRI':
+        return int.from_bytes(data[offset + 50:offset + 54], 'big')
+    return None
+
+# Duration, bitrate and sample rate of an MP3 from its frame headers, without
+# decoding. Uses the Xing/Info or VBRI frame count when the file has one and
+# otherwise walks every frame header. Returns None for data with no valid frames.
+def read_info(data):
+    start = first_frame_offset(data)
+    if start is None:
+        return None
+    first = parse_frame_header(data, start)
+
+    if is_info_frame(data, start, first):
+        frames = info_frame_count(data, start, first)
+        if frames:
+            duration = frames * first.samples / first.sample_rate
+            audio_bytes = len(data) - start - first.length
+            bitrate = int(audio_bytes * 8 / duration) if duration else first.bitrate
+            # LAME writes "Info" instead of "Xing" for constant-bitrate files
+            vbr = data[start + xing_offset(first):start + xing_offset(first) + 4] != b'Info'
+            return AudioInfo(duration, bitrate, first.sample_rate, first.channels, frames, vbr)
+
+    frames = 0
+    samples = 0
+    audio_bytes = 0
+    bitrates = set()
+    for offset, header in iter_frames(data):
+        if offset == start and is_info_frame(data, offset, header):
+            continue
+        frames += 1
+        samples += header.samples
+        audio_bytes += header.length
+        bitrates.add(header.bitrate)
+
+    if not frames:
+        return None
+    duration = samples / first.sample_rate
+    return AudioInfo(duration, int(audio_bytes * 8 / duration), first.sample_rate, first.channels, frames, len(bitrates) > 1)
+
+def _read_bits(data, bit_offset, count):
+    value = 0
+    for i in range(bit_offset, bit_offset + count):
+        value = (value << 1) | ((data[i >> 3] >> (7 - (i & 7))) & 1)
+    return value
+
+# Loudest global_gain in a Layer III frame's side info
+def frame_gain(data, offset, header):
+    side_info = (offset + 4 + (2 if header.crc else 0)) * 8
+    if header.version == 1:
+        granules = 2
+        # main_data_begin, private_bits (5 mono / 3 stereo), scfsi per channel
+        position = side_info + 9 + (5 if header.channels == 1 else 3) + 4 * header.channels
+        stride = 59
+    else:
+        granules = 1
+        # main_data_begin, private_bits (1 mono / 2 stereo)
+        position = side_info + 8 + header.channels
+        stride = 63
+
+    gains = []
+    for index in range(granules * header.channels):
+        # global_gain follows part2_3_length (12 bits) and big_values (9 bits)
+        gains.append(_read_bits(data, position + index * stride + 21, 8))
+    return max(gains)
+
+# Loudness of each Layer III frame, read from the side info rather than
+# decoded samples. global_gain is the quantizer step size in 1.5 dB steps, so
+# it tracks the frame's overall level closely enough for a player waveform.
+def frame_levels(data):
+    levels = []
+    start = first_frame_offset(data)
+    for offset, header in iter_frames(data):
+        if header.layer != 3 or (offset == start and is_info_frame(data, offset, header)):
+            continue
+        levels.append(frame_gain(data, offset, header))
+    return levels
+
+# Downsample per-frame levels to a fixed number of peaks, scaled to 0..1 over
+# the range_db below the loudest peak
+def waveform_peaks(levels, buckets=200, range_db=60):
+    if not levels:
+        return []
+    buckets = min(buckets, len(levels))
+    peaks = [
+        max(levels[i * len(levels) // buckets:(i + 1) * len(levels) // buckets])
+        for i in range(buckets)
+    ]
+    loudest = max(peaks)
+    return [round(max(0.0, 1 - (loudest - peak) * 1.5 / range_db), 3) for peak in peaks]
@@ -0,0 +1,81 @@
+import re
+from collections import namedtuple
+
+# Splits story text into TTS-sized segments. Segments never cross a page
+# boundary, so per-page audio offsets fall exactly on segment boundaries.
+
+# OpenAI TTS accepts at most 4096 characters of input per request
+TTS_MAX_INPUT = 4096
+
+# voice is None for segments read in the request's single voice
+Segment = namedtuple('Segment', ['page', 'text', 'voice'], defaults=[None])
+
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+|(?<=[.!?…]["”\')\]])\s+')
+
+
+# Story pages from a request: an explicit list of pages (strings or
+# {"text": ...} objects), or the text split on blank lines. An explicit list
+# keeps every page in place so page numbers match the request; null and empty
+# pages come back as '' and produce no segments. Raises ValueError for pages
+# that are not a list or page text that is not a string.
+def story_pages(text, pages=None):
+    if pages is not None and not isinstance(pages, list):
+        raise ValueError("pages must be a list")
+    if pages:
+        texts = [page.get('text') if isinstance(page, dict) else page for page in pages]
+        if not all(page is None or isinstance(page, str) for page in texts):
+            raise ValueError("Page text must be a string")
+        return [(page or '').strip() for page in texts]
+
+    if text is not None and not isinstance(text, str):
+        raise ValueError("text must be a string")
+    texts = re.split(r'\n\s*\n', text or '')
+    return [page.strip() for page in texts if page.strip()]
+
+def split_sentences(text):
+    return [sentence for sentence in SENTENCE_END.split(text) if sentence.strip()]
+
+# Break a piece of text that has no usable sentence boundary on whitespace
+def split_words(text, limit):
+    pieces, current = [], ''
+    for word in text.split():
+        while len(word) > limit:
+            if current:
+                pieces.append(current)
+                current = ''
+            pieces.append(word[:limit])
+            word = word[limit:]
+        candidate = f"{current} {word}" if current else word
+        if len(candidate) > limit:
+            pieces.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+# Pack a page's sentences into as few segments as fit under the limit
+def split_page(text, limit=TTS_MAX_INPUT):
+    if len(text) <= limit:
+        return [text]
+
+    segments, current = [], ''
+    for sentence in split_sentences(text):
+        for piece in (split_words(sentence, limit) if len(sentence) > limit else [sentence]):
+            candidate = f"{current} {piece}" if current else piece
+            if len(candidate) > limit:
+                segments.append(current)
+                current = piece
+            else:
+                current = candidate
+    if current:
+        segments.append(current)
+    return segments
+
+# Segments for a whole story, in reading order, each tagged with its page index
+def segment_story(pages, limit=TTS_MAX_INPUT):
+    return [
+        Segment(page, text) for page, page_text in enumerate(pages) if page_text
+        for text in split_page(page_text, limit)
+    ]
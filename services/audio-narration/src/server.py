@@ -2,15 +2,26 @@ import os
 import json
 import time
 import uuid
+import queue
 import logging
 import threading
 import tempfile
-from flask import Flask, request, jsonify, send_file
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 import openai
 import boto3
+import redis
 from pydub import AudioSegment
 from prometheus_client import Counter, Histogram, start_http_server
+from storage import S3MultipartWriter, LocalFileWriter, S3ObjectStore, LocalObjectStore, MIN_PART_SIZE
+from segmentation import TTS_MAX_INPUT, story_pages, segment_story
+from dialogue import segment_dialogue
+from tts_cache import NarrationCache, narration_key, segment_key
+from mp3 import FrameStripper, read_info, frame_levels, waveform_peaks
+from jobs import JobQueue, public_job, parse_hosts, check_webhook_url
+import hls
 
 # Configure logging
 logging.basicConfig(
@@ -48,10 +59,62 @@ else:
     logger.warning("AWS credentials not set. S3 storage will not work.")
     s3_client = None
 
+# Initialize Redis client for the shared job queue
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
+try:
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    redis_client.ping()
+    logger.info("Connected to Redis")
+except Exception as e:
+    logger.error(f"Redis connection error: {e}")
+    redis_client = None
+
+# Synthesis and storage settings. Long stories are split into segments of at
+# most TTS_MAX_INPUT characters that are synthesized concurrently on a shared,
+# bounded worker pool.
+TTS_MODEL = os.environ.get('TTS_MODEL', 'tts-1')
+SYNTHESIS_CONCURRENCY = int(os.environ.get('SYNTHESIS_CONCURRENCY', 8))
+synthesis_pool = ThreadPoolExecutor(max_workers=SYNTHESIS_CONCURRENCY)
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+S3_PART_SIZE = int(os.environ.get('S3_PART_SIZE', MIN_PART_SIZE))
+LOCAL_AUDIO_DIR = os.environ.get('LOCAL_AUDIO_DIR', os.path.join(tempfile.gettempdir(), 'storyverse-audio'))
+
+# Content-addressed TTS cache, in the media bucket (or LOCAL_AUDIO_DIR)
+TTS_CACHE_ENABLED = os.environ.get('TTS_CACHE_ENABLED', 'true').lower() == 'true'
+if not TTS_CACHE_ENABLED:
+    tts_cache = None
+elif s3_client:
+    tts_cache = NarrationCache(S3ObjectStore(s3_client, S3_BUCKET))
+else:
+    tts_cache = NarrationCache(LocalObjectStore(LOCAL_AUDIO_DIR))
+
+# HLS delivery outputs (multi-bitrate renditions plus a low-bitrate preview),
+# uploaded next to the narration under stories/{story_id}/. They are built on
+# a background pool after the MP3 is stored, off the request path.
+HLS_ENABLED = os.environ.get('HLS_ENABLED', 'false').lower() == 'true'
+HLS_BITRATES = hls.parse_bitrates(os.environ.get('HLS_BITRATES', '48,96,160'))
+HLS_SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', 6))
+HLS_PREVIEW_BITRATE = int(os.environ.get('HLS_PREVIEW_BITRATE', 32))
+HLS_UPLOAD_CONCURRENCY = int(os.environ.get('HLS_UPLOAD_CONCURRENCY', 8))
+HLS_WORKERS = int(os.environ.get('HLS_WORKERS', 2))
+hls_pool = ThreadPoolExecutor(max_workers=HLS_WORKERS)
+media_store = S3ObjectStore(s3_client, S3_BUCKET) if s3_client else LocalObjectStore(LOCAL_AUDIO_DIR)
+
 # Prometheus metrics
 GENERATION_REQUESTS = Counter('audio_generation_requests_total', 'Total number of audio generation requests')
 GENERATION_ERRORS = Counter('audio_generation_errors_total', 'Total number of audio generation errors')
 GENERATION_TIME = Histogram('audio_generation_time_seconds', 'Time spent generating audio')
+CACHE_HITS = Counter('audio_tts_cache_hits_total', 'Total number of TTS cache hits', ['kind'])
+CACHE_MISSES = Counter('audio_tts_cache_misses_total', 'Total number of TTS cache misses', ['kind'])
+HLS_TIME = Histogram('audio_hls_publish_time_seconds', 'Time spent rendering and uploading HLS outputs')
+HLS_ERRORS = Counter('audio_hls_errors_total', 'Total number of failed HLS output stages')
+JOB_RESULTS = Counter('audio_jobs_total', 'Total number of finished narration jobs', ['status'])
+METADATA_FALLBACKS = Counter('audio_metadata_decode_fallbacks_total', 'Total number of audio files decoded because their frame headers could not be read')
+
+# Number of peaks in the waveform returned for the player
+WAVEFORM_BUCKETS = int(os.environ.get('WAVEFORM_BUCKETS', 200))
 
 # Character voice mapping
 CHARACTER_VOICES = {
@@ -76,6 +139,298 @@ def start_metrics_server():
 def health_check():
     return jsonify({"status": "ok"})
 
+# Raised for a request that cannot be narrated; carries the HTTP status
+class InvalidRequest(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+# Validate a narration request and resolve its voice
+def resolve_narration(data):
+    if not data:
+        raise InvalidRequest("No data provided")
+
+    try:
+        pages = story_pages(data.get('text'), data.get('pages'))
+    except ValueError as e:
+        raise InvalidRequest(str(e))
+
+    params = {
+        "story_id": data.get('story_id', str(uuid.uuid4())),
+        "text": data.get('text'),
+        "pages": pages,
+        "page_offsets": bool(data.get('page_offsets', False)),
+        "multi_voice": bool(data.get('multi_voice', False)),
+        "fresh": bool(data.get('fresh', False)),
+        "waveform": bool(data.get('waveform', False)),
+        "hls": bool(data.get('hls', HLS_ENABLED)),
+        "characters": data.get('characters', []),
+        "narrator_voice": data.get('narrator_voice', 'alloy')
+    }
+
+    if not any(params["pages"]):
+        raise InvalidRequest("No story text provided")
+
+    if not client:
+        raise InvalidRequest("Audio generation service not configured", 500)
+
+    # Select voice based on primary character or use default narrator voice.
+    # Multi-voice narration keeps the narrator voice for narration and reads
+    # dialogue in each speaker's voice.
+    params["voice"] = params["narrator_voice"]
+    if not params["multi_voice"] and params["characters"] and params["characters"][0] in CHARACTER_VOICES:
+        params["voice"] = CHARACTER_VOICES[params["characters"][0]]
+
+    if params["multi_voice"]:
+        params["segments"], params["voices"] = segment_dialogue(
+            params["pages"], list(params["characters"]) + list(CHARACTER_VOICES), params["voice"], CHARACTER_VOICES
+        )
+    else:
+        params["segments"], params["voices"] = segment_story(params["pages"], TTS_MAX_INPUT), None
+    params["cache_key"] = narration_key(params["segments"], params["voice"], TTS_MODEL)
+
+    return params
+
+# Previously stored narration of the same text and voices, or None. fresh
+# requests skip the lookup, and requests for HLS skip entries without it.
+def cached_narration(params):
+    if not tts_cache or params["fresh"]:
+        return None
+
+    entry = tts_cache.get_narration(params["cache_key"])
+    if entry is not None and params["hls"] and (entry.get("hls") or {}).get("status") not in ('pending', 'ready'):
+        entry = None
+    if entry is None:
+        CACHE_MISSES.labels(kind='narration').inc()
+        return None
+
+    CACHE_HITS.labels(kind='narration').inc()
+    return entry
+
+# Response body for a narration served from the cache
+def cached_result(params, entry):
+    result = {
+        "status": "success",
+        "audio_url": entry["audio_url"],
+        "story_id": params["story_id"],
+        "voice": params["voice"],
+        "duration_seconds": entry["duration_seconds"],
+        "segments": entry["segments"],
+        "cached": True
+    }
+    if params["hls"] and entry.get("hls"):
+        result["hls"] = entry["hls"]
+    if params["voices"] is not None:
+        result["voices"] = params["voices"]
+    if params["page_offsets"]:
+        result["pages"] = entry["pages"]
+    if params["waveform"]:
+        result["waveform"] = entry.get("waveform", [])
+    return result
+
+# Storage key and public URL for a story's narration
+def audio_location(story_id):
+    s3_key = f"stories/{story_id}/narration.mp3"
+    return s3_key, media_url(s3_key)
+
+# Public URL for a key in the media store
+def media_url(key):
+    if s3_client:
+        return f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{key}"
+    return f"local://{os.path.join(LOCAL_AUDIO_DIR, key)}"
+
+# Build and upload the HLS outputs for a stored narration, then record the
+# outcome in its cache entry. Runs on hls_pool. A failure here is logged and
+# leaves the narration without HLS rather than failing it.
+def publish_hls(story_id, audio, cache_entry=None):
+    start_time = time.time()
+    try:
+        delivery = dict(hls.publish(
+            audio, f"stories/{story_id}/", media_store, media_url, HLS_BITRATES,
+            segment_seconds=HLS_SEGMENT_SECONDS,
+            preview_bitrate=HLS_PREVIEW_BITRATE,
+            upload_concurrency=HLS_UPLOAD_CONCURRENCY
+        ), status='ready')
+    except Exception as e:
+        logger.error(f"HLS output failed for story {story_id}: {e}")
+        HLS_ERRORS.inc()
+        delivery = {"status": "failed"}
+    finally:
+        HLS_TIME.observe(time.time() - start_time)
+
+    if tts_cache and cache_entry is not None:
+        key, audio_key, version, result = cache_entry
+        tts_cache.put_narration(key, audio_key, version, dict(result, hls=delivery))
+
+# Open a streaming writer for a story's narration, in S3 when configured and
+# under LOCAL_AUDIO_DIR otherwise
+def open_audio_writer(story_id):
+    s3_key, url = audio_location(story_id)
+    if s3_client:
+        return S3MultipartWriter(s3_client, S3_BUCKET, s3_key, url, part_size=S3_PART_SIZE)
+    return LocalFileWriter(LOCAL_AUDIO_DIR, s3_key)
+
+# Synthesize one segment with OpenAI TTS, passing its audio frames (tags and
+# header frame stripped, ready to concatenate) to emit as they arrive. Returns
+# the segment's audio and duration.
+def synthesize(text, voice, emit):
+    stripper = FrameStripper()
+    audio = bytearray()
+    with client.audio.speech.with_streaming_response.create(
+        model=TTS_MODEL,
+        voice=voice,
+        input=text,
+        response_format='mp3'
+    ) as response:
+        for chunk in response.iter_bytes(STREAM_CHUNK_SIZE):
+            frames = stripper.feed(chunk)
+            if frames:
+                audio += frames
+                emit(frames)
+    frames = stripper.close()
+    if frames:
+        audio += frames
+        emit(frames)
+    audio = bytes(audio)
+    return audio, get_audio_duration(audio)
+
+# Synthesize a segment through the per-segment cache
+def synthesize_segment(text, voice, emit, fresh=False):
+    if not tts_cache:
+        return synthesize(text, voice, emit)
+
+    key = segment_key(text, voice, TTS_MODEL)
+    cached = None if fresh else tts_cache.get_segment(key)
+    if cached is not None:
+        CACHE_HITS.labels(kind='segment').inc()
+        emit(cached[0])
+        return cached
+
+    CACHE_MISSES.labels(kind='segment').inc()
+    audio, duration = synthesize(text, voice, emit)
+    tts_cache.put_segment(key, audio, duration)
+    return audio, duration
+
+# Run synthesize_segment on the synthesis pool with its audio chunks sent to
+# chunks, followed by None once it has finished or failed
+def stream_segment(segment, voice, chunks, fresh):
+    try:
+        return synthesize_segment(segment.text, segment.voice or voice, chunks.put, fresh)
+    finally:
+        chunks.put(None)
+
+# Synthesize the narration segment by segment in parallel (each segment in
+# its own voice for multi-voice narration), yielding audio in story order as
+# it arrives: the earliest unfinished segment streams straight through, later
+# ones are held until it is done. Audio is written to storage as it is
+# yielded. The last value is the result dict (bytes chunks before it).
+# Nothing is staged on local disk.
+def narrate(params):
+    segments = params["segments"]
+    writer = open_audio_writer(params["story_id"])
+    streams = [queue.Queue() for _ in segments]
+    futures = [
+        synthesis_pool.submit(stream_segment, segment, params["voice"], chunks, params["fresh"])
+        for segment, chunks in zip(segments, streams)
+    ]
+
+    pages = []
+    levels = []
+    parts = []
+    position = 0.0
+    try:
+        for segment, chunks, future in zip(segments, streams, futures):
+            for chunk in iter(chunks.get, None):
+                writer.write(chunk)
+                yield chunk
+            audio, duration = future.result()
+            levels.extend(frame_levels(audio))
+            # Empty pages have no segments and no entry; numbers follow the request
+            if not pages or pages[-1]["page"] != segment.page + 1:
+                pages.append({"page": segment.page + 1, "start_seconds": round(position, 3), "duration_seconds": 0})
+            pages[-1]["duration_seconds"] = round(pages[-1]["duration_seconds"] + duration, 3)
+            position += duration
+
+            if params["hls"]:
+                parts.append(audio)
+
+        audio_url = writer.close()
+    except BaseException:
+        # Includes GeneratorExit when a streaming client disconnects
+        for future in futures:
+            future.cancel()
+        writer.abort()
+        raise
+
+    result = {
+        "status": "success",
+        "audio_url": audio_url,
+        "story_id": params["story_id"],
+        "voice": params["voice"],
+        "duration_seconds": round(position, 3),
+        "segments": len(segments)
+    }
+    if params["voices"] is not None:
+        result["voices"] = params["voices"]
+    if params["hls"]:
+        # URLs are known up front; master_url appears once publishing finishes
+        result["hls"] = dict(
+            hls.delivery_urls(f"stories/{params['story_id']}/", media_url, HLS_BITRATES), status='pending'
+        )
+    waveform = waveform_peaks(levels, WAVEFORM_BUCKETS)
+    cache_entry = (
+        params["cache_key"], audio_location(params["story_id"])[0], writer.version,
+        dict(result, pages=pages, waveform=waveform)
+    )
+    if tts_cache:
+        tts_cache.put_narration(*cache_entry)
+    if params["hls"]:
+        hls_pool.submit(publish_hls, params["story_id"], b''.join(parts), cache_entry)
+    if params["page_offsets"]:
+        result["pages"] = pages
+    if params["waveform"]:
+        result["waveform"] = waveform
+    yield result
+
+# Narrate a resolved request, from the cache when possible
+def produce_narration(params):
+    entry = cached_narration(params)
+    if entry is not None:
+        return cached_result(params, entry)
+
+    # The last item narrate yields is the result
+    for result in narrate(params):
+        pass
+    return result
+
+# Run a queued narration job
+def run_job(data):
+    start_time = time.time()
+    try:
+        return produce_narration(resolve_narration(data))
+    finally:
+        GENERATION_TIME.observe(time.time() - start_time)
+
+# Background narration jobs
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Webhooks may only target these hosts when set; otherwise any public address
+WEBHOOK_ALLOWED_HOSTS = parse_hosts(os.environ.get('WEBHOOK_ALLOWED_HOSTS'))
+
+job_queue = JobQueue(
+    redis_client=redis_client,
+    run=run_job,
+    workers=JOB_WORKERS,
+    job_ttl=int(os.environ.get('JOB_TTL', 86400)),
+    webhook_timeout=float(os.environ.get('WEBHOOK_TIMEOUT', 10)),
+    webhook_retries=int(os.environ.get('WEBHOOK_RETRIES', 3)),
+    webhook_secret=os.environ.get('WEBHOOK_SECRET'),
+    webhook_allowed_hosts=WEBHOOK_ALLOWED_HOSTS,
+    lease_ttl=int(os.environ.get('JOB_LEASE_TTL', 60)),
+    max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', 3)),
+    on_finish=lambda job: JOB_RESULTS.labels(status=job["status"]).inc()
+)
+
 # Audio generation endpoint
 @app.route('/api/generate', methods=['POST'])
 def generate_audio():
@@ -83,80 +438,114 @@ def generate_audio():
     start_time = time.time()
     
     try:
-        data = request.json
-        
-        # Validate request
-        if not data:
-            GENERATION_ERRORS.inc()
-            return jsonify({"error": "No data provided"}), 400
-        
-        story_id = data.get('story_id', str(uuid.uuid4()))
-        story_text = data.get('text')
-        characters = data.get('characters', [])
-        narrator_voice = data.get('narrator_voice', 'alloy')
-        
-        if not story_text:
-            GENERATION_ERRORS.inc()
-            return jsonify({"error": "No story text provided"}), 400
-        
-        if not client:
-            GENERATION_ERRORS.inc()
-            return jsonify({"error": "Audio generation service not configured"}), 500
-        
-        # For simplicity, we'll use a single voice for the entire narration
-        # In a real implementation, we would parse the text to identify character dialogue
-        # and use different voices for different characters
-        
-        # Select voice based on primary character or use default narrator voice
-        voice = narrator_voice
-        if characters and characters[0] in CHARACTER_VOICES:
-            voice = CHARACTER_VOICES[characters[0]]
-        
-        # Generate audio with OpenAI TTS
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3')
+        params = resolve_narration(request.json)
+        result = produce_narration(params)
+
+        GENERATION_TIME.observe(time.time() - start_time)
+        return jsonify(result)
         
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": e.message}), e.status_code
+    except Exception as e:
+        logger.exception("Error generating audio")
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": str(e)}), 500
+
+# Streaming audio generation endpoint. The MP3 is sent to the client as it is
+# synthesized, so playback can start before synthesis finishes, and is stored
+# at the audio URL given in the X-Audio-Url header at the same time.
+@app.route('/api/generate/stream', methods=['POST'])
+def generate_audio_stream():
+    GENERATION_REQUESTS.inc()
+    start_time = time.time()
+
+    try:
+        params = resolve_narration(request.json)
+        entry = cached_narration(params)
+        audio_bytes = tts_cache.read_audio(entry) if entry is not None else None
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": e.message}), e.status_code
+
+    if audio_bytes is not None:
+        GENERATION_TIME.observe(time.time() - start_time)
+        return Response(audio_bytes, mimetype='audio/mpeg', headers={
+            "X-Story-Id": params["story_id"],
+            "X-Voice": params["voice"],
+            "X-Audio-Url": entry["audio_url"],
+            "X-Cache": "hit"
+        })
+
+    chunks = narrate(params)
+
+    def audio():
         try:
-            response = client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=story_text
-            )
-            
-            # Save audio to temp file
-            response.stream_to_file(temp_file.name)
-            
-            # In a real implementation, we would upload to S3 here
-            audio_url = f"local://{temp_file.name}"
-            
-            if s3_client:
-                # Upload to S3
-                s3_key = f"stories/{story_id}/narration.mp3"
-                s3_client.upload_file(temp_file.name, S3_BUCKET, s3_key)
-                audio_url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
-            
+            for chunk in chunks:
+                if isinstance(chunk, bytes):
+                    yield chunk
             GENERATION_TIME.observe(time.time() - start_time)
-            return jsonify({
-                "status": "success",
-                "audio_url": audio_url,
-                "story_id": story_id,
-                "voice": voice,
-                "duration_seconds": get_audio_duration(temp_file.name)
-            })
-            
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_file.name):
-                os.unlink(temp_file.name)
-        
+        except GeneratorExit:
+            chunks.close()
+            raise
+        except Exception:
+            # Headers are already sent; the client sees a truncated stream
+            logger.exception("Error streaming audio")
+            GENERATION_ERRORS.inc()
+
+    return Response(stream_with_context(audio()), mimetype='audio/mpeg', headers={
+        "X-Story-Id": params["story_id"],
+        "X-Voice": params["voice"],
+        "X-Audio-Url": audio_location(params["story_id"])[1],
+        "X-Cache": "miss"
+    })
+
+# Narration job endpoint. Validates the request, queues it and returns the job
+# id at once; poll /api/jobs/<job_id> or pass webhook_url to be notified.
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    GENERATION_REQUESTS.inc()
+
+    try:
+        data = request.json
+        params = resolve_narration(data)
+
+        webhook_url = data.get('webhook_url')
+        if webhook_url:
+            try:
+                check_webhook_url(str(webhook_url), WEBHOOK_ALLOWED_HOSTS)
+            except ValueError as e:
+                raise InvalidRequest(str(e))
+
+        job = job_queue.submit(dict(data, story_id=params["story_id"]), webhook_url)
+        return jsonify(dict(public_job(job), status_url=f"/api/jobs/{job['job_id']}")), 202
+
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": e.message}), e.status_code
     except Exception as e:
-        logger.exception("Error generating audio")
+        logger.exception("Error queueing narration job")
         GENERATION_ERRORS.inc()
         return jsonify({"error": str(e)}), 500
 
-# Get audio duration in seconds
-def get_audio_duration(file_path):
+# Narration job status endpoint
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(public_job(job))
+
+# Get audio duration in seconds from MP3 frame headers, decoding the audio
+# only when the headers cannot be read
+def get_audio_duration(audio_bytes):
+    info = read_info(audio_bytes)
+    if info is not None:
+        return info.duration
+
+    METADATA_FALLBACKS.inc()
     try:
-        audio = AudioSegment.from_file(file_path)
+        audio = AudioSegment.from_file(BytesIO(audio_bytes), format='mp3')
         return len(audio) / 1000.0  # Convert milliseconds to seconds
     except Exception as e:
         logger.error(f"Error getting audio duration: {e}")
@@ -166,6 +555,9 @@ if __name__ == '__main__':
     # Start metrics server in a separate thread
     metrics_thread = threading.Thread(target=start_metrics_server, daemon=True)
     metrics_thread.start()
+
+    # Start narration job workers
+    job_queue.start()
     
     # Start Flask app
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,168 @@
+import os
+import json
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# S3 requires every multipart part except the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+# Streams bytes into an S3 object without staging them on disk. Data is
+# buffered in memory up to part_size and uploaded as multipart parts; an object
+# that never fills one part is written with a single put_object instead.
+class S3MultipartWriter:
+    def __init__(self, s3_client, bucket, key, url, part_size=MIN_PART_SIZE, content_type='audio/mpeg'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.url = url
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        # Version tag of the stored object, set on close
+        self.version = None
+
+    def write(self, chunk):
+        self.buffer.extend(chunk)
+        self.size += len(chunk)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+            )
+            self.upload_id = response['UploadId']
+
+        number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body
+        )
+        self.parts.append({"ETag": response['ETag'], "PartNumber": number})
+
+    def close(self):
+        if self.upload_id is None:
+            response = self.s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type
+            )
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            response = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+            )
+        self.version = response.get('ETag')
+        self.buffer = bytearray()
+        return self.url
+
+    # Drop a partial upload so S3 does not keep billing for orphaned parts
+    def abort(self):
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.error(f"Failed to abort multipart upload for {self.key}: {e}")
+
+
+# Version tag for a local file, changing whenever the file is rewritten
+def local_version(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+# Local stand-in for S3MultipartWriter when no S3 credentials are configured.
+# Writes go to a .part file that is renamed into place on close.
+class LocalFileWriter:
+    def __init__(self, root, key):
+        self.path = os.path.join(root, key)
+        self.url = f"local://{self.path}"
+        self.size = 0
+        self.version = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path + '.part', 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+        self.version = local_version(self.path)
+        return self.url
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path + '.part'):
+            os.unlink(self.path + '.part')
+
+
+# Small-object store in S3, for cache index entries and cached audio
+class S3ObjectStore:
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    # Return (body, metadata), or None if the object does not exist
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read(), response.get('Metadata', {})
+
+    # Version tag (ETag) of an object, or None if it does not exist
+    def version(self, key):
+        try:
+            return self.s3_client.head_object(Bucket=self.bucket, Key=key)['ETag']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def put(self, key, body, metadata=None, content_type='application/octet-stream'):
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=key, Body=body, Metadata=metadata or {}, ContentType=content_type
+        )
+
+
+# Local stand-in for S3ObjectStore; metadata is kept in a sidecar JSON file
+class LocalObjectStore:
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, key):
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            body = f.read()
+        metadata = {}
+        if os.path.exists(path + '.meta.json'):
+            with open(path + '.meta.json') as f:
+                metadata = json.load(f)
+        return body, metadata
+
+    def version(self, key):
+        return local_version(os.path.join(self.root, key))
+
+    def put(self, key, body, metadata=None, content_type='application/octet-stream'):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        if metadata:
+            with open(path + '.meta.json', 'w') as f:
+                json.dump(metadata, f)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,83 @@
+import json
+import hashlib
+import logging
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+
+# Text as it affects synthesis: Unicode-normalized with whitespace collapsed
+def normalize_text(text):
+    return " ".join(unicodedata.normalize('NFC', text).split())
+
+def segment_key(text, voice, model):
+    payload = json.dumps([normalize_text(text), voice, model])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# Key for a whole narration: every segment's text and voice, in order, plus
+# the page each belongs to (which determines the page offsets)
+def narration_key(segments, default_voice, model):
+    payload = json.dumps([model] + [
+        [segment.page, normalize_text(segment.text), segment.voice or default_voice] for segment in segments
+    ])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# Content-addressed TTS cache in an object store. A narration entry is a JSON
+# index record pointing at an already stored narration; a segment entry is the
+# segment's audio frames with the duration in the object metadata, so a story
+# with a few changed pages only re-synthesizes those pages. Store failures are
+# logged and treated as misses.
+class NarrationCache:
+    def __init__(self, store, prefix='tts-cache/'):
+        self.store = store
+        self.prefix = prefix
+
+    def _get(self, key):
+        try:
+            return self.store.get(key)
+        except Exception as e:
+            logger.warning(f"TTS cache read failed for {key}: {e}")
+            return None
+
+    def _put(self, key, body, metadata=None, content_type='application/octet-stream'):
+        try:
+            self.store.put(key, body, metadata, content_type)
+        except Exception as e:
+            logger.warning(f"TTS cache write failed for {key}: {e}")
+
+    # Index entry for a narration. Narration audio lives at a per-story key that
+    # a later narration of the same story overwrites, so an entry only counts
+    # while the stored audio is still the version it was indexed with.
+    def get_narration(self, key):
+        found = self._get(f"{self.prefix}narrations/{key}.json")
+        if not found:
+            return None
+        entry = json.loads(found[0])
+        try:
+            current = self.store.version(entry["audio_key"]) == entry["version"]
+        except Exception as e:
+            logger.warning(f"TTS cache check failed for {entry['audio_key']}: {e}")
+            current = False
+        return entry if current else None
+
+    # Index a stored narration; audio_key and version identify its audio in the store
+    def put_narration(self, key, audio_key, version, result):
+        entry = dict(result, audio_key=audio_key, version=version)
+        self._put(f"{self.prefix}narrations/{key}.json", json.dumps(entry).encode('utf-8'), content_type='application/json')
+
+    # Return (audio, duration_seconds) for a cached segment, or None
+    def get_segment(self, key):
+        found = self._get(f"{self.prefix}segments/{key}.mp3")
+        if not found:
+            return None
+        audio, metadata = found
+        return audio, float(metadata.get('duration', 0))
+
+    def put_segment(self, key, audio, duration):
+        self._put(f"{self.prefix}segments/{key}.mp3", audio, {"duration": str(duration)}, 'audio/mpeg')
+
+    # Stored bytes for an indexed narration's audio, or None
+    def read_audio(self, entry):
+        found = self._get(entry["audio_key"])
+        return found[0] if found else None
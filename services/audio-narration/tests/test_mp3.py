@@ -0,0 +1,140 @@
+import pytest
+
+from mp3 import (
+    FrameStripper, parse_frame_header, first_frame_offset, strip_to_frames, concatenate,
+    read_info, frame_gain, frame_levels, waveform_peaks
+)
+
+# Frame headers: MPEG-1 Layer III 128 kbps 44.1 kHz joint stereo, the same
+# in mono, and MPEG-2 Layer III 64 kbps 24 kHz mono
+MPEG1_STEREO = bytes([0xFF, 0xFB, 0x90, 0x40])
+MPEG1_MONO = bytes([0xFF, 0xFB, 0x90, 0xC0])
+MPEG2_MONO = bytes([0xFF, 0xF3, 0x84, 0xC0])
+
+ID3V2 = b'ID3\x04\x00\x00\x00\x00\x00\x0a' + b'\x00' * 10
+ID3V1 = b'TAG' + b'\x00' * 125
+
+
+# Pack (value, width) fields MSB first into bytes
+def pack_bits(fields):
+    bits = ''.join(format(value, f'0{width}b') for value, width in fields)
+    bits += '0' * (-len(bits) % 8)
+    return bytes(int(bits[i:i + 8], 2) for i in range(0, len(bits), 8))
+
+# Layer III side info with the given global_gain per granule and channel
+def side_info(version, channels, gains):
+    if version == 1:
+        fields = [(0, 9), (0, 5 if channels == 1 else 3), (0, 4 * channels)]
+        # part2_3_length, big_values, global_gain, then the remaining 30 bits
+        granule = lambda gain: [(0x5A5, 12), (0x155, 9), (gain, 8), (0x3FFFFFFF, 30)]
+    else:
+        fields = [(0, 8), (0, channels)]
+        granule = lambda gain: [(0x5A5, 12), (0x155, 9), (gain, 8), (0x3FFFFFFFF, 34)]
+    for gain in gains:
+        fields.extend(granule(gain))
+    return pack_bits(fields)
+
+def frame(header, body=b''):
+    length = parse_frame_header(header).length
+    return header + body + b'\x00' * (length - len(header) - len(body))
+
+def xing_frame(frames, tag=b'Xing'):
+    # After 32 bytes of MPEG-1 stereo side info; flags say a frame count follows
+    return frame(MPEG1_STEREO, b'\x00' * 32 + tag + (1).to_bytes(4, 'big') + frames.to_bytes(4, 'big'))
+
+def vbri_frame(frames):
+    body = bytearray(60)
+    body[32:36] = b'VBRI'
+    body[46:50] = frames.to_bytes(4, 'big')
+    return frame(MPEG1_STEREO, bytes(body))
+
+def audio_frames(count):
+    return b''.join(frame(MPEG1_STEREO, side_info(1, 2, [100, 110, 120, 130])) for _ in range(count))
+
+
+def test_parse_mpeg1_header():
+    header = parse_frame_header(MPEG1_STEREO)
+    assert (header.version, header.layer, header.bitrate, header.sample_rate) == (1, 3, 128000, 44100)
+    assert (header.channels, header.samples, header.length, header.crc) == (2, 1152, 417, False)
+
+def test_parse_padded_mono_header_with_crc():
+    header = parse_frame_header(bytes([0xFF, 0xFA, 0x92, 0xC0]))
+    assert (header.channels, header.padding, header.length, header.crc) == (1, 1, 418, True)
+
+def test_parse_mpeg2_header():
+    header = parse_frame_header(MPEG2_MONO)
+    assert (header.version, header.bitrate, header.sample_rate) == (2, 64000, 24000)
+    assert (header.channels, header.samples, header.length) == (1, 576, 192)
+
+@pytest.mark.parametrize('data', [
+    b'\xFF\xFB\x90',              # truncated
+    b'\xFE\xFB\x90\x40',          # no sync
+    b'\xFF\xFB\xF0\x40',          # bitrate index 15
+    b'\xFF\xFB\x9C\x40',          # reserved sample rate
+    b'\xFF\xF9\x90\x40',          # reserved layer
+])
+def test_invalid_headers(data):
+    assert parse_frame_header(data) is None
+
+def test_first_frame_skips_id3v2_and_junk():
+    data = ID3V2 + b'\xFF\x00junk' + audio_frames(2)
+    assert first_frame_offset(data) == len(ID3V2) + 6
+
+def test_strip_to_frames_removes_tags_and_info_frame():
+    frames = audio_frames(3)
+    assert strip_to_frames(ID3V2 + xing_frame(3) + frames + ID3V1) == frames
+    assert strip_to_frames(vbri_frame(3) + frames) == frames
+    assert strip_to_frames(frames) == frames
+
+def test_concatenate():
+    frames = audio_frames(2)
+    assert concatenate([ID3V2 + xing_frame(2) + frames, frames + ID3V1]) == frames + frames
+
+def test_read_info_from_xing_frame_count():
+    info = read_info(ID3V2 + xing_frame(100) + audio_frames(3))
+    assert info.frames == 100
+    assert info.duration == pytest.approx(100 * 1152 / 44100)
+    assert info.vbr
+
+def test_read_info_from_info_tag_is_cbr():
+    assert not read_info(xing_frame(10, tag=b'Info') + audio_frames(3)).vbr
+
+def test_read_info_from_vbri_frame_count():
+    assert read_info(vbri_frame(40) + audio_frames(3)).frames == 40
+
+def test_read_info_walks_frames_without_info_frame():
+    info = read_info(audio_frames(10) + ID3V1)
+    assert (info.frames, info.vbr) == (10, False)
+    assert info.bitrate == pytest.approx(417 * 8 * 44100 / 1152, abs=1)
+    assert info.duration == pytest.approx(10 * 1152 / 44100)
+
+def test_read_info_without_frames():
+    assert read_info(b'not an mp3') is None
+
+@pytest.mark.parametrize('header, version, channels, gains', [
+    (MPEG1_STEREO, 1, 2, [100, 140, 120, 90]),
+    (MPEG1_MONO, 1, 1, [80, 150]),
+    (MPEG2_MONO, 2, 1, [170]),
+])
+def test_frame_gain_reads_global_gain(header, version, channels, gains):
+    data = frame(header, side_info(version, channels, gains))
+    assert frame_gain(data, 0, parse_frame_header(data)) == max(gains)
+
+def test_frame_gain_after_crc():
+    header = bytes([0xFF, 0xFA, 0x90, 0xC0])
+    data = frame(header, b'\x12\x34' + side_info(1, 1, [60, 75]))
+    assert frame_gain(data, 0, parse_frame_header(data)) == 75
+
+def test_frame_levels_skip_info_frame():
+    assert frame_levels(xing_frame(2) + audio_frames(2)) == [130, 130]
+
+def test_waveform_peaks_scale():
+    assert waveform_peaks([100, 100, 60, 60], buckets=2, range_db=60) == [1.0, 0.0]
+    assert waveform_peaks([]) == []
+
+@pytest.mark.parametrize('chunk_size', [1, 13, 417, 4096])
+def test_frame_stripper_matches_strip_to_frames(chunk_size):
+    for data in (ID3V2 + xing_frame(3) + audio_frames(3) + ID3V1, audio_frames(4), audio_frames(1), b''):
+        stripper = FrameStripper()
+        out = b''.join(stripper.feed(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size))
+        assert out + stripper.close() == strip_to_frames(data)
@@ -0,0 +1,39 @@
+import pytest
+
+from segmentation import Segment, story_pages, segment_story, split_page
+from dialogue import segment_dialogue
+
+
+def test_pages_from_text_split_on_blank_lines():
+    assert story_pages("One.\n\n  \nTwo.\n\n") == ["One.", "Two."]
+    assert story_pages(None) == []
+
+def test_explicit_pages_keep_their_positions():
+    pages = story_pages(None, ["First.", None, {"text": "  "}, {"text": None}, {}, {"text": "Last."}])
+    assert pages == ["First.", "", "", "", "", "Last."]
+
+@pytest.mark.parametrize('pages', ["abc", {"text": "abc"}, 5])
+def test_pages_must_be_a_list(pages):
+    with pytest.raises(ValueError):
+        story_pages(None, pages)
+
+@pytest.mark.parametrize('pages', [[5], [{"text": 5}], [["nested"]]])
+def test_page_text_must_be_a_string(pages):
+    with pytest.raises(ValueError):
+        story_pages(None, pages)
+
+def test_text_must_be_a_string():
+    with pytest.raises(ValueError):
+        story_pages(123)
+
+def test_segments_skip_empty_pages_without_renumbering():
+    pages = story_pages(None, ["First.", None, "", "Fourth."])
+    assert segment_story(pages) == [Segment(0, "First."), Segment(3, "Fourth.")]
+    segments, _ = segment_dialogue(pages, [], "alloy", {})
+    assert [segment.page for segment in segments] == [0, 3]
+
+def test_split_page_stays_under_limit():
+    text = "A short sentence. " * 20
+    pieces = split_page(text.strip(), limit=50)
+    assert all(len(piece) <= 50 for piece in pieces)
+    assert " ".join(pieces) == text.strip()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import io
+import json
+import time
+import uuid
+import base64
+import struct
+import socket
+import hashlib
+import argparse
+import threading
+import queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+# Stand-in for a ComfyUI server, for exercising the image-generation service
+# without a GPU. It accepts workflows on /prompt, "executes" them one at a time
+# with a fixed delay per sampler step, sends the same websocket events ComfyUI
+# does to the submitting client, and serves /history, /queue, /view and
+# /system_stats. Rendered images are flat-color PNGs of the workflow's latent size.
+# A node with class_type "StubError" fails the prompt the way a node exception
+# (e.g. CUDA out of memory) does in ComfyUI, with its "message" input as the error.
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class StubComfyUI:
+    def __init__(self, step_time=0.05):
+        self.step_time = step_time
+        self.pending = queue.Queue()
+        self.queued = []
+        self.running = None
+        self.history = {}
+        self.images = {}
+        self.sockets = {}
+        self.lock = threading.Lock()
+
+    def submit(self, workflow, client_id):
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            self.queued.append(prompt_id)
+        self.pending.put((prompt_id, workflow, client_id))
+        return prompt_id
+
+    def send(self, client_id, event_type, data):
+        with self.lock:
+            targets = [self.sockets[client_id]] if client_id in self.sockets else []
+        for connection in targets:
+            connection.send_text(json.dumps({"type": event_type, "data": data}))
+
+    def broadcast_status(self):
+        with self.lock:
+            remaining = len(self.queued) + (1 if self.running else 0)
+            targets = list(self.sockets.values())
+        for connection in targets:
+            connection.send_text(json.dumps({
+                "type": "status", "data": {"status": {"exec_info": {"queue_remaining": remaining}}}
+            }))
+
+    def run(self):
+        while True:
+            prompt_id, workflow, client_id = self.pending.get()
+            with self.lock:
+                self.queued.remove(prompt_id)
+                self.running = prompt_id
+            self.broadcast_status()
+            self.execute(prompt_id, workflow, client_id)
+            with self.lock:
+                self.running = None
+            self.broadcast_status()
+
+    def execute(self, prompt_id, workflow, client_id):
+        self.send(client_id, "execution_start", {"prompt_id": prompt_id})
+        outputs = {}
+        latent = {"width": 512, "height": 512, "batch_size": 1}
+        for node_id, node in sorted(workflow.items(), key=lambda item: int(item[0]) if item[0].isdigit() else 0):
+            inputs = node.get("inputs", {})
+            self.send(client_id, "executing", {"node": node_id, "prompt_id": prompt_id})
+            if node.get("class_type") == "StubError":
+                return self.fail(prompt_id, workflow, client_id, node_id, inputs.get("message", "Stub node error"))
+            if node.get("class_type") == "EmptyLatentImage":
+                latent = inputs
+            elif node.get("class_type") == "KSampler":
+                steps = int(inputs.get("steps", 20))
+                for step in range(1, steps + 1):
+                    time.sleep(self.step_time)
+                    self.send(client_id, "progress", {"value": step, "max": steps, "node": node_id, "prompt_id": prompt_id})
+            elif node.get("class_type") == "SaveImage":
+                images = []
+                for index in range(int(latent.get("batch_size", 1))):
+                    filename = f"{inputs.get('filename_prefix', 'ComfyUI')}_{prompt_id[:8]}_{index:05d}_.png"
+                    self.images[filename] = render_png(latent, f"{prompt_id}{index}")
+                    images.append({"filename": filename, "subfolder": "", "type": "output"})
+                outputs[node_id] = {"images": images}
+                self.send(client_id, "executed", {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id})
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {"client_id": client_id}, []],
+                "outputs": outputs,
+                "status": {"status_str": "success", "completed": True, "messages": []}
+            }
+        self.send(client_id, "execution_success", {"prompt_id": prompt_id})
+        self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    # ComfyUI follows an execution_error with the same null "executing" event
+    # that ends a successful prompt
+    def fail(self, prompt_id, workflow, client_id, node_id, message):
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {"client_id": client_id}, []],
+                "outputs": {},
+                "status": {"status_str": "error", "completed": False, "messages": []}
+            }
+        self.send(client_id, "execution_error", {
+            "prompt_id": prompt_id, "node_id": node_id, "node_type": "StubError",
+            "exception_message": message, "exception_type": "RuntimeError", "traceback": []
+        })
+        self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+
+def render_png(latent, key):
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    image = Image.new('RGB', (int(latent.get("width", 512)), int(latent.get("height", 512))), tuple(digest[:3]))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# Server side of one websocket connection (unmasked frames out, masked in)
+class WebSocketConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def _send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack('>H', len(payload))
+        else:
+            header += bytes([127]) + struct.pack('>Q', len(payload))
+        with self.lock:
+            try:
+                self.sock.sendall(header + payload)
+            except OSError:
+                pass
+
+    def send_text(self, text):
+        self._send_frame(0x1, text.encode('utf-8'))
+
+    def _recv_exact(self, count):
+        data = b''
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError("socket closed")
+            data += chunk
+        return data
+
+    # Read client frames until close, answering pings
+    def serve(self):
+        try:
+            while True:
+                first, second = self._recv_exact(2)
+                opcode = first & 0x0F
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack('>H', self._recv_exact(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', self._recv_exact(8))[0]
+                mask = self._recv_exact(4) if second & 0x80 else b'\0\0\0\0'
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._recv_exact(length)))
+                if opcode == 0x8:
+                    self._send_frame(0x8, b'')
+                    return
+                if opcode == 0x9:
+                    self._send_frame(0xA, payload)
+        except (ConnectionError, OSError):
+            return
+
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _json(self, body, status=200):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/ws':
+                return self._websocket(query.get('clientId', [str(uuid.uuid4())])[0])
+            if url.path == '/system_stats':
+                return self._json({"system": {"comfyui_version": "stub"}, "devices": []})
+            if url.path == '/queue':
+                with stub.lock:
+                    running = [[0, stub.running]] if stub.running else []
+                    pending = [[i + 1, prompt_id] for i, prompt_id in enumerate(stub.queued)]
+                return self._json({"queue_running": running, "queue_pending": pending})
+            if url.path.startswith('/history'):
+                prompt_id = url.path[len('/history/'):]
+                with stub.lock:
+                    if not prompt_id:
+                        return self._json(dict(stub.history))
+                    entry = stub.history.get(prompt_id)
+                return self._json({prompt_id: entry} if entry else {})
+            if url.path == '/view':
+                image = stub.images.get(query.get('filename', [''])[0])
+                if image is None:
+                    return self._json({"error": "not found"}, 404)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+                return
+            self._json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/prompt':
+                workflow = body.get('prompt')
+                if not isinstance(workflow, dict):
+                    return self._json({"error": {"message": "invalid prompt"}}, 400)
+                prompt_id = stub.submit(workflow, body.get('client_id'))
+                return self._json({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+            self._json({"error": "not found"}, 404)
+
+        def _websocket(self, client_id):
+            accept = base64.b64encode(hashlib.sha1((self.headers['Sec-WebSocket-Key'] + WS_GUID).encode()).digest()).decode()
+            self.send_response(101)
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', accept)
+            self.end_headers()
+            self.wfile.flush()
+
+            connection = WebSocketConnection(self.connection)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with stub.lock:
+                stub.sockets[client_id] = connection
+            stub.broadcast_status()
+            connection.serve()
+            with stub.lock:
+                if stub.sockets.get(client_id) is connection:
+                    del stub.sockets[client_id]
+            self.close_connection = True
+
+    return Handler
+
+
+# Start a stub and its HTTP server in background threads; port 0 picks a free port
+def serve(host='127.0.0.1', port=0, step_time=0.05):
+    stub = StubComfyUI(step_time=step_time)
+    threading.Thread(target=stub.run, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), make_handler(stub))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return stub, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub ComfyUI server for testing image-generation")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8188)
+    parser.add_argument('--step-time', type=float, default=0.05, help="seconds per sampler step")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.step_time)
+    print(f"Stub ComfyUI listening on http://{args.host}:{args.port}")
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+import json
+import time
+import uuid
+import logging
+import threading
+import requests
+import websocket
+
+logger = logging.getLogger(__name__)
+
+
+# Raised when ComfyUI rejects a workflow or cannot be reached
+class ComfyUIError(Exception):
+    pass
+
+
+# requests Session with a connection pool sized for concurrent calls
+def pooled_session(pool_size=16):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# HTTP side of the ComfyUI API for one server
+class ComfyUIClient:
+    def __init__(self, base_url, client_id=None, session=None, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id or str(uuid.uuid4())
+        self.session = session or pooled_session()
+        self.timeout = timeout
+
+    @property
+    def ws_url(self):
+        scheme, rest = self.base_url.split('://', 1)
+        return f"{'wss' if scheme == 'https' else 'ws'}://{rest}/ws?clientId={self.client_id}"
+
+    # Queue a workflow; events for it are sent to this client's websocket
+    def submit(self, workflow):
+        try:
+            response = self.session.post(
+                f"{self.base_url}/prompt",
+                json={"prompt": workflow, "client_id": self.client_id},
+                timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            raise ComfyUIError(f"ComfyUI unreachable: {e}")
+
+        if response.status_code != 200:
+            logger.error(f"ComfyUI API error: {response.text}")
+            raise ComfyUIError("Failed to submit workflow to ComfyUI")
+        return response.json().get('prompt_id')
+
+    # Bytes of an output image record from a prompt's outputs
+    def view(self, image):
+        response = self.session.get(
+            f"{self.base_url}/view",
+            params={"filename": image['filename'], "subfolder": image.get('subfolder', ''), "type": image.get('type', 'output')},
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise ComfyUIError(f"Failed to fetch {image['filename']} from ComfyUI")
+        return response.content
+
+    # Prompts running or waiting in ComfyUI's queue, from every client
+    def queue_depth(self):
+        response = self.session.get(f"{self.base_url}/queue", timeout=self.timeout)
+        response.raise_for_status()
+        queue = response.json()
+        return len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+    # True if the API answers
+    def responsive(self):
+        try:
+            return self.session.get(f"{self.base_url}/system_stats", timeout=5).status_code == 200
+        except requests.RequestException:
+            return False
+
+    # History entry for a prompt, or None while it has not finished
+    def history(self, prompt_id):
+        response = self.session.get(f"{self.base_url}/history/{prompt_id}", timeout=self.timeout)
+        if response.status_code != 200:
+            return None
+        return response.json().get(prompt_id)
+
+
+# Execution state of one submitted prompt, updated from websocket events
+class PromptState:
+    def __init__(self, prompt_id, finished=None):
+        self.prompt_id = prompt_id
+        self.finished = finished
+        self.status = 'queued'
+        self.node = None
+        self.value = 0
+        self.max = 0
+        self.outputs = None
+        self.error = None
+        # Caller data kept with the prompt, e.g. its cache key
+        self.context = {}
+        self.done = threading.Event()
+        self.updated_at = time.time()
+
+    # Record the prompt's outcome; the first terminal event wins
+    def finish(self, status, outputs=None, error=None):
+        if self.done.is_set():
+            return
+        self.status = status
+        self.outputs = outputs if outputs is not None else self.outputs
+        self.error = error
+        self.updated_at = time.time()
+        self.done.set()
+        if self.finished is not None:
+            with self.finished:
+                self.finished.notify_all()
+
+    def to_dict(self):
+        progress = round(self.value / self.max, 3) if self.max else (1.0 if self.status == 'completed' else 0.0)
+        return {
+            "prompt_id": self.prompt_id,
+            "status": self.status,
+            "node": self.node,
+            "progress": progress,
+            "step": self.value,
+            "steps": self.max,
+            "error": self.error
+        }
+
+
+# Tracks execution of every prompt submitted by a ComfyUIClient over one
+# background websocket connection, waking waiters as soon as their prompt
+# finishes. After a reconnect, and whenever the socket is down, unfinished
+# prompts are checked against /history so no completion is missed.
+class ComfyEventListener:
+    def __init__(self, client, history_interval=2, retention=3600, reconnect_delay=2, finished=None):
+        self.client = client
+        self.history_interval = history_interval
+        self.retention = retention
+        self.reconnect_delay = reconnect_delay
+        self.states = {}
+        self.lock = threading.Lock()
+        # Notified whenever any prompt finishes; may be shared by several listeners
+        self.finished = finished or threading.Condition()
+        self.connected = False
+        # Prompts waiting or running in ComfyUI, from status events or /queue
+        self.queue_remaining = 0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            ws = websocket.WebSocketApp(
+                self.client.ws_url,
+                on_open=self._on_open,
+                on_message=self._on_message,
+                on_close=self._on_close
+            )
+            try:
+                ws.run_forever(ping_interval=30, ping_timeout=10)
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket error: {e}")
+            self.connected = False
+            time.sleep(self.reconnect_delay)
+
+    def _on_open(self, ws):
+        self.connected = True
+        logger.info("Connected to ComfyUI websocket")
+        # Catch up on anything that finished while we were disconnected
+        threading.Thread(target=self.sync_pending, daemon=True).start()
+
+    def _on_close(self, ws, status_code, message):
+        self.connected = False
+
+    # State for a prompt, created if events for it have not been seen yet
+    def track(self, prompt_id):
+        with self.lock:
+            state = self.states.get(prompt_id)
+            if state is None:
+                state = self.states[prompt_id] = PromptState(prompt_id, self.finished)
+                self._prune()
+            return state
+
+    def get(self, prompt_id):
+        with self.lock:
+            return self.states.get(prompt_id)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for prompt_id in [p for p, s in self.states.items() if s.done.is_set() and s.updated_at < cutoff]:
+            del self.states[prompt_id]
+
+    def _on_message(self, ws, message):
+        # Binary messages are live previews; only JSON events matter here
+        if not isinstance(message, str):
+            return
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+
+        data = event.get('data') or {}
+        if event.get('type') == 'status':
+            exec_info = (data.get('status') or {}).get('exec_info') or {}
+            self.queue_remaining = exec_info.get('queue_remaining', self.queue_remaining)
+            return
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        state = self.track(prompt_id)
+        kind = event.get('type')
+
+        if kind == 'execution_start':
+            state.status = 'running'
+        elif kind == 'executing':
+            if data.get('node') is None:
+                # A null node marks the end of the prompt, and is also sent
+                # after execution_error or execution_interrupted
+                if not state.done.is_set():
+                    state.finish('completed')
+            else:
+                state.status = 'running'
+                state.node = data['node']
+        elif kind == 'progress':
+            state.status = 'running'
+            state.value, state.max = data.get('value', 0), data.get('max', 0)
+        elif kind == 'executed':
+            outputs = dict(state.outputs or {})
+            outputs[data.get('node')] = data.get('output') or {}
+            state.outputs = outputs
+        elif kind == 'execution_success':
+            state.finish('completed')
+        elif kind in ('execution_error', 'execution_interrupted'):
+            state.finish('failed', error=data.get('exception_message') or kind)
+        state.updated_at = time.time()
+
+    # Number of this client's prompts that have not finished
+    def pending(self):
+        with self.lock:
+            return sum(1 for state in self.states.values() if not state.done.is_set())
+
+    # Fail every unfinished prompt, e.g. when the ComfyUI process restarts and drops its queue
+    def fail_pending(self, error):
+        with self.lock:
+            pending = [state for state in self.states.values() if not state.done.is_set()]
+        for state in pending:
+            state.finish('failed', error=error)
+
+    # Resolve unfinished prompts from /history
+    def sync_pending(self):
+        with self.lock:
+            pending = [state for state in self.states.values() if not state.done.is_set()]
+        for state in pending:
+            self.check_history(state)
+
+    # Resolve a prompt from /history if it has finished
+    def check_history(self, state):
+        try:
+            entry = self.client.history(state.prompt_id)
+        except requests.RequestException as e:
+            logger.warning(f"ComfyUI history check failed: {e}")
+            return
+        if entry is None:
+            return
+        status = (entry.get('status') or {}).get('status_str')
+        if status == 'error':
+            state.finish('failed', error="ComfyUI execution error")
+        else:
+            state.finish('completed', outputs=entry.get('outputs', {}))
+
+    # Block until a prompt finishes or timeout passes. Returns its state, with
+    # outputs filled in from /history when events did not carry all of them
+    # (cached nodes emit no "executed" event).
+    def wait(self, prompt_id, timeout):
+        state = self.track(prompt_id)
+        deadline = time.time() + timeout
+        while not state.done.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return state
+            if not state.done.wait(remaining if self.connected else min(remaining, self.history_interval)):
+                if not self.connected:
+                    self.check_history(state)
+
+        if state.status == 'completed' and not find_images(state.outputs):
+            self._check_history_outputs(state)
+        return state
+
+    # Yield the states of prompt_ids as each finishes
+    def as_completed(self, prompt_ids, timeout):
+        return as_completed([(self, prompt_id) for prompt_id in prompt_ids], self.finished, timeout, self.history_interval)
+
+    def _check_history_outputs(self, state):
+        try:
+            entry = self.client.history(state.prompt_id)
+        except requests.RequestException as e:
+            logger.warning(f"ComfyUI history fetch failed: {e}")
+            return
+        if entry is not None:
+            state.outputs = entry.get('outputs', {})
+
+
+# Yield prompt states as each finishes, for (listener, prompt_id) pairs whose
+# listeners all notify the finished condition. Prompts still unfinished when
+# timeout passes are yielded last, in their unfinished state.
+def as_completed(tracked, finished, timeout, history_interval=2):
+    pending = {prompt_id: (listener, listener.track(prompt_id)) for listener, prompt_id in tracked}
+    deadline = time.time() + timeout
+    while pending:
+        done = [(listener, state) for listener, state in pending.values() if state.done.is_set()]
+        if not done:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            connected = all(listener.connected for listener, _ in pending.values())
+            with finished:
+                # Recheck under the condition so a finish between the scan
+                # above and this wait is not missed
+                if not any(state.done.is_set() for _, state in pending.values()):
+                    finished.wait(remaining if connected else min(remaining, history_interval))
+            # Events from a disconnected listener never arrive; ask /history
+            for listener, state in pending.values():
+                if not listener.connected and not state.done.is_set():
+                    listener.check_history(state)
+            continue
+
+        for listener, state in done:
+            del pending[state.prompt_id]
+            yield listener.wait(state.prompt_id, 0)
+
+    for _, state in pending.values():
+        yield state
+
+
+# Image records (filename, subfolder, type) from a prompt's outputs
+def find_images(outputs):
+    images = []
+    for _, output in sorted((outputs or {}).items()):
+        images.extend(output.get('images', []))
+    return images
@@ -0,0 +1,86 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Cache key for a compiled workflow. Everything that affects the rendered
+# image (prompts, seed, steps, cfg, sampler, checkpoint, resolution) is in the
+# workflow's node inputs, so equal workflows render equal images.
+def workflow_key(workflow):
+    canonical = json.dumps(workflow, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Thread-safe in-process LRU cache with a per-entry TTL
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# Rendered image cache: in-process LRU in front of a shared Redis tier.
+# Entries are the stored image's details, not the image bytes. The key prefix
+# carries the entry format version, so entries written in an older format
+# are never read back.
+class ImageCache:
+    def __init__(self, redis_client=None, max_size=1024, ttl=3600, redis_ttl=604800, prefix='imagegen:image:v2:'):
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.redis_client = redis_client
+        self.redis_ttl = redis_ttl
+        self.prefix = prefix
+
+    # Return (image, tier) on a hit, or (None, None) on a miss
+    def get(self, key):
+        image = self.local.get(key)
+        if image is not None:
+            return image, 'local'
+
+        if self.redis_client:
+            try:
+                cached = self.redis_client.get(self.prefix + key)
+            except Exception as e:
+                logger.warning(f"Redis cache read failed: {e}")
+                cached = None
+            if cached:
+                image = json.loads(cached)
+                self.local.set(key, image)
+                return image, 'redis'
+
+        return None, None
+
+    # shared=False keeps the entry out of the Redis tier, for images stored
+    # where only this process can read them
+    def set(self, key, image, shared=True):
+        self.local.set(key, image)
+
+        if self.redis_client and shared:
+            try:
+                self.redis_client.setex(self.prefix + key, self.redis_ttl, json.dumps(image))
+            except Exception as e:
+                logger.warning(f"Redis cache write failed: {e}")
@@ -0,0 +1,161 @@
+import io
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Pillow only writes AVIF with the pillow-avif-plugin installed
+try:
+    import pillow_avif  # noqa: F401
+    AVIF_SUPPORTED = True
+except ImportError:
+    AVIF_SUPPORTED = False
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'avif': 'image/avif'
+}
+
+
+# Parse a comma-separated list of output formats, dropping AVIF when it cannot be written
+def parse_formats(value):
+    formats = [part.strip().lower() for part in value.split(',') if part.strip()]
+    unknown = [fmt for fmt in formats if fmt not in CONTENT_TYPES]
+    if unknown:
+        raise ValueError(f"Unsupported image formats: {unknown}")
+    if 'avif' in formats and not AVIF_SUPPORTED:
+        logger.warning("pillow-avif-plugin not installed; skipping AVIF variants")
+        formats.remove('avif')
+    return formats
+
+def _encode(image, fmt, quality):
+    buffer = io.BytesIO()
+    if fmt == 'png':
+        image.save(buffer, format='PNG', optimize=True)
+    else:
+        image.save(buffer, format=fmt.upper(), quality=quality)
+    return buffer.getvalue()
+
+# Encode a rendered PNG as full-size and thumbnail variants in each format.
+# CPU-bound, so it runs in a process pool. Returns the image size and a list
+# of (name, content_type, data), e.g. ("thumb.webp", "image/webp", b"...").
+def render_variants(png, formats, thumbnail_width=256, quality=None):
+    quality = quality or {}
+    image = Image.open(io.BytesIO(png))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_width, thumbnail_width * image.height // image.width), Image.LANCZOS)
+
+    variants = [('original.png', CONTENT_TYPES['png'], png)]
+    for fmt in formats:
+        if fmt == 'png':
+            continue
+        variants.append((f'full.{fmt}', CONTENT_TYPES[fmt], _encode(image, fmt, quality.get(fmt, 80))))
+        variants.append((f'thumb.{fmt}', CONTENT_TYPES[fmt], _encode(thumbnail, fmt, quality.get(fmt, 80))))
+    return image.size, variants
+
+
+# Process pool for image encoding. Workers come from a forkserver rather than
+# being forked from the multithreaded server process, which can deadlock the
+# child. If a worker dies (e.g. OOM-killed) the pool is broken for good, so it
+# is replaced and the job retried once on the new pool.
+class EncodePool:
+    def __init__(self, max_workers, start_method='forkserver'):
+        self.max_workers = max_workers
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            # Workers need this module, not the server's __main__
+            self.context.set_forkserver_preload([__name__])
+        self.lock = threading.Lock()
+        self.executor = self._create()
+
+    def _create(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.context)
+
+    def _replace(self, broken):
+        with self.lock:
+            if self.executor is broken:
+                logger.warning("Image encoding pool broke; starting a new one")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._create()
+            return self.executor
+
+    # Run fn(*args) in a worker process and return its result
+    def run(self, fn, *args):
+        executor = self.executor
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            return self._replace(executor).submit(fn, *args).result()
+
+
+# Images in S3, served through the CDN
+class S3ImageStore:
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def put(self, key, body, content_type):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=body,
+            ContentType=content_type,
+            # Keys are content-addressed, so objects never change
+            CacheControl='public, max-age=31536000, immutable'
+        )
+
+
+# Images on local disk, for running without S3 credentials
+class LocalImageStore:
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, key, body, content_type):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+
+# Encode a rendered image on encode_pool (an EncodePool) and upload every
+# variant under prefix in parallel. Returns the URLs of each variant plus the
+# image size; image_url is the first full-size web format, or the original PNG.
+def publish(png, prefix, store, url_for, encode_pool, formats, thumbnail_width=256, quality=None,
+            upload_concurrency=8):
+    size, variants = encode_pool.run(render_variants, png, formats, thumbnail_width, quality)
+
+    def upload(variant):
+        name, content_type, data = variant
+        store.put(prefix + name, data, content_type)
+
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+        # list() so the first failed upload raises here
+        list(executor.map(upload, variants))
+
+    images = {"original": url_for(prefix + 'original.png')}
+    thumbnails = {}
+    for name, _, _ in variants:
+        variant, fmt = name.split('.')
+        if variant == 'full':
+            images[fmt] = url_for(prefix + name)
+        elif variant == 'thumb':
+            thumbnails[fmt] = url_for(prefix + name)
+
+    full_formats = [fmt for fmt in formats if fmt in images and fmt != 'png']
+    return {
+        "image_url": images[full_formats[0]] if full_formats else images["original"],
+        "images": images,
+        "thumbnails": thumbnails,
+        "width": size[0],
+        "height": size[1]
+    }
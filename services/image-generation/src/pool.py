@@ -0,0 +1,141 @@
+import time
+import logging
+import threading
+import requests
+from comfyui import ComfyUIClient, ComfyEventListener, ComfyUIError, as_completed, pooled_session
+from supervisor import ComfyUISupervisor
+
+logger = logging.getLogger(__name__)
+
+
+# Parse a comma-separated list of ComfyUI base URLs
+def parse_backends(value):
+    return [url.strip().rstrip('/') for url in value.split(',') if url.strip()]
+
+
+# One ComfyUI server: its HTTP client, websocket listener and supervisor
+class Backend:
+    def __init__(self, url, listener_options, supervisor_options, session_pool_size, finished):
+        self.url = url
+        self.client = ComfyUIClient(url, session=pooled_session(session_pool_size))
+        self.listener = ComfyEventListener(self.client, finished=finished, **listener_options)
+        self.supervisor = ComfyUISupervisor(self.client, self.listener, **supervisor_options)
+
+    # Prompts ahead of a new one: ComfyUI's queue as last reported, or this
+    # process's unfinished prompts if more were submitted since the report
+    def load(self):
+        return max(self.listener.queue_remaining, self.listener.pending())
+
+    def to_dict(self):
+        return dict(self.supervisor.to_dict(), url=self.url, queue_depth=self.load(),
+                    websocket=self.listener.connected)
+
+
+# Spreads prompts across several ComfyUI servers. Each prompt goes to the
+# ready backend with the shortest queue, as reported by websocket status events
+# and a periodic /queue poll. Prompt lookups and waits are routed to whichever
+# backend's listener tracks the prompt.
+class ComfyUIPool:
+    def __init__(self, urls, warmup_workflow, managed_command=None, history_interval=2,
+                 queue_poll_interval=5, session_pool_size=16, on_change=None, on_queue_depth=None,
+                 **supervisor_options):
+        self.finished = threading.Condition()
+        self.history_interval = history_interval
+        self.queue_poll_interval = queue_poll_interval
+        self.on_queue_depth = on_queue_depth or (lambda url, depth: None)
+        self.backends = []
+        self.next_index = 0
+        self.lock = threading.Lock()
+        on_change = on_change or (lambda backend, status: None)
+
+        for index, url in enumerate(urls):
+            options = dict(
+                supervisor_options,
+                warmup_workflow=warmup_workflow,
+                # Only the first backend can be the ComfyUI this process runs
+                command=managed_command if index == 0 else None
+            )
+            backend = Backend(url, {"history_interval": history_interval}, options, session_pool_size, self.finished)
+            backend.supervisor.on_change = lambda status, backend=backend: on_change(backend, status)
+            self.backends.append(backend)
+
+    def start(self):
+        for backend in self.backends:
+            backend.listener.start()
+            backend.supervisor.start()
+        threading.Thread(target=self._poll_queues, daemon=True).start()
+
+    def _poll_queues(self):
+        while True:
+            for backend in self.backends:
+                if not backend.supervisor.ready.is_set():
+                    continue
+                try:
+                    backend.listener.queue_remaining = backend.client.queue_depth()
+                except (requests.RequestException, ValueError) as e:
+                    logger.warning(f"ComfyUI queue check failed for {backend.url}: {e}")
+                    continue
+                self.on_queue_depth(backend.url, backend.listener.queue_remaining)
+            time.sleep(self.queue_poll_interval)
+
+    def ready(self):
+        return any(backend.supervisor.ready.is_set() for backend in self.backends)
+
+    def to_dict(self):
+        return [backend.to_dict() for backend in self.backends]
+
+    # Ready backend with the least work queued; ties rotate so idle backends share new work
+    def choose(self):
+        with self.lock:
+            start = self.next_index
+            self.next_index = (self.next_index + 1) % len(self.backends)
+        candidates = [
+            self.backends[(start + offset) % len(self.backends)] for offset in range(len(self.backends))
+        ]
+        ready = [backend for backend in candidates if backend.supervisor.ready.is_set()]
+        if not ready:
+            raise ComfyUIError("No ComfyUI backend is ready")
+        return min(ready, key=lambda backend: backend.load())
+
+    # Queue a workflow on the least-loaded backend and start tracking it
+    def submit(self, workflow):
+        backend = self.choose()
+        prompt_id = backend.client.submit(workflow)
+        backend.listener.track(prompt_id)
+        return prompt_id
+
+    def _listener_for(self, prompt_id):
+        for backend in self.backends:
+            if backend.listener.get(prompt_id) is not None:
+                return backend.listener
+        return None
+
+    # Bytes of one of a prompt's output images, from the backend that rendered it
+    def view(self, prompt_id, image):
+        listener = self._listener_for(prompt_id)
+        if listener is None:
+            raise ComfyUIError(f"Unknown prompt {prompt_id}")
+        return listener.client.view(image)
+
+    def get(self, prompt_id):
+        listener = self._listener_for(prompt_id)
+        return listener.get(prompt_id) if listener else None
+
+    # Bring a prompt's state up to date from /history if its events may have been missed
+    def refresh(self, state):
+        listener = self._listener_for(state.prompt_id)
+        if listener and not listener.connected and not state.done.is_set():
+            listener.check_history(state)
+
+    def wait(self, prompt_id, timeout):
+        listener = self._listener_for(prompt_id)
+        if listener is None:
+            raise ComfyUIError(f"Unknown prompt {prompt_id}")
+        return listener.wait(prompt_id, timeout)
+
+    def as_completed(self, prompt_ids, timeout):
+        tracked = [(self._listener_for(prompt_id), prompt_id) for prompt_id in prompt_ids]
+        missing = [prompt_id for listener, prompt_id in tracked if listener is None]
+        if missing:
+            raise ComfyUIError(f"Unknown prompts {missing}")
+        return as_completed(tracked, self.finished, timeout, self.history_interval)
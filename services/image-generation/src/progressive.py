@@ -0,0 +1,108 @@
+import time
+import uuid
+import threading
+
+
+# A progressive render: a quick preview image that stands in until the
+# full-quality render of the same prompt replaces it
+class Render:
+    def __init__(self, prompt_id, info):
+        self.render_id = str(uuid.uuid4())
+        self.prompt_id = prompt_id
+        self.info = info
+        self.status = 'rendering'
+        self.preview = None
+        self.final = None
+        self.error = None
+        # Progress of the full render while it runs
+        self.progress = {"progress": 0.0, "step": 0, "steps": 0}
+        self.done = threading.Event()
+        self.updated_at = time.time()
+
+    def to_dict(self):
+        current = self.final or self.preview or {}
+        record = dict(
+            self.info,
+            render_id=self.render_id,
+            status=self.status,
+            image_url=current.get("image_url"),
+            preview=self.preview,
+            final=self.final,
+            error=self.error,
+            status_url=f"/api/renders/{self.render_id}",
+            events_url=f"/api/renders/{self.render_id}/events"
+        )
+        if not self.done.is_set():
+            record.update(self.progress)
+        return record
+
+
+# Registry of progressive renders. The pod running a render keeps it in
+# process for retention seconds after it finishes and writes every change to
+# store (a RecordStore), so the status and event URLs work on any replica.
+class RenderTracker:
+    def __init__(self, store, retention=3600):
+        self.store = store
+        self.retention = retention
+        self.renders = {}
+        self.lock = threading.Lock()
+
+    def create(self, prompt_id, info):
+        render = Render(prompt_id, info)
+        with self.lock:
+            self._prune()
+            self.renders[render.render_id] = render
+        self._save(render)
+        return render
+
+    def get(self, render_id):
+        with self.lock:
+            return self.renders.get(render_id)
+
+    # Current record of a render from this pod or the shared store, or None
+    def record(self, render_id):
+        render = self.get(render_id)
+        if render is not None:
+            return render.to_dict()
+        return self.store.load(render_id)
+
+    # Record of a render after it finishes or timeout passes, whichever is first
+    def wait(self, render_id, timeout):
+        render = self.get(render_id)
+        if render is not None:
+            render.done.wait(timeout)
+        else:
+            time.sleep(timeout)
+        return self.record(render_id)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        for render_id in [r for r, render in self.renders.items() if render.done.is_set() and render.updated_at < cutoff]:
+            del self.renders[render_id]
+
+    def _save(self, render):
+        render.updated_at = time.time()
+        self.store.save(render.render_id, render.to_dict())
+
+    def set_progress(self, render, progress):
+        if progress != render.progress:
+            render.progress = progress
+            self._save(render)
+
+    def set_preview(self, render, image):
+        render.preview = image
+        if render.status == 'rendering':
+            render.status = 'preview'
+        self._save(render)
+
+    def complete(self, render, image):
+        render.final = image
+        render.status = 'complete'
+        render.done.set()
+        self._save(render)
+
+    def fail(self, render, error):
+        render.error = error
+        render.status = 'failed'
+        render.done.set()
+        self._save(render)
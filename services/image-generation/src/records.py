@@ -0,0 +1,36 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# JSON status records shared between replicas through Redis, so a poll can be
+# answered by any pod, not only the one doing the work. Without Redis nothing
+# is shared and load() finds nothing.
+class RecordStore:
+    def __init__(self, redis_client, prefix, ttl=3600):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return self.redis_client is not None
+
+    def save(self, record_id, record):
+        if not self.enabled:
+            return
+        try:
+            self.redis_client.setex(self.prefix + record_id, self.ttl, json.dumps(record))
+        except Exception as e:
+            logger.warning(f"Redis record write failed: {e}")
+
+    def load(self, record_id):
+        if not self.enabled:
+            return None
+        try:
+            stored = self.redis_client.get(self.prefix + record_id)
+        except Exception as e:
+            logger.warning(f"Redis record read failed: {e}")
+            return None
+        return json.loads(stored) if stored else None
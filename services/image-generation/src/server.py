@@ -2,13 +2,21 @@ import os
 import json
 import uuid
 import time
+import random
 import logging
+import tempfile
 import threading
-import subprocess
-from flask import Flask, request, jsonify
+import boto3
+import redis
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import requests
-from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from comfyui import ComfyUIError, find_images
+from image_cache import ImageCache, workflow_key
+from pool import ComfyUIPool, parse_backends
+from progressive import RenderTracker
+from records import RecordStore
+import media
 
 # Configure logging
 logging.basicConfig(
@@ -25,14 +33,106 @@ CORS(app)
 GENERATION_REQUESTS = Counter('image_generation_requests_total', 'Total number of image generation requests')
 GENERATION_ERRORS = Counter('image_generation_errors_total', 'Total number of image generation errors')
 GENERATION_TIME = Histogram('image_generation_time_seconds', 'Time spent generating images')
+STORY_REQUESTS = Counter('image_story_requests_total', 'Total number of story illustration requests')
+STORY_GENERATION_TIME = Histogram('image_story_generation_time_seconds', 'Time spent illustrating whole stories')
+CACHE_HITS = Counter('image_generation_cache_hits_total', 'Total number of image cache hits', ['tier'])
+CACHE_MISSES = Counter('image_generation_cache_misses_total', 'Total number of image cache misses')
+COMFYUI_READY = Gauge('image_generation_comfyui_ready', 'Whether a ComfyUI backend is up and warmed up', ['backend'])
+COMFYUI_RESTARTS = Counter('image_generation_comfyui_restarts_total', 'Total number of ComfyUI restarts', ['backend'])
+POSTPROCESS_TIME = Histogram('image_postprocess_time_seconds', 'Time spent encoding and uploading image variants')
+POSTPROCESS_ERRORS = Counter('image_postprocess_errors_total', 'Total number of failed image post-processing runs')
+COMFYUI_QUEUE_DEPTH = Gauge('image_generation_comfyui_queue_depth', 'Prompts queued or running on a ComfyUI backend', ['backend'])
 
 # ComfyUI API endpoint
 COMFYUI_API = os.environ.get('COMFYUI_API', 'http://localhost:8188')
+# Comma-separated ComfyUI endpoints to spread work across; the first is the
+# local one when COMFYUI_MANAGED is set
+COMFYUI_APIS = parse_backends(os.environ.get('COMFYUI_APIS', COMFYUI_API))
+# Seconds between /queue depth checks on each backend
+QUEUE_POLL_INTERVAL = float(os.environ.get('QUEUE_POLL_INTERVAL', '5'))
+# HTTP connections kept open to each backend
+COMFYUI_POOL_SIZE = int(os.environ.get('COMFYUI_POOL_SIZE', 16))
+# Seconds to wait for a prompt to finish before giving up
+GENERATION_TIMEOUT = float(os.environ.get('GENERATION_TIMEOUT', '120'))
+# Seconds between /history checks while the ComfyUI websocket is disconnected
+HISTORY_FALLBACK_INTERVAL = float(os.environ.get('HISTORY_FALLBACK_INTERVAL', '2'))
+# Whether this process runs ComfyUI itself (false when it runs elsewhere)
+COMFYUI_MANAGED = os.environ.get('COMFYUI_MANAGED', 'true').lower() == 'true'
+COMFYUI_COMMAND = ["python", "/app/ComfyUI/main.py", "--listen", "0.0.0.0", "--port", "8188"]
+COMFYUI_STARTUP_TIMEOUT = int(os.environ.get('COMFYUI_STARTUP_TIMEOUT', 300))
+COMFYUI_WARMUP_TIMEOUT = int(os.environ.get('COMFYUI_WARMUP_TIMEOUT', 600))
+COMFYUI_CHECK_INTERVAL = int(os.environ.get('COMFYUI_CHECK_INTERVAL', 10))
+COMFYUI_RESTART_DELAY = int(os.environ.get('COMFYUI_RESTART_DELAY', 5))
+# Progressive mode previews: fewer sampler steps on a smaller latent
+PREVIEW_STEPS = int(os.environ.get('PREVIEW_STEPS', 10))
+PREVIEW_SCALE = float(os.environ.get('PREVIEW_SCALE', 0.5))
+# Seconds between progress checks on a render's event stream
+RENDER_EVENTS_INTERVAL = float(os.environ.get('RENDER_EVENTS_INTERVAL', 0.5))
+# How long render and progress records stay readable from every replica
+STATUS_RECORD_TTL = int(os.environ.get('STATUS_RECORD_TTL', 3600))
+# Most pages accepted by one story illustration request
+MAX_STORY_PAGES = int(os.environ.get('MAX_STORY_PAGES', '30'))
+
+# Seed used unless the caller passes one or asks for a varied seed
+DEFAULT_SEED = int(os.environ.get('DEFAULT_SEED', 123456789))
+
+# Initialize Redis client for the shared image cache tier
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+try:
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    redis_client.ping()
+    logger.info("Connected to Redis")
+except Exception as e:
+    logger.error(f"Redis connection error: {e}")
+    redis_client = None
+
+# Image cache configuration
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', 1024))
+IMAGE_CACHE_TTL = int(os.environ.get('IMAGE_CACHE_TTL', 3600))
+IMAGE_CACHE_REDIS_TTL = int(os.environ.get('IMAGE_CACHE_REDIS_TTL', 604800))
+
+image_cache = ImageCache(
+    redis_client=redis_client,
+    max_size=IMAGE_CACHE_SIZE,
+    ttl=IMAGE_CACHE_TTL,
+    redis_ttl=IMAGE_CACHE_REDIS_TTL
+)
 
 # S3 configuration
+AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY')
+AWS_SECRET_KEY = os.environ.get('AWS_SECRET_KEY')
+AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
 S3_BUCKET = os.environ.get('S3_BUCKET', 'storyverse-media')
 S3_PREFIX = os.environ.get('S3_PREFIX', 'stories')
 
+if AWS_ACCESS_KEY and AWS_SECRET_KEY:
+    s3_client = boto3.client(
+        's3',
+        aws_access_key_id=AWS_ACCESS_KEY,
+        aws_secret_access_key=AWS_SECRET_KEY,
+        region_name=AWS_REGION
+    )
+else:
+    logger.warning("AWS credentials not set. Images will be stored locally.")
+    s3_client = None
+
+# Image delivery: variants are served from CDN_BASE_URL (the bucket's CDN) when set
+CDN_BASE_URL = os.environ.get('CDN_BASE_URL', '').rstrip('/')
+LOCAL_IMAGE_DIR = os.environ.get('LOCAL_IMAGE_DIR', os.path.join(tempfile.gettempdir(), 'storyverse-images'))
+IMAGE_FORMATS = media.parse_formats(os.environ.get('IMAGE_FORMATS', 'webp,avif'))
+IMAGE_QUALITY = {
+    'webp': int(os.environ.get('WEBP_QUALITY', 80)),
+    'avif': int(os.environ.get('AVIF_QUALITY', 55))
+}
+THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', 256))
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', 2))
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 8))
+
+image_store = media.S3ImageStore(s3_client, S3_BUCKET) if s3_client else media.LocalImageStore(LOCAL_IMAGE_DIR)
+# Encoding is CPU-bound, so it runs in worker processes rather than Flask threads
+encode_pool = media.EncodePool(max_workers=POSTPROCESS_WORKERS)
+
 # Character templates
 CHARACTER_TEMPLATES = {
     'goku': {
@@ -66,16 +166,8 @@ def start_metrics_server():
     start_http_server(8000)
     logger.info("Prometheus metrics server started on port 8000")
 
-# Start ComfyUI server
-def start_comfyui():
-    logger.info("Starting ComfyUI server...")
-    subprocess.Popen(["python", "/app/ComfyUI/main.py", "--listen", "0.0.0.0", "--port", "8188"])
-    # Wait for ComfyUI to start
-    time.sleep(10)
-    logger.info("ComfyUI server started")
-
 # Generate workflow for character combination
-def generate_workflow(characters, scene, style):
+def generate_workflow(characters, scene, style, seed=DEFAULT_SEED, steps=30, width=768, height=512):
     # This is a simplified workflow - in a real implementation, this would be more complex
     # and would handle character combinations more intelligently
     
@@ -96,8 +188,8 @@ def generate_workflow(characters, scene, style):
     workflow = {
         "3": {
             "inputs": {
-                "seed": 123456789,
-                "steps": 30,
+                "seed": seed,
+                "steps": steps,
                 "cfg": 7.5,
                 "sampler_name": "euler_ancestral",
                 "scheduler": "normal",
@@ -117,8 +209,8 @@ def generate_workflow(characters, scene, style):
         },
         "5": {
             "inputs": {
-                "width": 768,
-                "height": 512,
+                "width": width,
+                "height": height,
                 "batch_size": 1
             },
             "class_type": "EmptyLatentImage"
@@ -155,11 +247,279 @@ def generate_workflow(characters, scene, style):
     
     return workflow
 
-# Health check endpoint
+# Quick preview of the image generate_workflow would render with the same
+# prompt and seed, at PREVIEW_STEPS steps and PREVIEW_SCALE of the resolution
+def preview_workflow(characters, scene, style, seed):
+    # Latent sizes must be multiples of 8
+    width = max(64, int(768 * PREVIEW_SCALE) // 8 * 8)
+    height = max(64, int(512 * PREVIEW_SCALE) // 8 * 8)
+    return generate_workflow(characters, scene, style, seed, steps=PREVIEW_STEPS, width=width, height=height)
+
+# Keep metrics in step with each backend's supervisor; prompts queued in a
+# ComfyUI that is being restarted are lost, so fail their waiters right away
+def comfyui_status_changed(backend, status):
+    COMFYUI_READY.labels(backend=backend.url).set(1 if status == 'ready' else 0)
+    if status == 'restarting':
+        COMFYUI_RESTARTS.labels(backend=backend.url).inc()
+        backend.listener.fail_pending("ComfyUI restarted")
+
+def comfyui_queue_depth(url, depth):
+    COMFYUI_QUEUE_DEPTH.labels(backend=url).set(depth)
+
+# ComfyUI backends, each supervised; the warmup render loads the checkpoint before traffic arrives
+comfyui_pool = ComfyUIPool(
+    COMFYUI_APIS,
+    generate_workflow(["warmup"], "", "cartoon", steps=1, width=64, height=64),
+    managed_command=COMFYUI_COMMAND if COMFYUI_MANAGED else None,
+    history_interval=HISTORY_FALLBACK_INTERVAL,
+    queue_poll_interval=QUEUE_POLL_INTERVAL,
+    session_pool_size=COMFYUI_POOL_SIZE,
+    on_change=comfyui_status_changed,
+    on_queue_depth=comfyui_queue_depth,
+    startup_timeout=COMFYUI_STARTUP_TIMEOUT,
+    warmup_timeout=COMFYUI_WARMUP_TIMEOUT,
+    check_interval=COMFYUI_CHECK_INTERVAL,
+    restart_delay=COMFYUI_RESTART_DELAY
+)
+
+# Health check endpoint: ready once some ComfyUI backend is up and warmed up
 @app.route('/health', methods=['GET'])
 def health_check():
+    backends = comfyui_pool.to_dict()
+    if not comfyui_pool.ready():
+        return jsonify({"status": "unavailable", "backends": backends}), 503
+    return jsonify({"status": "ok", "backends": backends})
+
+# Liveness endpoint: the Flask process is serving. ComfyUI restarts are
+# handled by the supervisor, so they do not fail this check.
+@app.route('/live', methods=['GET'])
+def liveness_check():
     return jsonify({"status": "ok"})
 
+# Error response for requests that need ComfyUI while it is not ready
+def comfyui_unavailable():
+    response = jsonify({
+        "error": "Image generation is not ready",
+        "backends": {backend["url"]: backend["status"] for backend in comfyui_pool.to_dict()}
+    })
+    response.headers['Retry-After'] = str(COMFYUI_CHECK_INTERVAL)
+    return response, 503
+
+def media_url(key):
+    if CDN_BASE_URL:
+        return f"{CDN_BASE_URL}/{key}"
+    if s3_client:
+        return f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{key}"
+    return f"local://{os.path.join(LOCAL_IMAGE_DIR, key)}"
+
+# Encode a rendered PNG into its web variants and upload them. Keys are
+# content-addressed by the workflow that rendered the image.
+def publish_image(png, key):
+    start_time = time.time()
+    image = media.publish(
+        png,
+        f"{S3_PREFIX}/images/{key}/",
+        image_store,
+        media_url,
+        encode_pool,
+        IMAGE_FORMATS,
+        thumbnail_width=THUMBNAIL_WIDTH,
+        quality=IMAGE_QUALITY,
+        upload_concurrency=UPLOAD_CONCURRENCY
+    )
+    POSTPROCESS_TIME.observe(time.time() - start_time)
+    return image
+
+# Seed for a request: a fresh random one with vary_seed, else the given or default seed
+def request_seed(data):
+    if data.get('vary_seed'):
+        return random.randint(0, 2**32 - 1)
+    return int(data.get('seed', DEFAULT_SEED))
+
+# Cached image for a workflow, or None. Varied-seed requests always render.
+def cached_image(key, vary_seed):
+    if vary_seed:
+        return None
+    image, tier = image_cache.get(key)
+    if image is None:
+        CACHE_MISSES.inc()
+        return None
+    CACHE_HITS.labels(tier=tier).inc()
+    return image
+
+# Published image for a finished prompt, or None. The rendered PNG is fetched
+# from the backend that rendered it and published once, then cached under the
+# prompt's workflow key.
+def prompt_image(state):
+    if state.status != 'completed':
+        return None
+    if 'image' in state.context:
+        return state.context['image']
+    if not find_images(state.outputs):
+        comfyui_pool.wait(state.prompt_id, 0)
+    images = find_images(state.outputs)
+    if not images:
+        return None
+    
+    key = state.context.get('cache_key') or state.prompt_id
+    try:
+        image = publish_image(comfyui_pool.view(state.prompt_id, images[0]), key)
+    except Exception:
+        logger.exception(f"Image post-processing failed for prompt {state.prompt_id}")
+        POSTPROCESS_ERRORS.inc()
+        return None
+    
+    state.context['image'] = image
+    if state.context.get('cache_key'):
+        # Without S3, images are on this pod's disk, so other pods must not reuse them
+        image_cache.set(state.context.pop('cache_key'), image, shared=s3_client is not None)
+    return image
+
+# Why a prompt has no image
+def prompt_error(state):
+    if state.error:
+        return state.error
+    return "Image post-processing failed" if state.status == 'completed' else "Image generation timed out"
+
+# Queue a workflow in ComfyUI and start tracking it
+def submit_workflow(workflow, key):
+    prompt_id = comfyui_pool.submit(workflow)
+    comfyui_pool.get(prompt_id).context['cache_key'] = key
+    return prompt_id
+
+# Prompt progress and render records for polls that land on another replica
+progress_records = RecordStore(redis_client, 'imagegen:progress:', STATUS_RECORD_TTL)
+render_records = RecordStore(redis_client, 'imagegen:render:', STATUS_RECORD_TTL)
+
+# Wait for a prompt to finish, passing its progress to on_progress every
+# RENDER_EVENTS_INTERVAL while it changes. Returns its final state.
+def follow_prompt(prompt_id, on_progress):
+    deadline = time.time() + GENERATION_TIMEOUT
+    last = None
+    while True:
+        state = comfyui_pool.wait(prompt_id, max(0, min(RENDER_EVENTS_INTERVAL, deadline - time.time())))
+        if state.done.is_set() or time.time() >= deadline:
+            return state
+        progress = state.to_dict()
+        if progress != last:
+            last = progress
+            on_progress(progress)
+
+# Progress of a prompt, with its published image once it has completed
+def prompt_progress(state):
+    progress = state.to_dict()
+    if state.status == 'completed':
+        image = prompt_image(state)
+        if image is None:
+            progress["error"] = prompt_error(state)
+        else:
+            progress.update(image)
+    return progress
+
+# Mirror a queued prompt's progress, then its published image, to
+# progress_records so /api/progress answers on every replica
+def share_progress(prompt_id):
+    state = follow_prompt(prompt_id, lambda progress: progress_records.save(prompt_id, progress))
+    progress_records.save(prompt_id, prompt_progress(state))
+
+# Progress of a submitted prompt
+@app.route('/api/progress/<prompt_id>', methods=['GET'])
+def get_progress(prompt_id):
+    state = comfyui_pool.get(prompt_id)
+    if state is None:
+        # Submitted through another replica
+        progress = progress_records.load(prompt_id)
+        if progress is None:
+            return jsonify({"error": "Unknown prompt"}), 404
+        return jsonify(progress)
+    
+    # Events may have been missed while the websocket was down
+    comfyui_pool.refresh(state)
+    return jsonify(prompt_progress(state))
+
+# Progressive renders started by /api/generate
+renders = RenderTracker(render_records)
+
+# Wait for a progressive render's full-quality prompt and publish it over the preview
+def finish_render(render, start_time):
+    state = follow_prompt(render.prompt_id, lambda progress: renders.set_progress(
+        render, {key: progress[key] for key in ('progress', 'step', 'steps')}
+    ))
+    image = prompt_image(state)
+    if image is None:
+        GENERATION_ERRORS.inc()
+        renders.fail(render, prompt_error(state))
+        return
+    GENERATION_TIME.observe(time.time() - start_time)
+    renders.complete(render, image)
+
+# Progressive render: queue a quick preview ahead of the full render, answer
+# as soon as the preview is ready, and finish the full render in the
+# background. The render's status URL and event stream report the final image.
+def progressive_render(result, preview, workflow, key, start_time):
+    preview_key = workflow_key(preview)
+    preview_image = cached_image(preview_key, False)
+    try:
+        preview_id = None if preview_image else submit_workflow(preview, preview_key)
+        prompt_id = submit_workflow(workflow, key)
+    except ComfyUIError as e:
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": str(e)}), 500
+    
+    render = renders.create(prompt_id, dict(result, cached=False))
+    if preview_id:
+        preview_image = prompt_image(comfyui_pool.wait(preview_id, GENERATION_TIMEOUT))
+    if preview_image:
+        renders.set_preview(render, preview_image)
+    threading.Thread(target=finish_render, args=(render, start_time), daemon=True).start()
+    
+    # Without a preview the caller still gets the render to follow
+    return jsonify(render.to_dict()), 200 if preview_image else 202
+
+# Status of a progressive render, including the full render's progress, from
+# whichever replica runs it
+@app.route('/api/renders/<render_id>', methods=['GET'])
+def get_render(render_id):
+    status = renders.record(render_id)
+    if status is None:
+        return jsonify({"error": "Unknown render"}), 404
+    return jsonify(status)
+
+# Server-sent events for a progressive render: "progress" while the full
+# render runs, then one "complete" or "failed" event, after which the stream ends
+@app.route('/api/renders/<render_id>/events', methods=['GET'])
+def render_events(render_id):
+    if renders.record(render_id) is None:
+        return jsonify({"error": "Unknown render"}), 404
+    
+    def stream():
+        last = None
+        idle = 0
+        while True:
+            status = renders.wait(render_id, RENDER_EVENTS_INTERVAL)
+            if status is None:
+                yield f"event: failed\ndata: {json.dumps({'render_id': render_id, 'error': 'Render expired'})}\n\n"
+                return
+            if status["status"] in ('complete', 'failed'):
+                yield f"event: {status['status']}\ndata: {json.dumps(status)}\n\n"
+                return
+            if status != last:
+                last = status
+                idle = 0
+                yield f"event: progress\ndata: {json.dumps(status)}\n\n"
+            else:
+                idle += RENDER_EVENTS_INTERVAL
+                # Comment line keeps proxies from closing a quiet stream
+                if idle >= 15:
+                    idle = 0
+                    yield ": keepalive\n\n"
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Image generation endpoint
 @app.route('/api/generate', methods=['POST'])
 def generate_image():
@@ -183,69 +543,194 @@ def generate_image():
             GENERATION_ERRORS.inc()
             return jsonify({"error": "No characters provided"}), 400
         
+        try:
+            seed = request_seed(data)
+        except (TypeError, ValueError):
+            GENERATION_ERRORS.inc()
+            return jsonify({"error": "seed must be an integer"}), 400
+        
+        result = {
+            "status": "success",
+            "story_id": story_id,
+            "characters": characters,
+            "scene": scene,
+            "style": style,
+            "seed": seed
+        }
+        
         # Generate workflow
-        workflow = generate_workflow(characters, scene, style)
+        workflow = generate_workflow(characters, scene, style, seed)
+        key = workflow_key(workflow)
+        
+        # Identical workflows render identical images, so reuse a stored one
+        cached = cached_image(key, data.get('vary_seed'))
+        if cached is not None:
+            GENERATION_TIME.observe(time.time() - start_time)
+            return jsonify(dict(result, **cached, cached=True))
+        
+        if not comfyui_pool.ready():
+            GENERATION_ERRORS.inc()
+            return comfyui_unavailable()
+        
+        if data.get('progressive'):
+            return progressive_render(result, preview_workflow(characters, scene, style, seed), workflow, key, start_time)
         
         # Submit workflow to ComfyUI
-        response = requests.post(
-            f"{COMFYUI_API}/prompt",
-            json={"prompt": workflow}
-        )
+        try:
+            prompt_id = submit_workflow(workflow, key)
+        except ComfyUIError as e:
+            GENERATION_ERRORS.inc()
+            return jsonify({"error": str(e)}), 500
+        
+        # Without waiting, the caller follows progress at the returned URL
+        if not data.get('wait', True):
+            if progress_records.enabled:
+                threading.Thread(target=share_progress, args=(prompt_id,), daemon=True).start()
+            return jsonify({
+                "status": "queued",
+                "prompt_id": prompt_id,
+                "progress_url": f"/api/progress/{prompt_id}",
+                "story_id": story_id,
+                "seed": seed
+            }), 202
         
-        if response.status_code != 200:
-            logger.error(f"ComfyUI API error: {response.text}")
+        # Wait for the websocket listener to report the prompt finished
+        state = comfyui_pool.wait(prompt_id, GENERATION_TIMEOUT)
+        if state.status == 'failed':
             GENERATION_ERRORS.inc()
-            return jsonify({"error": "Failed to submit workflow to ComfyUI"}), 500
-        
-        prompt_id = response.json().get('prompt_id')
-        
-        # Poll for completion (in a real implementation, this would be async)
-        # This is simplified for demonstration purposes
-        max_retries = 30
-        for i in range(max_retries):
-            time.sleep(1)
-            history_response = requests.get(f"{COMFYUI_API}/history/{prompt_id}")
-            if history_response.status_code == 200:
-                history = history_response.json()
-                if prompt_id in history:
-                    if 'outputs' in history[prompt_id]:
-                        # Get the image path
-                        for node_id, output in history[prompt_id]['outputs'].items():
-                            if 'images' in output:
-                                image_data = output['images'][0]
-                                image_path = f"/app/ComfyUI/output/{image_data['filename']}"
-                                
-                                # In a real implementation, we would upload to S3 here
-                                # For now, we'll just return the local path
-                                image_url = f"local://{image_path}"
-                                
-                                GENERATION_TIME.observe(time.time() - start_time)
-                                return jsonify({
-                                    "status": "success",
-                                    "image_url": image_url,
-                                    "story_id": story_id,
-                                    "characters": characters,
-                                    "scene": scene,
-                                    "style": style
-                                })
-        
-        # If we get here, generation timed out
-        GENERATION_ERRORS.inc()
-        return jsonify({"error": "Image generation timed out"}), 500
+            return jsonify({"error": f"Image generation failed: {state.error}"}), 500
+        
+        image = prompt_image(state)
+        if image is None:
+            GENERATION_ERRORS.inc()
+            return jsonify({"error": prompt_error(state), "prompt_id": prompt_id}), 500 if state.status == 'completed' else 504
+        
+        GENERATION_TIME.observe(time.time() - start_time)
+        return jsonify(dict(result, **image, cached=False))
         
     except Exception as e:
         logger.exception("Error generating image")
         GENERATION_ERRORS.inc()
         return jsonify({"error": str(e)}), 500
 
+# Illustrate every page of a story in one request. All page workflows are
+# queued in ComfyUI up front, so the GPU works through them back to back with
+# the checkpoint kept loaded, and each image is streamed back as an NDJSON line
+# as soon as it finishes. In progressive mode every page's preview is queued
+# ahead of the full renders and streamed first, with stage "preview"; the
+# full render of each page follows with stage "final".
+@app.route('/api/generate/story', methods=['POST'])
+def generate_story_images():
+    STORY_REQUESTS.inc()
+    start_time = time.time()
+    
+    data = request.json
+    if not data:
+        return jsonify({"error": "No data provided"}), 400
+    
+    pages = data.get('pages', [])
+    characters = data.get('characters', [])
+    style = data.get('style', 'cartoon')
+    story_id = data.get('story_id', str(uuid.uuid4()))
+    
+    if not pages:
+        return jsonify({"error": "No pages provided"}), 400
+    if not isinstance(pages, list) or not all(isinstance(page, dict) for page in pages):
+        return jsonify({"error": "pages must be a list of objects"}), 400
+    if len(pages) > MAX_STORY_PAGES:
+        return jsonify({"error": f"At most {MAX_STORY_PAGES} pages per request"}), 400
+    if any(not (page.get('characters') or characters) for page in pages):
+        return jsonify({"error": "No characters provided"}), 400
+    try:
+        seeds = [request_seed(data) for _ in pages]
+    except (TypeError, ValueError):
+        return jsonify({"error": "seed must be an integer"}), 400
+    
+    cached = []
+    uncached = []
+    for index, (page, seed) in enumerate(zip(pages, seeds)):
+        page_number = page.get('page_number', index + 1)
+        page_characters = page.get('characters') or characters
+        scene = page.get('scene_description', '')
+        workflow = generate_workflow(page_characters, scene, style, seed)
+        key = workflow_key(workflow)
+        image = cached_image(key, data.get('vary_seed'))
+        if image is not None:
+            cached.append(dict(image, page_number=page_number, status="success", seed=seed, cached=True, stage="final"))
+        else:
+            uncached.append((page_number, seed, workflow, key, page_characters, scene))
+    
+    queued = [(page_number, seed, workflow, key, "final") for page_number, seed, workflow, key, _, _ in uncached]
+    if data.get('progressive'):
+        previews = []
+        for page_number, seed, _, _, page_characters, scene in uncached:
+            preview = preview_workflow(page_characters, scene, style, seed)
+            previews.append((page_number, seed, preview, workflow_key(preview), "preview"))
+        queued = previews + queued
+    
+    if uncached and not comfyui_pool.ready():
+        return comfyui_unavailable()
+    
+    # Submit every uncached page before waiting on any of them
+    submitted = {}
+    failed = []
+    for page_number, seed, workflow, key, stage in queued:
+        try:
+            prompt_id = submit_workflow(workflow, key)
+        except ComfyUIError as e:
+            GENERATION_ERRORS.inc()
+            failed.append({"page_number": page_number, "status": "error", "error": str(e), "stage": stage})
+            continue
+        submitted[prompt_id] = (page_number, seed, stage)
+    
+    if failed and not (submitted or cached):
+        return jsonify({"error": "Failed to submit workflows to ComfyUI"}), 500
+    
+    def stream():
+        completed = len(cached)
+        finals = set()
+        for page in cached + failed:
+            yield json.dumps(page) + "\n"
+        
+        for state in comfyui_pool.as_completed(list(submitted), GENERATION_TIMEOUT * len(submitted)):
+            page_number, seed, stage = submitted[state.prompt_id]
+            # A preview that lands after its page's final image is stale
+            if stage == "preview" and page_number in finals:
+                continue
+            page = {"page_number": page_number, "prompt_id": state.prompt_id, "seed": seed, "stage": stage}
+            image = prompt_image(state)
+            if image:
+                if stage == "final":
+                    completed += 1
+                    finals.add(page_number)
+                page.update(image, status="success", cached=False)
+            else:
+                GENERATION_ERRORS.inc()
+                page.update(status="error", error=prompt_error(state))
+            yield json.dumps(page) + "\n"
+        
+        STORY_GENERATION_TIME.observe(time.time() - start_time)
+        yield json.dumps({
+            "status": "done",
+            "story_id": story_id,
+            "pages": len(pages),
+            "completed": completed,
+            "style": style
+        }) + "\n"
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='application/x-ndjson',
+        headers={"X-Story-Id": story_id}
+    )
+
 if __name__ == '__main__':
     # Start metrics server in a separate thread
     metrics_thread = threading.Thread(target=start_metrics_server, daemon=True)
     metrics_thread.start()
     
-    # Start ComfyUI in a separate thread
-    comfyui_thread = threading.Thread(target=start_comfyui, daemon=True)
-    comfyui_thread.start()
+    # Start the ComfyUI backends, their websocket listeners and queue tracking
+    comfyui_pool.start()
     
     # Start Flask app
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,136 @@
+import time
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+# Runs ComfyUI and tracks whether it can take work. On each (re)start it polls
+# until the API answers, then renders a tiny warmup workflow so the checkpoint
+# is loaded before real traffic arrives, and only then reports ready. After
+# that it watches the process and the API: if the process exits or stops
+# answering, it is restarted. With command=None ComfyUI is managed elsewhere and
+# only the readiness checks and warmup run.
+class ComfyUISupervisor:
+    def __init__(self, client, listener, warmup_workflow, command=None, startup_timeout=300,
+                 warmup_timeout=600, check_interval=10, max_failed_checks=3, restart_delay=5,
+                 on_change=None):
+        self.client = client
+        self.listener = listener
+        self.warmup_workflow = warmup_workflow
+        self.command = command
+        self.startup_timeout = startup_timeout
+        self.warmup_timeout = warmup_timeout
+        self.check_interval = check_interval
+        self.max_failed_checks = max_failed_checks
+        self.restart_delay = restart_delay
+        self.on_change = on_change or (lambda status: None)
+        self.process = None
+        self.status = 'stopped'
+        self.restarts = 0
+        self.last_error = None
+        self.ready_since = None
+        self.ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "ready": self.ready.is_set(),
+            "managed": self.command is not None,
+            "pid": self.process.pid if self.process else None,
+            "restarts": self.restarts,
+            "ready_since": self.ready_since,
+            "last_error": self.last_error
+        }
+
+    def _set_status(self, status):
+        self.status = status
+        if status == 'ready':
+            self.ready_since = time.time()
+            self.ready.set()
+        else:
+            self.ready_since = None
+            self.ready.clear()
+        logger.info(f"ComfyUI {status}")
+        self.on_change(status)
+
+    def _run(self):
+        while True:
+            try:
+                self._set_status('starting')
+                if self.command:
+                    self.process = subprocess.Popen(self.command)
+
+                if self._wait_responsive() and self._warmup():
+                    self._set_status('ready')
+                    self._monitor()
+            except Exception as e:
+                logger.exception("ComfyUI supervisor error")
+                self.last_error = str(e)
+
+            self._set_status('restarting' if self.command else 'unavailable')
+            self.restarts += 1
+            self._stop_process()
+            time.sleep(self.restart_delay)
+
+    def _alive(self):
+        return self.process is None or self.process.poll() is None
+
+    def _wait_responsive(self):
+        deadline = time.time() + self.startup_timeout
+        while time.time() < deadline:
+            if not self._alive():
+                self.last_error = f"ComfyUI exited with code {self.process.returncode} during startup"
+                logger.error(self.last_error)
+                return False
+            if self.client.responsive():
+                return True
+            time.sleep(1)
+        self.last_error = f"ComfyUI did not respond within {self.startup_timeout}s"
+        logger.error(self.last_error)
+        return False
+
+    # Render the warmup workflow; it loads the checkpoint into GPU memory
+    def _warmup(self):
+        self._set_status('warming_up')
+        start_time = time.time()
+        prompt_id = self.client.submit(self.warmup_workflow)
+        state = self.listener.wait(prompt_id, self.warmup_timeout)
+        if state.status != 'completed':
+            self.last_error = f"Warmup prompt {state.status}: {state.error or 'timed out'}"
+            logger.error(self.last_error)
+            return False
+        logger.info(f"ComfyUI warmup finished in {time.time() - start_time:.1f}s")
+        return True
+
+    # Return once the process has exited or the API stopped answering
+    def _monitor(self):
+        failed_checks = 0
+        while True:
+            time.sleep(self.check_interval)
+            if not self._alive():
+                self.last_error = f"ComfyUI exited with code {self.process.returncode}"
+                logger.error(self.last_error)
+                return
+            if self.client.responsive():
+                failed_checks = 0
+                continue
+            failed_checks += 1
+            if failed_checks >= self.max_failed_checks:
+                self.last_error = f"ComfyUI unresponsive for {failed_checks} checks"
+                logger.error(self.last_error)
+                return
+
+    def _stop_process(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
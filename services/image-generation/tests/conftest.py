@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# Service modules import each other by name, as they do when run from src/;
+# the stub ComfyUI server lives in scripts/
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+sys.path.insert(0, os.path.join(here, '..', 'scripts'))
+
+import stub_comfyui  # noqa: E402
+
+
+# Start a stub ComfyUI server; yields (stub, base_url)
+@pytest.fixture
+def comfyui_stub():
+    servers = []
+
+    def start(step_time=0.01):
+        stub, server = stub_comfyui.serve(step_time=step_time)
+        servers.append(server)
+        return stub, f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
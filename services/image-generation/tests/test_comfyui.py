@@ -0,0 +1,103 @@
+import json
+import time
+
+from comfyui import ComfyUIClient, ComfyEventListener, find_images
+
+
+# Sampler plus SaveImage, enough for the stub to render one image
+def workflow(steps=3):
+    return {
+        "1": {"class_type": "EmptyLatentImage", "inputs": {"width": 64, "height": 64, "batch_size": 1}},
+        "2": {"class_type": "KSampler", "inputs": {"steps": steps}},
+        "3": {"class_type": "SaveImage", "inputs": {"filename_prefix": "test"}},
+    }
+
+def failing_workflow(message):
+    return {
+        "1": {"class_type": "KSampler", "inputs": {"steps": 2}},
+        "2": {"class_type": "StubError", "inputs": {"message": message}},
+    }
+
+def connected_listener(base_url, **options):
+    listener = ComfyEventListener(ComfyUIClient(base_url), **options)
+    listener.start()
+    deadline = time.time() + 5
+    while not listener.connected and time.time() < deadline:
+        time.sleep(0.01)
+    assert listener.connected
+    return listener
+
+def event(kind, **data):
+    return json.dumps({"type": kind, "data": data})
+
+
+def test_null_executing_after_error_keeps_prompt_failed():
+    listener = ComfyEventListener(ComfyUIClient('http://127.0.0.1:1'))
+    listener._on_message(None, event('execution_start', prompt_id='p'))
+    listener._on_message(None, event('execution_error', prompt_id='p', exception_message='CUDA out of memory'))
+    listener._on_message(None, event('executing', prompt_id='p', node=None))
+    state = listener.get('p')
+    assert (state.status, state.error) == ('failed', 'CUDA out of memory')
+
+def test_null_executing_after_interrupt_keeps_prompt_failed():
+    listener = ComfyEventListener(ComfyUIClient('http://127.0.0.1:1'))
+    listener._on_message(None, event('execution_interrupted', prompt_id='p'))
+    listener._on_message(None, event('executing', prompt_id='p', node=None))
+    assert (listener.get('p').status, listener.get('p').error) == ('failed', 'execution_interrupted')
+
+def test_finish_keeps_first_outcome():
+    listener = ComfyEventListener(ComfyUIClient('http://127.0.0.1:1'))
+    state = listener.track('p')
+    state.finish('completed', outputs={"9": {"images": []}})
+    state.finish('failed', error='late')
+    assert (state.status, state.error, state.outputs) == ('completed', None, {"9": {"images": []}})
+
+def test_listener_completes_prompt_with_outputs(comfyui_stub):
+    _, base_url = comfyui_stub()
+    listener = connected_listener(base_url)
+    prompt_id = listener.client.submit(workflow())
+    state = listener.wait(prompt_id, 5)
+    assert state.status == 'completed'
+    assert state.to_dict()["progress"] == 1.0
+    images = find_images(state.outputs)
+    assert len(images) == 1
+    assert listener.client.view(images[0]).startswith(b'\x89PNG')
+
+def test_listener_reports_execution_error(comfyui_stub):
+    _, base_url = comfyui_stub()
+    listener = connected_listener(base_url)
+    prompt_id = listener.client.submit(failing_workflow('CUDA out of memory'))
+    state = listener.wait(prompt_id, 5)
+    assert (state.status, state.error) == ('failed', 'CUDA out of memory')
+    # The trailing null "executing" event has been processed by now too
+    time.sleep(0.1)
+    assert (state.status, state.error) == ('failed', 'CUDA out of memory')
+
+def test_history_resolves_prompts_finished_while_disconnected(comfyui_stub):
+    stub, base_url = comfyui_stub()
+    client = ComfyUIClient(base_url)
+    listener = ComfyEventListener(client, history_interval=0.05)
+    ok, failed = client.submit(workflow(1)), client.submit(failing_workflow('boom'))
+    assert listener.wait(ok, 5).status == 'completed'
+    assert find_images(listener.get(ok).outputs)
+    assert listener.wait(failed, 5).status == 'failed'
+
+def test_as_completed_yields_in_finish_order(comfyui_stub):
+    _, base_url = comfyui_stub()
+    listener = connected_listener(base_url)
+    slow, fast = listener.client.submit(workflow(20)), listener.client.submit(workflow(1))
+    # The stub runs one prompt at a time, so submission order is finish order
+    states = list(listener.as_completed([fast, slow], 5))
+    assert [state.prompt_id for state in states] == [slow, fast]
+    assert all(state.status == 'completed' for state in states)
+
+def test_as_completed_yields_unfinished_prompts_at_timeout(comfyui_stub):
+    _, base_url = comfyui_stub(step_time=0.05)
+    listener = connected_listener(base_url)
+    fast, slow = listener.client.submit(workflow(1)), listener.client.submit(workflow(100))
+    start = time.time()
+    states = list(listener.as_completed([slow, fast], 1))
+    assert time.time() - start < 2
+    assert [state.prompt_id for state in states] == [fast, slow]
+    assert states[0].status == 'completed'
+    assert not states[1].done.is_set()
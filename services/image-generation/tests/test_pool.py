@@ -0,0 +1,96 @@
+import socket
+import time
+
+import pytest
+
+from comfyui import ComfyUIError, find_images
+from pool import ComfyUIPool, parse_backends
+from test_comfyui import workflow, failing_workflow
+
+
+def start_pool(urls, ready_count=None):
+    pool = ComfyUIPool(urls, workflow(1), history_interval=0.05, queue_poll_interval=0.05,
+                       check_interval=0.1, restart_delay=0.1, startup_timeout=2)
+    pool.start()
+    ready_count = len(urls) if ready_count is None else ready_count
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        backends = [b for b in pool.backends if b.supervisor.ready.is_set() and b.listener.connected]
+        if len(backends) >= ready_count:
+            break
+        time.sleep(0.02)
+    assert len(backends) == ready_count
+    # Let the warmup prompts' queue reports settle
+    time.sleep(0.2)
+    return pool
+
+def backend_of(pool, prompt_id):
+    return next(b.url for b in pool.backends if b.listener.get(prompt_id) is not None)
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def test_parse_backends():
+    assert parse_backends(' http://a:8188/, ,http://b:8188 ') == ['http://a:8188', 'http://b:8188']
+
+def test_idle_backends_take_turns(comfyui_stub):
+    urls = [comfyui_stub()[1], comfyui_stub()[1]]
+    pool = start_pool(urls)
+    chosen = [pool.choose().url for _ in range(4)]
+    assert sorted(chosen[:2]) == sorted(urls)
+    assert chosen[2:] == chosen[:2]
+
+def test_submit_routes_to_least_loaded_backend(comfyui_stub):
+    urls = [comfyui_stub()[1], comfyui_stub()[1]]
+    pool = start_pool(urls)
+    first = pool.submit(workflow(200))
+    busy = backend_of(pool, first)
+    # Each new prompt goes to the idle backend while the first one runs
+    for _ in range(3):
+        prompt_id = pool.submit(workflow(1))
+        assert backend_of(pool, prompt_id) != busy
+        state = pool.wait(prompt_id, 5)
+        assert state.status == 'completed' and find_images(state.outputs)
+    assert pool.get(first).status == 'running'
+
+def test_as_completed_across_backends(comfyui_stub):
+    pool = start_pool([comfyui_stub()[1], comfyui_stub()[1]])
+    slow = pool.submit(workflow(30))
+    fast = pool.submit(workflow(1))
+    assert backend_of(pool, slow) != backend_of(pool, fast)
+    states = list(pool.as_completed([slow, fast], 5))
+    assert [state.prompt_id for state in states] == [fast, slow]
+    assert pool.view(fast, find_images(states[0].outputs)[0]).startswith(b'\x89PNG')
+
+def test_as_completed_timeout_yields_unfinished_last(comfyui_stub):
+    pool = start_pool([comfyui_stub(step_time=0.05)[1], comfyui_stub(step_time=0.05)[1]])
+    slow = pool.submit(workflow(100))
+    fast = pool.submit(workflow(1))
+    states = list(pool.as_completed([slow, fast], 1))
+    assert [state.prompt_id for state in states] == [fast, slow]
+    assert not states[1].done.is_set()
+
+def test_failed_prompt_is_reported_failed(comfyui_stub):
+    pool = start_pool([comfyui_stub()[1]])
+    prompt_id = pool.submit(failing_workflow('CUDA out of memory'))
+    state = pool.wait(prompt_id, 5)
+    time.sleep(0.1)
+    assert (state.status, state.error) == ('failed', 'CUDA out of memory')
+
+def test_down_backend_is_skipped(comfyui_stub):
+    live = comfyui_stub()[1]
+    pool = start_pool([unused_url(), live], ready_count=1)
+    assert pool.ready()
+    prompt_ids = [pool.submit(workflow(1)) for _ in range(3)]
+    assert all(backend_of(pool, prompt_id) == live for prompt_id in prompt_ids)
+    assert [state.status for state in pool.as_completed(prompt_ids, 5)] == ['completed'] * 3
+
+def test_no_ready_backend():
+    pool = ComfyUIPool([unused_url()], workflow(1), startup_timeout=1)
+    with pytest.raises(ComfyUIError):
+        pool.choose()
+    with pytest.raises(ComfyUIError):
+        pool.wait('unknown', 0)
@@ -0,0 +1,145 @@
+import sys
+import math
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Load benchmark for the text generation service. Drives /api/generate (or the
+# streaming endpoint) at a fixed concurrency and reports latency percentiles
+# and throughput. Run it against a server started with TEXTGEN_BACKEND=stub to
+# measure the serving stack without calling the model, e.g.
+#
+#   TEXTGEN_BACKEND=stub STUB_LATENCY_MEDIAN=0.5 python src/server.py &
+#   python scripts/benchmark.py --concurrency 32 --requests 500
+#
+# Requests are sent with "fresh": true so the story cache and inventory do not
+# absorb them; pass --cached to measure the cache-hit path instead.
+
+DEFAULT_STORY = {
+    "characters": ["Spider-Man", "Elsa"],
+    "theme": "adventure",
+    "moral_lesson": "friendship",
+    "age_group": "6-8",
+    "length": "bedtime-short"
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the text generation service")
+    parser.add_argument('--url', default='http://localhost:8080', help="service base URL")
+    parser.add_argument('--concurrency', type=int, default=16, help="requests in flight at once")
+    parser.add_argument('--requests', type=int, default=200, help="total requests to send")
+    parser.add_argument('--stream', action='store_true', help="use /api/generate/stream")
+    parser.add_argument('--mode', default='single', choices=['single', 'outline'], help="generation_mode to request")
+    parser.add_argument('--cached', action='store_true', help="allow cache and inventory hits")
+    parser.add_argument('--timeout', type=float, default=300, help="per-request timeout in seconds")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    return parser.parse_args()
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values, p):
+    if not values:
+        return None
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.local = threading.local()
+        endpoint = '/api/generate/stream' if args.stream else '/api/generate'
+        self.url = args.url.rstrip('/') + endpoint
+        self.payload = dict(DEFAULT_STORY, fresh=not args.cached, generation_mode=args.mode)
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    # Send one request, returning its timings and outcome
+    def send(self, _):
+        started = time.perf_counter()
+        first_page = None
+        try:
+            response = self.session().post(self.url, json=self.payload, timeout=self.args.timeout, stream=self.args.stream)
+            if self.args.stream and response.status_code == 200:
+                ok = False
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event["event"] == "page" and first_page is None:
+                        first_page = time.perf_counter() - started
+                    elif event["event"] == "done":
+                        ok = True
+                    elif event["event"] == "error":
+                        break
+                status = 200 if ok else 'stream-error'
+            else:
+                # Read the whole body so latency covers the full response
+                response.content
+                status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+
+        return {"status": status, "latency": time.perf_counter() - started, "first_page": first_page}
+
+    def run(self):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            results = list(executor.map(self.send, range(self.args.requests)))
+        return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed, args):
+    succeeded = sorted(r["latency"] for r in results if r["status"] == 200)
+    first_pages = sorted(r["first_page"] for r in results if r["first_page"] is not None)
+
+    statuses = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+
+    report = {
+        "requests": len(results),
+        "concurrency": args.concurrency,
+        "succeeded": len(succeeded),
+        "statuses": statuses,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(succeeded) / elapsed, 2) if elapsed > 0 else None,
+        "latency_seconds": {
+            f"p{p}": round(percentile(succeeded, p), 4) if succeeded else None for p in (50, 95, 99)
+        }
+    }
+    if first_pages:
+        report["first_page_seconds"] = {f"p{p}": round(percentile(first_pages, p), 4) for p in (50, 95, 99)}
+    return report
+
+
+def print_report(report):
+    print(f"requests:    {report['requests']} at concurrency {report['concurrency']}")
+    print(f"succeeded:   {report['succeeded']}  statuses: {report['statuses']}")
+    print(f"elapsed:     {report['elapsed_seconds']}s  throughput: {report['throughput_rps']} req/s")
+    latency = report["latency_seconds"]
+    print(f"latency:     p50={latency['p50']}s  p95={latency['p95']}s  p99={latency['p99']}s")
+    if "first_page_seconds" in report:
+        first_page = report["first_page_seconds"]
+        print(f"first page:  p50={first_page['p50']}s  p95={first_page['p95']}s  p99={first_page['p99']}s")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results, elapsed = Benchmark(args).run()
+    report = summarize(results, elapsed, args)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    # Non-zero exit when nothing succeeded, so CI notices a broken stack
+    sys.exit(0 if report["succeeded"] else 1)
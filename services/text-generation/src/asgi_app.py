@@ -0,0 +1,350 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+import anthropic
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from server import (
+    ANTHROPIC_API_KEY, TEXTGEN_BACKEND, STUB_SETTINGS, MODEL_NAME, GENERATION_REQUESTS, GENERATION_ERRORS, GENERATION_TIME,
+    COALESCED_REQUESTS, UPSTREAM_CONCURRENCY, UPSTREAM_QUEUE_SIZE, UPSTREAM_QUEUE_TIMEOUT,
+    UPSTREAM_RETRY_AFTER, InvalidRequest, StoryParseError, story_cache, single_flight,
+    OUTLINE_MAX_TOKENS, OUTLINE_MAX_PARALLEL, PAGE_BATCH_MAX_TOKENS, MAX_TOKENS,
+    PARSE_FAILURES, TIME_TO_FIRST_TOKEN, resolve_story_params, resolve_batch, batch_item_event,
+    build_message_request, build_result, story_from_parser, page_batches, merge_outline_pages,
+    record_usage, metric_labels, observe_stage, timed_stage, parse_output,
+    metadata_event, get_ready_story, replay_story, inventory, cache_key, start_metrics_server,
+    CHARACTER_SERVICE_URL, CHARACTER_REFRESH_INTERVAL
+)
+from story_stream import StoryStreamParser
+from prompts import character_snapshot, build_prompt, build_outline_prompt, build_pages_prompt
+from singleflight import AsyncSingleFlight
+from concurrency import AsyncUpstreamLimiter, UpstreamBusy
+from backends import AsyncAnthropicBackend, AsyncStubBackend
+
+# Async serving mode for text generation. Requests are handled on an event loop
+# with AsyncAnthropic, so an in-flight generation costs a coroutine rather than
+# a parked worker thread. Prompt building, parsing and caching are shared with
+# the Flask app in server.py.
+
+logger = logging.getLogger(__name__)
+
+# Shared connection pool for upstream calls
+UPSTREAM_KEEPALIVE = int(os.environ.get('UPSTREAM_KEEPALIVE', 32))
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', 120))
+
+if TEXTGEN_BACKEND == 'stub':
+    async_backend = AsyncStubBackend(**STUB_SETTINGS)
+elif ANTHROPIC_API_KEY:
+    async_backend = AsyncAnthropicBackend(anthropic.AsyncAnthropic(
+        api_key=ANTHROPIC_API_KEY,
+        http_client=anthropic.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_CONCURRENCY,
+                max_keepalive_connections=UPSTREAM_KEEPALIVE
+            ),
+            timeout=UPSTREAM_TIMEOUT
+        )
+    ))
+else:
+    async_backend = None
+
+upstream_limiter = AsyncUpstreamLimiter(
+    max_concurrency=UPSTREAM_CONCURRENCY,
+    max_queue=UPSTREAM_QUEUE_SIZE,
+    queue_timeout=UPSTREAM_QUEUE_TIMEOUT,
+    retry_after=UPSTREAM_RETRY_AFTER
+)
+async_single_flight = AsyncSingleFlight(single_flight)
+
+# Error response for a rejected upstream slot
+def busy_response(e):
+    return JSONResponse({"error": e.message}, status_code=e.status_code, headers={"Retry-After": str(e.retry_after)})
+
+# Read the JSON body, treating an unparseable body like an empty one
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+# Async version of server.call_model
+async def call_model(params, call, build, max_tokens=MAX_TOKENS):
+    with timed_stage('prompt_build', params):
+        prompt = build()
+
+    queued_at = time.perf_counter()
+    async with upstream_limiter.slot():
+        observe_stage('queue_wait', params, time.perf_counter() - queued_at)
+        with timed_stage('upstream', params):
+            completion = await async_backend.create(build_message_request(prompt, max_tokens))
+
+    record_usage(completion.usage, params)
+    return parse_output(completion.text, params, call)
+
+# Generate a complete story with the async model backend
+async def generate_story(params):
+    if params.get("mode") == 'outline':
+        async for event in stream_outlined_story(params):
+            if event["event"] == "done":
+                return event["story"]
+    return await call_model(params, 'story', lambda: build_prompt(params))
+
+# Async version of server.stream_outlined_story
+async def stream_outlined_story(params):
+    outline = await call_model(params, 'outline', lambda: build_outline_prompt(params), OUTLINE_MAX_TOKENS)
+    batches = page_batches(outline)
+    if not batches:
+        raise StoryParseError("Failed to parse generated story: empty outline")
+
+    yield {"event": "title", "title": outline.get("title")}
+
+    parallel = asyncio.Semaphore(OUTLINE_MAX_PARALLEL)
+
+    async def write_batch(batch):
+        async with parallel:
+            written = await call_model(params, 'pages', lambda: build_pages_prompt(params, outline, batch), PAGE_BATCH_MAX_TOKENS)
+        try:
+            return merge_outline_pages(batch, written)
+        except StoryParseError:
+            PARSE_FAILURES.labels(call='pages', **metric_labels(params)).inc()
+            raise
+
+    tasks = [asyncio.ensure_future(write_batch(batch)) for batch in batches]
+    pages = []
+    try:
+        for task in tasks:
+            for page in await task:
+                pages.append(page)
+                yield {"event": "page", "page": page}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    yield {"event": "done", "story": {"title": outline.get("title"), "pages": pages}}
+
+# Async version of server.get_story
+async def get_story(params):
+    story_data = await asyncio.to_thread(get_ready_story, params)
+    if story_data is not None:
+        return story_data
+
+    if params["fresh"]:
+        story_data = await generate_story(params)
+    else:
+        key = cache_key(params, MODEL_NAME)
+
+        async def generate_once():
+            # Another flight may have filled the cache while we waited to lead
+            cached, _ = await asyncio.to_thread(story_cache.get, key)
+            return cached if cached is not None else await generate_story(params)
+
+        story_data, shared = await async_single_flight.do(key, generate_once)
+        if shared:
+            COALESCED_REQUESTS.inc()
+
+    await asyncio.to_thread(story_cache.set, cache_key(params, MODEL_NAME), story_data)
+    return story_data
+
+# Stream a story from the async model backend. The caller must hold an upstream slot.
+async def stream_story(params):
+    with timed_stage('prompt_build', params):
+        prompt = build_prompt(params)
+
+    parser = StoryStreamParser()
+    with timed_stage('upstream', params):
+        opened_at = time.perf_counter()
+        async with async_backend.stream(build_message_request(prompt)) as stream:
+            async for text in stream.text_stream:
+                if opened_at is not None:
+                    TIME_TO_FIRST_TOKEN.labels(**metric_labels(params)).observe(time.perf_counter() - opened_at)
+                    opened_at = None
+                for event in parser.feed(text):
+                    yield event
+        record_usage(stream.usage, params)
+
+    story_data, complete = story_from_parser(parser, params)
+    yield {"event": "done", "story": story_data, "complete": complete}
+
+async def replay_story_async(story_data):
+    for event in replay_story(story_data):
+        yield event
+
+# Health check endpoint
+async def health_check(request):
+    return JSONResponse({"status": "ok"})
+
+# Text generation endpoint
+async def generate_text(request):
+    GENERATION_REQUESTS.inc()
+    start_time = time.time()
+
+    try:
+        params = resolve_story_params(await read_json(request))
+        story_data = await get_story(params)
+
+        return JSONResponse(build_result(params, story_data))
+
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        return JSONResponse({"error": e.message}, status_code=e.status_code)
+    except UpstreamBusy as e:
+        GENERATION_ERRORS.inc()
+        return busy_response(e)
+    except StoryParseError as e:
+        logger.exception("Error parsing generated story")
+        GENERATION_ERRORS.inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+    except Exception as e:
+        logger.exception("Error generating text")
+        GENERATION_ERRORS.inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+    finally:
+        GENERATION_TIME.observe(time.time() - start_time)
+
+# Streaming text generation endpoint (NDJSON, one event per line)
+async def generate_text_stream(request):
+    GENERATION_REQUESTS.inc()
+    start_time = time.time()
+
+    try:
+        params = resolve_story_params(await read_json(request))
+        story_data = await asyncio.to_thread(get_ready_story, params)
+        # Outline mode takes a slot per upstream call instead of one for the stream
+        holds_slot = story_data is None and params["mode"] != 'outline'
+        if holds_slot:
+            with timed_stage('queue_wait', params):
+                await upstream_limiter.acquire()
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        GENERATION_TIME.observe(time.time() - start_time)
+        return JSONResponse({"error": e.message}, status_code=e.status_code)
+    except UpstreamBusy as e:
+        GENERATION_ERRORS.inc()
+        GENERATION_TIME.observe(time.time() - start_time)
+        return busy_response(e)
+
+    async def events():
+        try:
+            yield json.dumps(metadata_event(params)) + "\n"
+
+            if story_data is not None:
+                story_events = replay_story_async(story_data)
+            elif params["mode"] == 'outline':
+                story_events = stream_outlined_story(params)
+            else:
+                story_events = stream_story(params)
+
+            async for event in story_events:
+                if event["event"] == "done":
+                    complete = event.get("complete", True)
+                    # A truncated story is returned but never cached as if it were whole
+                    if story_data is None and complete:
+                        await asyncio.to_thread(story_cache.set, cache_key(params, MODEL_NAME), event["story"])
+                    event = {"event": "done", **build_result(params, event["story"])}
+                    if not complete:
+                        event["partial"] = True
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            logger.exception("Error streaming text")
+            GENERATION_ERRORS.inc()
+            yield json.dumps({"event": "error", "error": str(e)}) + "\n"
+        finally:
+            GENERATION_TIME.observe(time.time() - start_time)
+            if holds_slot:
+                upstream_limiter.release()
+
+    return StreamingResponse(events(), media_type='application/x-ndjson')
+
+# Batch text generation endpoint. Streams one NDJSON event per story as each
+# finishes; failed items are reported without failing the batch.
+async def generate_text_batch(request):
+    GENERATION_REQUESTS.inc()
+    start_time = time.time()
+
+    try:
+        stories, concurrency = resolve_batch(await read_json(request))
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        GENERATION_TIME.observe(time.time() - start_time)
+        return JSONResponse({"error": e.message}, status_code=e.status_code)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate_item(index, spec):
+        async with semaphore:
+            try:
+                params = resolve_story_params(spec)
+                return batch_item_event(index, params, await get_story(params))
+            except Exception as e:
+                if not isinstance(e, (InvalidRequest, UpstreamBusy)):
+                    logger.exception(f"Error generating batch item {index}")
+                return batch_item_event(index, error=e)
+
+    async def events():
+        tasks = [asyncio.ensure_future(generate_item(index, spec)) for index, spec in enumerate(stories)]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                event = await next_done
+                if event["event"] == "result":
+                    succeeded += 1
+                yield json.dumps(event) + "\n"
+
+            yield json.dumps({
+                "event": "done",
+                "total": len(stories),
+                "succeeded": succeeded,
+                "failed": len(stories) - succeeded,
+                "duration_seconds": round(time.time() - start_time, 3)
+            }) + "\n"
+        finally:
+            # Drop outstanding items if the client went away
+            for task in tasks:
+                task.cancel()
+            GENERATION_TIME.observe(time.time() - start_time)
+
+    return StreamingResponse(events(), media_type='application/x-ndjson')
+
+# Start background stock refills once the event loop is running. Refills
+# generate on this loop, so they share the async upstream limiter with requests.
+@asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    inventory.start(
+        lambda params: asyncio.run_coroutine_threadsafe(generate_story(params), loop).result(),
+        has_capacity=lambda: upstream_limiter.waiting == 0
+    )
+    yield
+
+app = Starlette(
+    lifespan=lifespan,
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/api/generate', generate_text, methods=['POST']),
+        Route('/api/generate/stream', generate_text_stream, methods=['POST']),
+        Route('/api/generate/batch', generate_text_batch, methods=['POST'])
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])]
+)
+
+if __name__ == '__main__':
+    # Start metrics server in a separate thread
+    metrics_thread = threading.Thread(target=start_metrics_server, daemon=True)
+    metrics_thread.start()
+
+    # Load the character catalog and keep it fresh in the background
+    character_snapshot.start(CHARACTER_SERVICE_URL, CHARACTER_REFRESH_INTERVAL)
+
+    # Start ASGI app
+    uvicorn.run(app, host='0.0.0.0', port=8080)
@@ -0,0 +1,203 @@
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager, asynccontextmanager
+
+# Model backends for text generation. Every backend takes a Messages API
+# request dict (see server.build_message_request) and exposes:
+#   create(request) -> Completion(text, usage)
+#   stream(request) -> context manager whose value has .text_stream and,
+#                      once the stream is exhausted, .usage
+# The async backends expose the same methods as coroutines / async context
+# managers for the ASGI serving mode.
+
+Completion = namedtuple('Completion', ['text', 'usage'])
+
+# Token usage in the shape of the Anthropic SDK's Usage object
+Usage = namedtuple('Usage', ['input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'])
+
+
+class AnthropicBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, request):
+        response = self.client.messages.create(**request)
+        return Completion(response.content[0].text, response.usage)
+
+    @contextmanager
+    def stream(self, request):
+        with self.client.messages.stream(**request) as stream:
+            yield _AnthropicStream(stream)
+
+
+class _AnthropicStream:
+    def __init__(self, stream):
+        self.stream = stream
+        self.text_stream = stream.text_stream
+
+    @property
+    def usage(self):
+        return self.stream.get_final_message().usage
+
+
+class AsyncAnthropicBackend:
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, request):
+        response = await self.client.messages.create(**request)
+        return Completion(response.content[0].text, response.usage)
+
+    @asynccontextmanager
+    async def stream(self, request):
+        async with self.client.messages.stream(**request) as stream:
+            result = _AsyncAnthropicStream(stream)
+            yield result
+            result.usage = (await stream.get_final_message()).usage
+
+
+class _AsyncAnthropicStream:
+    def __init__(self, stream):
+        self.text_stream = stream.text_stream
+        self.usage = None
+
+
+# Deterministic local stand-in for the model, for load tests and CI without
+# network access. Output content is derived from a hash of the request, so the
+# same request always produces the same story. Latency, token pacing and
+# malformed responses are drawn from one seeded random sequence, so a run with
+# the same seed and request order is reproducible.
+class StubBackend:
+    def __init__(self, latency_median=0.8, latency_sigma=0.35, tokens_per_second=150.0,
+                 malformed_rate=0.0, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    # Draw time-to-first-token and malformed flag for the next call
+    def _next_call(self):
+        with self.lock:
+            latency = self.random.lognormvariate(0, self.latency_sigma) * self.latency_median
+            malformed = self.random.random() < self.malformed_rate
+        return latency, malformed
+
+    def _respond(self, request):
+        text = render_stub_output(request)
+        latency, malformed = self._next_call()
+        if malformed:
+            # Cut the document short so no closing brace survives
+            text = text[:len(text) // 2].replace('}', '')
+        return text, latency, stub_usage(request, text)
+
+    def _token_delay(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+    # Split output into roughly token-sized chunks with the delay before each
+    def _chunks(self, text):
+        for i in range(0, len(text), 4):
+            yield text[i:i + 4], self._token_delay()
+
+    def create(self, request):
+        text, latency, usage = self._respond(request)
+        time.sleep(latency + usage.output_tokens * self._token_delay())
+        return Completion(text, usage)
+
+    @contextmanager
+    def stream(self, request):
+        text, latency, usage = self._respond(request)
+        yield _StubStream(self._paced(text, latency), usage)
+
+    def _paced(self, text, latency):
+        time.sleep(latency)
+        for chunk, delay in self._chunks(text):
+            time.sleep(delay)
+            yield chunk
+
+
+class _StubStream:
+    def __init__(self, text_stream, usage):
+        self.text_stream = text_stream
+        self.usage = usage
+
+
+class AsyncStubBackend(StubBackend):
+    async def create(self, request):
+        text, latency, usage = self._respond(request)
+        await asyncio.sleep(latency + usage.output_tokens * self._token_delay())
+        return Completion(text, usage)
+
+    @asynccontextmanager
+    async def stream(self, request):
+        text, latency, usage = self._respond(request)
+        yield _StubStream(self._apaced(text, latency), usage)
+
+    async def _apaced(self, text, latency):
+        await asyncio.sleep(latency)
+        for chunk, delay in self._chunks(text):
+            await asyncio.sleep(delay)
+            yield chunk
+
+
+def _request_text(request):
+    parts = [block.get("text", "") for block in request.get("system", [])]
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get("text", "") for block in content)
+    return "\n".join(parts)
+
+def stub_usage(request, text):
+    return Usage(
+        input_tokens=len(_request_text(request)) // 4,
+        output_tokens=len(text) // 4,
+        cache_read_input_tokens=0,
+        cache_creation_input_tokens=0
+    )
+
+# Build a plausible JSON response for a story, outline or page-batch request
+def render_stub_output(request):
+    prompt = _request_text(request)
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    rng = random.Random(digest)
+
+    characters_match = re.search(r'^Characters: (.+)$', prompt, re.MULTILINE)
+    characters = characters_match.group(1) if characters_match else "the friends"
+    words = ["brave", "bright", "curious", "gentle", "kind", "lucky", "quiet", "silly", "tiny", "wise"]
+    places = ["forest", "castle", "river", "meadow", "spaceship", "village", "mountain", "beach"]
+
+    def sentence():
+        return f"{characters} found a {rng.choice(words)} {rng.choice(places)} and learned something new."
+
+    pages_match = re.search(r'^Write pages ([\d, ]+),', prompt, re.MULTILINE)
+    if pages_match:
+        numbers = [int(n) for n in pages_match.group(1).split(',')]
+        document = {"pages": [
+            {"page_number": n, "text": " ".join(sentence() for _ in range(3)), "scene_description": sentence()}
+            for n in numbers
+        ]}
+        return json.dumps(document, indent=2)
+
+    count_match = re.search(r'divided into (\d+)', prompt)
+    page_count = int(count_match.group(1)) if count_match else 5
+    title = f"The {rng.choice(words).title()} {rng.choice(places).title()}"
+
+    if '"beat"' in prompt:
+        pages = [{"page_number": n, "beat": sentence(), "scene_description": sentence()} for n in range(1, page_count + 1)]
+    else:
+        pages = [
+            {"page_number": n, "text": " ".join(sentence() for _ in range(3)), "scene_description": sentence()}
+            for n in range(1, page_count + 1)
+        ]
+
+    return "Here is your story:\n" + json.dumps({"title": title, "pages": pages}, indent=2)
@@ -0,0 +1,140 @@
+import sys
+import time
+import logging
+import threading
+from typing import NamedTuple, Optional, Tuple
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+# Compact, immutable profile for one character. Strings shared between many
+# characters (universe names, common traits) are interned.
+class CharacterProfile(NamedTuple):
+    name: str
+    universe: str
+    description: Optional[str]
+    traits: Tuple[str, ...]
+    abilities: Tuple[str, ...]
+    friends: Tuple[str, ...]
+    speech_style: Optional[str]
+
+
+def _strings(values):
+    return tuple(sys.intern(str(value)) for value in values if value)
+
+# Profile from a hardcoded CHARACTER_INFO entry
+def profile_from_info(name, info):
+    return CharacterProfile(
+        name=name.title(),
+        universe=sys.intern(info['universe']),
+        description=None,
+        traits=_strings(info.get('traits', [])),
+        abilities=_strings(info.get('abilities', [])),
+        friends=_strings(info.get('friends', [])),
+        speech_style=info.get('speech_style')
+    )
+
+# Profiles keyed by lower-cased name from a character-database listing. Friends
+# are resolved by id against the same listing. Fields the catalog provides
+# override the fallback profile of the same name; the rest (e.g. speech_style,
+# which the catalog schema does not have) are kept.
+def profiles_from_catalog(characters, fallback=None):
+    names = {character.get('_id'): character.get('name') for character in characters}
+    profiles = {}
+    for character in characters:
+        name = (character.get('name') or '').strip()
+        if not name:
+            continue
+
+        universe = character.get('universe')
+        if isinstance(universe, dict):
+            universe = universe.get('name')
+
+        friends = [
+            names.get(relation.get('character'))
+            for relation in character.get('relationships') or []
+            if relation.get('relationshipType') == 'friend'
+        ]
+
+        provided = {
+            "universe": sys.intern(universe) if isinstance(universe, str) and universe else None,
+            "description": character.get('description') or None,
+            "traits": _strings(character.get('traits') or []),
+            "abilities": _strings(ability.get('name') for ability in character.get('abilities') or []),
+            "friends": _strings(friends)
+        }
+        provided = {field: value for field, value in provided.items() if value}
+
+        base = (fallback or {}).get(name.lower()) or CharacterProfile(
+            name=name, universe=sys.intern('an original story'), description=None,
+            traits=(), abilities=(), friends=(), speech_style=None
+        )
+        profiles[name.lower()] = base._replace(name=name, **provided)
+    return profiles
+
+
+# Local snapshot of the character catalog used for prompt building. The
+# snapshot is fetched from character-database at startup and refreshed in the
+# background with a conditional GET; a changed catalog is built into a new dict
+# and swapped in with a single assignment, so readers never see a partial
+# update and prompt building never waits on the network. Hardcoded profiles
+# cover characters the catalog does not have (or the whole catalog, until the
+# first successful fetch).
+class CharacterSnapshot:
+    def __init__(self, fallback):
+        self.fallback = {name.lower(): profile_from_info(name, info) for name, info in fallback.items()}
+        self.profiles = dict(self.fallback)
+        self.etag = None
+        self.loaded_at = None
+        self.url = None
+        self.timeout = 10
+
+    def get(self, name):
+        return self.profiles.get(str(name).strip().lower())
+
+    # Universe per character name, for inventory seeding
+    def universes(self):
+        return {name: profile.universe for name, profile in self.profiles.items()}
+
+    # Fetch the catalog if it changed since the last load. Returns True when a
+    # new snapshot was swapped in.
+    def refresh(self):
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        response = requests.get(f"{self.url}/api/characters", headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            self.loaded_at = time.time()
+            return False
+        response.raise_for_status()
+
+        characters = response.json().get('data', {}).get('characters', [])
+        profiles = dict(self.fallback)
+        profiles.update(profiles_from_catalog(characters, self.fallback))
+
+        self.profiles = profiles
+        self.etag = response.headers.get('ETag')
+        self.loaded_at = time.time()
+        logger.info(f"Loaded character snapshot with {len(profiles)} profiles")
+        return True
+
+    def start(self, url, refresh_interval=300, timeout=10):
+        if not url:
+            logger.info("Character snapshot disabled; using built-in profiles")
+            return
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Initial character snapshot load failed, using built-in profiles: {e}")
+
+        threading.Thread(target=self._refresh_loop, args=(refresh_interval,), daemon=True).start()
+
+    def _refresh_loop(self, refresh_interval):
+        while True:
+            time.sleep(refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Character snapshot refresh failed: {e}")
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+
+# Raised when no upstream slot can be obtained; maps to a 429/503 with Retry-After
+class UpstreamBusy(Exception):
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# Caps concurrent upstream calls for thread-per-request serving. Callers that
+# cannot get a slot wait in a bounded queue; once the queue is full they are
+# rejected with 429, and if they wait longer than queue_timeout with 503.
+class UpstreamLimiter:
+    def __init__(self, max_concurrency=16, max_queue=64, queue_timeout=30, retry_after=5):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.semaphore.acquire(blocking=False):
+            return
+
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                raise UpstreamBusy("Too many generation requests queued", 429, self.retry_after)
+            self.waiting += 1
+
+        try:
+            if not self.semaphore.acquire(timeout=self.queue_timeout):
+                raise UpstreamBusy("Timed out waiting for generation capacity", 503, self.retry_after)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+# asyncio counterpart of UpstreamLimiter for the ASGI serving mode
+class AsyncUpstreamLimiter:
+    def __init__(self, max_concurrency=16, max_queue=64, queue_timeout=30, retry_after=5):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.waiting = 0
+
+    async def acquire(self):
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            return
+
+        if self.waiting >= self.max_queue:
+            raise UpstreamBusy("Too many generation requests queued", 429, self.retry_after)
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamBusy("Timed out waiting for generation capacity", 503, self.retry_after)
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,175 @@
+import json
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+
+from story_cache import canonical_params, cache_key
+
+logger = logging.getLogger(__name__)
+
+
+# Parse an "start-end" UTC hour window such as "1-6"
+def parse_hours(window):
+    start, end = (int(part) for part in window.split('-', 1))
+    return start % 24, end % 24
+
+
+# Keeps a small stock of pre-generated stories for the most requested parameter
+# combinations. Demand is tracked in a Redis sorted set; stock for each
+# combination is a Redis list of ready stories, each served at most once.
+# Stock is topped up during off-peak hours and refilled in the background
+# whenever a request takes from (or finds empty) a combination's stock.
+# A pending refill is claimed with a Redis key next to the stock, so replicas
+# do not top up the same combination at once. Refills generate through
+# whichever serving mode started the inventory, so they share its upstream
+# limiter with live traffic.
+class StoryInventory:
+    def __init__(self, redis_client, model, stock_size=3, top_n=20, min_demand=5, stock_ttl=604800,
+                 offpeak_hours='1-6', refill_interval=300, on_refill=None, character_universes=None,
+                 refill_claim_ttl=900, prefix='textgen:inventory:'):
+        self.redis_client = redis_client
+        self.generate = None
+        self.has_capacity = lambda: True
+        self.model = model
+        self.stock_size = stock_size
+        self.min_demand = min_demand
+        self.stock_ttl = stock_ttl
+        self.top_n = top_n
+        self.offpeak_hours = parse_hours(offpeak_hours)
+        self.refill_interval = refill_interval
+        self.on_refill = on_refill or (lambda: None)
+        self.character_universes = character_universes or (lambda: {})
+        # A claim outlives a replica that dies mid-refill by at most this long
+        self.refill_claim_ttl = refill_claim_ttl
+        self.prefix = prefix
+        self.refills = queue.Queue()
+
+    @property
+    def enabled(self):
+        return self.redis_client is not None
+
+    def _stock_key(self, canonical):
+        return f"{self.prefix}stock:{cache_key(canonical, self.model)}"
+
+    def _pending_key(self, canonical):
+        return f"{self.prefix}pending:{cache_key(canonical, self.model)}"
+
+    # Count a request towards the demand ranking
+    def record_demand(self, params):
+        if not self.enabled:
+            return
+        member = json.dumps(canonical_params(params), sort_keys=True)
+        try:
+            self.redis_client.zincrby(self.prefix + 'demand', 1, member)
+        except Exception as e:
+            logger.warning(f"Inventory demand update failed: {e}")
+
+    # Take a ready story for the request. Stock that was drawn down, or that is
+    # missing for an already popular combination, is refilled in the background.
+    def take(self, params):
+        if not self.enabled:
+            return None
+        canonical = canonical_params(params)
+        try:
+            stored = self.redis_client.lpop(self._stock_key(canonical))
+            if stored or self._is_popular(canonical):
+                self.request_refill(canonical)
+        except Exception as e:
+            logger.warning(f"Inventory read failed: {e}")
+            return None
+
+        return json.loads(stored) if stored else None
+
+    def _is_popular(self, canonical):
+        score = self.redis_client.zscore(self.prefix + 'demand', json.dumps(canonical, sort_keys=True))
+        return score is not None and score >= self.min_demand
+
+    # Queue a background top-up of one combination's stock, unless a replica
+    # already has one pending. Only a started inventory claims refills.
+    def request_refill(self, canonical):
+        if self.generate is None:
+            return
+        if self.redis_client.set(self._pending_key(canonical), 1, nx=True, ex=self.refill_claim_ttl):
+            self.refills.put(json.dumps(canonical, sort_keys=True))
+
+    # generate(params) returns a story; has_capacity() is False while live
+    # requests are waiting for an upstream slot
+    def start(self, generate, has_capacity=None):
+        if not self.enabled:
+            logger.info("Story inventory disabled (no Redis)")
+            return
+        self.generate = generate
+        self.has_capacity = has_capacity or (lambda: True)
+        threading.Thread(target=self._refill_worker, daemon=True).start()
+        threading.Thread(target=self._scheduler, daemon=True).start()
+        logger.info("Story inventory started")
+
+    def in_offpeak(self, now=None):
+        hour = (now or datetime.utcnow()).hour
+        start, end = self.offpeak_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def _scheduler(self):
+        while True:
+            try:
+                if self.in_offpeak():
+                    for canonical in self._popular_combinations():
+                        self.request_refill(canonical)
+                    # Keep the demand ranking from growing without bound
+                    self.redis_client.zremrangebyrank(self.prefix + 'demand', 0, -(self.top_n * 50) - 1)
+            except Exception as e:
+                logger.error(f"Inventory scheduling error: {e}")
+            time.sleep(self.refill_interval)
+
+    def _popular_combinations(self):
+        members = self.redis_client.zrevrange(self.prefix + 'demand', 0, self.top_n - 1)
+        combinations = [json.loads(member) for member in members]
+        if len(combinations) < self.top_n:
+            combinations.extend(self._seed_from_universes(self.top_n - len(combinations)))
+        return combinations
+
+    # Fall back to usage-analytics universe popularity while request history is thin
+    def _seed_from_universes(self, limit):
+        seeded = []
+        for universe in self.redis_client.zrevrange('popular_universes', 0, limit - 1):
+            universe = universe.decode('utf-8') if isinstance(universe, bytes) else universe
+            for character, character_universe in self.character_universes().items():
+                if character_universe.lower() == universe.lower():
+                    seeded.append(canonical_params({
+                        "characters": [character],
+                        "theme": 'adventure',
+                        "moral_lesson": 'friendship',
+                        "age_group": '6-8',
+                        "length": 'bedtime-short'
+                    }))
+        return seeded[:limit]
+
+    def _refill_worker(self):
+        while True:
+            canonical = json.loads(self.refills.get())
+            try:
+                self._top_up(canonical)
+            except Exception as e:
+                logger.error(f"Inventory refill error: {e}")
+            finally:
+                try:
+                    self.redis_client.delete(self._pending_key(canonical))
+                except Exception as e:
+                    logger.warning(f"Inventory refill claim release failed: {e}")
+
+    def _top_up(self, canonical):
+        stock_key = self._stock_key(canonical)
+        while self.redis_client.llen(stock_key) < self.stock_size:
+            # Leave upstream capacity to live traffic
+            while not self.has_capacity():
+                time.sleep(1)
+            story_data = self.generate(dict(canonical))
+            self.redis_client.rpush(stock_key, json.dumps(story_data))
+            self.redis_client.expire(stock_key, self.stock_ttl)
+            # Keep the claim for as long as the top-up makes progress
+            self.redis_client.expire(self._pending_key(canonical), self.refill_claim_ttl)
+            self.on_refill()
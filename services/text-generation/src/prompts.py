@@ -0,0 +1,201 @@
+# Prompt assembly for text generation. Prompts are split into segments that
+# stay byte-identical across requests (instructions and output format, then
+# character profiles) followed by the per-request segment. The stable prefix
+# is a few hundred tokens, well under the provider's minimum cacheable length
+# (2048 tokens for claude-3-haiku), so no cache breakpoints are set; a
+# breakpoint below the minimum is ignored by the provider.
+
+from characters import CharacterSnapshot
+
+# Built-in character profiles, used until the catalog snapshot loads and for
+# characters the catalog does not have
+CHARACTER_INFO = {
+    'goku': {
+        'universe': 'Dragon Ball',
+        'traits': ['strong', 'kind', 'naive', 'determined', 'loves food'],
+        'abilities': ['super strength', 'flying', 'energy blasts', 'martial arts'],
+        'friends': ['Krillin', 'Bulma', 'Vegeta', 'Piccolo'],
+        'speech_style': 'simple and direct, often excited about fighting'
+    },
+    'woody': {
+        'universe': 'Toy Story',
+        'traits': ['loyal', 'brave', 'responsible', 'insecure at times'],
+        'abilities': ['leadership', 'comes alive when humans aren\'t looking'],
+        'friends': ['Buzz Lightyear', 'Jessie', 'Bo Peep', 'Rex'],
+        'speech_style': 'friendly cowboy talk with phrases like "howdy partner"'
+    },
+    'fry': {
+        'universe': 'Futurama',
+        'traits': ['lazy', 'kind-hearted', 'naive', 'impulsive'],
+        'abilities': ['delivery boy skills', 'adaptability to the future'],
+        'friends': ['Bender', 'Leela', 'Professor Farnsworth', 'Zoidberg'],
+        'speech_style': 'casual and sometimes confused, makes pop culture references'
+    },
+    'leonardo': {
+        'universe': 'Ninja Turtles',
+        'traits': ['disciplined', 'responsible', 'strategic', 'leader'],
+        'abilities': ['ninjutsu', 'swordsmanship', 'leadership'],
+        'friends': ['Raphael', 'Donatello', 'Michelangelo', 'Splinter'],
+        'speech_style': 'serious and focused, occasionally says "turtle power"'
+    },
+    'simba': {
+        'universe': 'Lion King',
+        'traits': ['brave', 'playful', 'responsible', 'royal'],
+        'abilities': ['roaring', 'hunting', 'leadership'],
+        'friends': ['Nala', 'Timon', 'Pumbaa', 'Rafiki'],
+        'speech_style': 'regal yet approachable, sometimes playful'
+    },
+    'sulley': {
+        'universe': 'Monsters Inc',
+        'traits': ['kind', 'protective', 'strong', 'gentle giant'],
+        'abilities': ['scaring', 'strength', 'roaring'],
+        'friends': ['Mike Wazowski', 'Boo', 'Celia'],
+        'speech_style': 'friendly and warm, sometimes nervous'
+    }
+}
+
+# Character catalog snapshot, started by the serving entrypoint
+character_snapshot = CharacterSnapshot(CHARACTER_INFO)
+
+SYSTEM_PROMPT = "You are a children's story writer who creates engaging, age-appropriate stories featuring characters from popular franchises."
+
+# Word and page targets per story length
+LENGTH_TARGETS = {
+    'bedtime-short': ("300-400", "5-7"),
+    'chapter-adventure': ("600-800", "10-15"),
+    'mini-epic': ("1000-1200", "15-20")
+}
+
+# Static instructions and output format for a complete story
+STORY_INSTRUCTIONS = """
+You will be given character profiles and a story request.
+Each page should have a clear scene that could be illustrated.
+
+Format your response as a JSON object with the following structure:
+{
+    "title": "The story title",
+    "pages": [
+        {
+            "page_number": 1,
+            "text": "Text for page 1",
+            "scene_description": "Brief description of what should be illustrated on this page"
+        },
+        ...
+    ]
+}
+
+Make the story engaging, age-appropriate, and incorporate the moral lesson naturally.
+"""
+
+# Static instructions and output format for a story outline
+OUTLINE_INSTRUCTIONS = """
+You will be given character profiles and a story request to plan. Do not write the story text yet.
+For each page give a one or two sentence beat describing what happens, and a scene that could be illustrated.
+The beats must form a complete story arc and incorporate the moral lesson naturally.
+
+Format your response as a JSON object with the following structure:
+{
+    "title": "The story title",
+    "pages": [
+        {
+            "page_number": 1,
+            "beat": "What happens on page 1",
+            "scene_description": "Brief description of what should be illustrated on this page"
+        },
+        ...
+    ]
+}
+"""
+
+# Static instructions and output format for writing outlined pages
+PAGES_INSTRUCTIONS = """
+You will be given character profiles, the complete outline of a story and the pages to write.
+Write only the requested pages, following their beats exactly.
+Keep the voice consistent with the rest of the story and do not resolve events belonging to later pages.
+
+Format your response as a JSON object with the following structure:
+{
+    "pages": [
+        {
+            "page_number": 1,
+            "text": "Text for the page",
+            "scene_description": "Brief description of what should be illustrated on this page"
+        },
+        ...
+    ]
+}
+"""
+
+def text_block(text):
+    return {"type": "text", "text": text}
+
+# System segment: persona plus the static instructions for one kind of call
+def system_blocks(instructions):
+    return [text_block(SYSTEM_PROMPT + "\n" + instructions)]
+
+# Profile text for one character: universe and traits, or the catalog
+# description for a character without traits
+def character_profile(character):
+    profile = character_snapshot.get(character)
+    if not profile:
+        return f"Character: {character}"
+
+    summary = ', '.join(profile.traits) or profile.description
+    line = f"Character: {profile.name} from {profile.universe}"
+    return f"{line}: {summary}" if summary else line
+
+# Character segment: one block per character in a stable order
+def character_profile_blocks(characters):
+    ordered = sorted(set(characters), key=lambda c: str(c).lower())
+    return [text_block(character_profile(character)) for character in ordered]
+
+def request_details(params):
+    word_count, pages = LENGTH_TARGETS.get(params["length"], LENGTH_TARGETS['bedtime-short'])
+    return word_count, pages, "\n".join([
+        f"Characters: {', '.join(str(c) for c in params['characters'])}",
+        f"Theme: {params['theme']}",
+        f"Moral lesson: {params['moral_lesson']}",
+        f"Age group: {params['age_group']}"
+    ])
+
+def assemble(instructions, params, request_text):
+    return {
+        "system": system_blocks(instructions),
+        "content": character_profile_blocks(params["characters"]) + [text_block(request_text)]
+    }
+
+# Build the story prompt for a set of story parameters
+def build_prompt(params):
+    word_count, pages, details = request_details(params)
+    request_text = f"""Write a {params["length"]} story featuring the characters above.
+{details}
+
+The story should be appropriate for {params["age_group"]} year olds, approximately {word_count} words, and divided into {pages} pages."""
+    return assemble(STORY_INSTRUCTIONS, params, request_text)
+
+# Build the outline prompt: title plus one beat per page
+def build_outline_prompt(params):
+    word_count, pages, details = request_details(params)
+    request_text = f"""Outline a {params["length"]} story featuring the characters above.
+{details}
+
+The story should be appropriate for {params["age_group"]} year olds, approximately {word_count} words, and divided into {pages} pages."""
+    return assemble(OUTLINE_INSTRUCTIONS, params, request_text)
+
+# Build the prompt that writes the text for one batch of outlined pages
+def build_pages_prompt(params, outline, batch):
+    word_count, _, details = request_details(params)
+    low, high = (int(n) for n in word_count.split('-'))
+    words_per_page = max(20, (low + high) // 2 // max(1, len(outline.get("pages", []))))
+
+    full_outline = "\n".join(f"{page['page_number']}. {page.get('beat', '')}" for page in outline.get("pages", []))
+    page_numbers = ", ".join(str(page['page_number']) for page in batch)
+
+    request_text = f"""Story title: {outline.get('title', '')}
+{details}
+
+The complete outline, one beat per page:
+{full_outline}
+
+Write pages {page_numbers}, about {words_per_page} words per page."""
+    return assemble(PAGES_INSTRUCTIONS, params, request_text)
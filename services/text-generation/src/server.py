@@ -4,10 +4,20 @@ import time
 import uuid
 import logging
 import threading
-from flask import Flask, request, jsonify
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import anthropic
+import redis
 from prometheus_client import Counter, Histogram, start_http_server
+from story_stream import StoryStreamParser
+from story_cache import StoryCache, cache_key
+from singleflight import SingleFlight
+from concurrency import UpstreamLimiter, UpstreamBusy
+from inventory import StoryInventory
+from backends import AnthropicBackend, StubBackend
+from prompts import character_snapshot, build_prompt, build_outline_prompt, build_pages_prompt
 
 # Configure logging
 logging.basicConfig(
@@ -20,70 +30,465 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
+# Model backend: "anthropic", or "stub" for offline load tests and CI
+TEXTGEN_BACKEND = os.environ.get('TEXTGEN_BACKEND', 'anthropic')
+STUB_SETTINGS = {
+    "latency_median": float(os.environ.get('STUB_LATENCY_MEDIAN', 0.8)),
+    "latency_sigma": float(os.environ.get('STUB_LATENCY_SIGMA', 0.35)),
+    "tokens_per_second": float(os.environ.get('STUB_TOKENS_PER_SECOND', 150)),
+    "malformed_rate": float(os.environ.get('STUB_MALFORMED_RATE', 0.0)),
+    "seed": int(os.environ.get('STUB_SEED', 0))
+}
+
 # Initialize Anthropic client
 ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY')
-if not ANTHROPIC_API_KEY:
+if TEXTGEN_BACKEND == 'stub':
+    logger.warning("Using stub text generation backend")
+    backend = StubBackend(**STUB_SETTINGS)
+elif TEXTGEN_BACKEND != 'anthropic':
+    raise ValueError(f"Unknown TEXTGEN_BACKEND: {TEXTGEN_BACKEND}")
+elif not ANTHROPIC_API_KEY:
     logger.warning("ANTHROPIC_API_KEY not set. Text generation will not work.")
-    client = None
+    backend = None
 else:
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+    backend = AnthropicBackend(anthropic.Anthropic(api_key=ANTHROPIC_API_KEY))
+
+# Initialize Redis client for the shared cache tier
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+try:
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    redis_client.ping()
+    logger.info("Connected to Redis")
+except Exception as e:
+    logger.error(f"Redis connection error: {e}")
+    redis_client = None
+
+# Story cache configuration
+STORY_CACHE_SIZE = int(os.environ.get('STORY_CACHE_SIZE', 512))
+STORY_CACHE_TTL = int(os.environ.get('STORY_CACHE_TTL', 3600))
+STORY_CACHE_REDIS_TTL = int(os.environ.get('STORY_CACHE_REDIS_TTL', 86400))
+
+story_cache = StoryCache(
+    redis_client=redis_client,
+    max_size=STORY_CACHE_SIZE,
+    ttl=STORY_CACHE_TTL,
+    redis_ttl=STORY_CACHE_REDIS_TTL
+)
+
+# Identical concurrent generations share one upstream call
+SINGLE_FLIGHT_TIMEOUT = int(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 120))
+single_flight = SingleFlight(redis_client=redis_client, lock_ttl=SINGLE_FLIGHT_TIMEOUT)
+
+# Upstream concurrency limits, shared by both serving modes
+UPSTREAM_CONCURRENCY = int(os.environ.get('UPSTREAM_CONCURRENCY', 16))
+UPSTREAM_QUEUE_SIZE = int(os.environ.get('UPSTREAM_QUEUE_SIZE', 64))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 30))
+UPSTREAM_RETRY_AFTER = int(os.environ.get('UPSTREAM_RETRY_AFTER', 5))
+
+upstream_limiter = UpstreamLimiter(
+    max_concurrency=UPSTREAM_CONCURRENCY,
+    max_queue=UPSTREAM_QUEUE_SIZE,
+    queue_timeout=UPSTREAM_QUEUE_TIMEOUT,
+    retry_after=UPSTREAM_RETRY_AFTER
+)
+
+# Batch generation limits
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', UPSTREAM_CONCURRENCY))
 
 # Prometheus metrics
 GENERATION_REQUESTS = Counter('text_generation_requests_total', 'Total number of text generation requests')
 GENERATION_ERRORS = Counter('text_generation_errors_total', 'Total number of text generation errors')
 GENERATION_TIME = Histogram('text_generation_time_seconds', 'Time spent generating text')
+CACHE_HITS = Counter('text_generation_cache_hits_total', 'Total number of story cache hits', ['tier'])
+CACHE_MISSES = Counter('text_generation_cache_misses_total', 'Total number of story cache misses')
+BATCH_ITEMS = Counter('text_generation_batch_items_total', 'Total number of batch generation items', ['status'])
+INVENTORY_HITS = Counter('text_generation_inventory_hits_total', 'Total number of requests served from pre-generated stock')
+INVENTORY_MISSES = Counter('text_generation_inventory_misses_total', 'Total number of requests that found no pre-generated stock')
+INVENTORY_REFILLS = Counter('text_generation_inventory_refills_total', 'Total number of stories generated into stock')
+COALESCED_REQUESTS = Counter('text_generation_coalesced_requests_total', 'Total number of requests served by an identical in-flight generation')
+INPUT_TOKENS = Counter('text_generation_input_tokens_total', 'Total number of input tokens sent upstream', ['cache', 'length', 'age_group'])
+OUTPUT_TOKENS = Counter('text_generation_output_tokens_total', 'Total number of output tokens received from upstream', ['length', 'age_group'])
+STAGE_TIME = Histogram('text_generation_stage_seconds', 'Time spent in each generation stage', ['stage', 'length', 'age_group'])
+TIME_TO_FIRST_TOKEN = Histogram('text_generation_time_to_first_token_seconds', 'Time from opening an upstream stream to its first text', ['length', 'age_group'])
+PARSE_FAILURES = Counter('text_generation_parse_failures_total', 'Total number of model outputs that could not be parsed', ['call', 'length', 'age_group'])
+
+# Known label values; anything else is reported as "other" to bound metric cardinality
+METRIC_LENGTHS = ('bedtime-short', 'chapter-adventure', 'mini-epic')
+METRIC_AGE_GROUPS = ('3-5', '6-8', '9-12')
+
+# Model settings
+MODEL_NAME = "claude-3-haiku-20240307"
+MAX_TOKENS = 2000
+TEMPERATURE = 0.7
+
+# Outline mode: outline first, then page text in parallel batches
+GENERATION_MODES = ('single', 'outline')
+OUTLINE_MAX_TOKENS = 1200
+OUTLINE_PAGE_BATCH = int(os.environ.get('OUTLINE_PAGE_BATCH', 4))
+OUTLINE_MAX_PARALLEL = int(os.environ.get('OUTLINE_MAX_PARALLEL', 4))
+PAGE_BATCH_MAX_TOKENS = 1500
+
+
+# Raised for request validation failures
+class InvalidRequest(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+# Raised when the model output cannot be turned into a story
+class StoryParseError(Exception):
+    pass
 
-# Character information
-CHARACTER_INFO = {
-    'goku': {
-        'universe': 'Dragon Ball',
-        'traits': ['strong', 'kind', 'naive', 'determined', 'loves food'],
-        'abilities': ['super strength', 'flying', 'energy blasts', 'martial arts'],
-        'friends': ['Krillin', 'Bulma', 'Vegeta', 'Piccolo'],
-        'speech_style': 'simple and direct, often excited about fighting'
-    },
-    'woody': {
-        'universe': 'Toy Story',
-        'traits': ['loyal', 'brave', 'responsible', 'insecure at times'],
-        'abilities': ['leadership', 'comes alive when humans aren\'t looking'],
-        'friends': ['Buzz Lightyear', 'Jessie', 'Bo Peep', 'Rex'],
-        'speech_style': 'friendly cowboy talk with phrases like "howdy partner"'
-    },
-    'fry': {
-        'universe': 'Futurama',
-        'traits': ['lazy', 'kind-hearted', 'naive', 'impulsive'],
-        'abilities': ['delivery boy skills', 'adaptability to the future'],
-        'friends': ['Bender', 'Leela', 'Professor Farnsworth', 'Zoidberg'],
-        'speech_style': 'casual and sometimes confused, makes pop culture references'
-    },
-    'leonardo': {
-        'universe': 'Ninja Turtles',
-        'traits': ['disciplined', 'responsible', 'strategic', 'leader'],
-        'abilities': ['ninjutsu', 'swordsmanship', 'leadership'],
-        'friends': ['Raphael', 'Donatello', 'Michelangelo', 'Splinter'],
-        'speech_style': 'serious and focused, occasionally says "turtle power"'
-    },
-    'simba': {
-        'universe': 'Lion King',
-        'traits': ['brave', 'playful', 'responsible', 'royal'],
-        'abilities': ['roaring', 'hunting', 'leadership'],
-        'friends': ['Nala', 'Timon', 'Pumbaa', 'Rafiki'],
-        'speech_style': 'regal yet approachable, sometimes playful'
-    },
-    'sulley': {
-        'universe': 'Monsters Inc',
-        'traits': ['kind', 'protective', 'strong', 'gentle giant'],
-        'abilities': ['scaring', 'strength', 'roaring'],
-        'friends': ['Mike Wazowski', 'Boo', 'Celia'],
-        'speech_style': 'friendly and warm, sometimes nervous'
-    }
-}
 
 # Start Prometheus metrics server
 def start_metrics_server():
     start_http_server(8000)
     logger.info("Prometheus metrics server started on port 8000")
 
+# Read story parameters from a request body, filling in defaults
+def resolve_story_params(data):
+    if not data:
+        raise InvalidRequest("No data provided")
+
+    params = {
+        "characters": data.get('characters', []),
+        "theme": data.get('theme', 'adventure'),
+        "moral_lesson": data.get('moral_lesson', 'friendship'),
+        "age_group": data.get('age_group', '6-8'),
+        "length": data.get('length', 'bedtime-short'),
+        "story_id": data.get('story_id', str(uuid.uuid4())),
+        "fresh": bool(data.get('fresh', False)),
+        "mode": data.get('generation_mode', 'single')
+    }
+
+    if not params["characters"]:
+        raise InvalidRequest("No characters provided")
+
+    if params["mode"] not in GENERATION_MODES:
+        raise InvalidRequest(f"Unknown generation_mode: {params['mode']}")
+
+    if not backend:
+        raise InvalidRequest("Text generation service not configured", 500)
+
+    return params
+
+# Read a batch request body, returning the story specs and fan-out concurrency
+def resolve_batch(data):
+    if not data:
+        raise InvalidRequest("No data provided")
+
+    stories = data.get('stories')
+    if not isinstance(stories, list) or not stories:
+        raise InvalidRequest("No stories provided")
+    if not all(isinstance(spec, dict) for spec in stories):
+        raise InvalidRequest("stories must be a list of objects")
+    if len(stories) > BATCH_MAX_ITEMS:
+        raise InvalidRequest(f"Batch exceeds the maximum of {BATCH_MAX_ITEMS} stories")
+
+    try:
+        concurrency = int(data.get('concurrency', BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise InvalidRequest("Invalid concurrency")
+
+    return stories, max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+
+# Split outline pages into batches written by separate calls
+def page_batches(outline):
+    pages = outline.get("pages", [])
+    return [pages[i:i + OUTLINE_PAGE_BATCH] for i in range(0, len(pages), OUTLINE_PAGE_BATCH)]
+
+# Combine outline pages with the text written for them
+def merge_outline_pages(batch, written):
+    written_pages = {page.get("page_number"): page for page in written.get("pages", [])}
+    pages = []
+    for outline_page in batch:
+        page_number = outline_page["page_number"]
+        page = written_pages.get(page_number)
+        if not page or not page.get("text"):
+            raise StoryParseError(f"Failed to parse generated story: missing text for page {page_number}")
+        pages.append({
+            "page_number": page_number,
+            "text": page["text"],
+            "scene_description": page.get("scene_description") or outline_page.get("scene_description", "")
+        })
+    return pages
+
+# Metric labels for a set of story parameters
+def metric_labels(params):
+    length = params.get("length")
+    age_group = params.get("age_group")
+    return {
+        "length": length if length in METRIC_LENGTHS else 'other',
+        "age_group": age_group if age_group in METRIC_AGE_GROUPS else 'other'
+    }
+
+def observe_stage(stage, params, seconds):
+    STAGE_TIME.labels(stage=stage, **metric_labels(params)).observe(seconds)
+
+# Time a block of work as one generation stage, including on failure
+@contextmanager
+def timed_stage(stage, params):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, params, time.perf_counter() - started)
+
+# Parse model output for one kind of call, counting and timing failures
+def parse_output(content, params, call):
+    with timed_stage('parse', params):
+        try:
+            return parse_story(content)
+        except StoryParseError:
+            PARSE_FAILURES.labels(call=call, **metric_labels(params)).inc()
+            raise
+
+# Extract the story JSON object from the model output
+def parse_story(content):
+    start_idx = content.find('{')
+    end_idx = content.rfind('}') + 1
+    if start_idx < 0 or end_idx <= start_idx:
+        raise StoryParseError("Failed to parse generated story")
+
+    try:
+        return json.loads(content[start_idx:end_idx])
+    except ValueError as e:
+        raise StoryParseError(f"Failed to parse generated story: {str(e)}")
+
+# Attach request metadata to a generated story
+def build_result(params, story_data):
+    return {
+        "story_id": params["story_id"],
+        "characters": params["characters"],
+        "theme": params["theme"],
+        "moral_lesson": params["moral_lesson"],
+        "age_group": params["age_group"],
+        "length": params["length"],
+        "story": story_data
+    }
+
+# Request arguments for the Messages API
+def build_message_request(prompt, max_tokens=MAX_TOKENS):
+    return {
+        "model": MODEL_NAME,
+        "max_tokens": max_tokens,
+        "temperature": TEMPERATURE,
+        "system": prompt["system"],
+        "messages": [
+            {"role": "user", "content": prompt["content"]}
+        ]
+    }
+
+# Record token usage; input tokens are split by prompt cache outcome
+def record_usage(usage, params):
+    if usage is None:
+        return
+    labels = metric_labels(params)
+    INPUT_TOKENS.labels(cache='uncached', **labels).inc(usage.input_tokens or 0)
+    INPUT_TOKENS.labels(cache='read', **labels).inc(getattr(usage, 'cache_read_input_tokens', None) or 0)
+    INPUT_TOKENS.labels(cache='write', **labels).inc(getattr(usage, 'cache_creation_input_tokens', None) or 0)
+    OUTPUT_TOKENS.labels(**labels).inc(usage.output_tokens or 0)
+
+# Final story from a finished stream and whether it is complete: prefer the
+# full document, but fall back to the pages parsed incrementally (e.g. when
+# output was cut off at MAX_TOKENS)
+def story_from_parser(parser, params):
+    try:
+        return parse_output(parser.text, params, 'stream'), True
+    except StoryParseError:
+        if not parser.pages:
+            raise
+        return {"title": parser.title, "pages": parser.pages}, False
+
+# Metadata event that opens a story stream
+def metadata_event(params):
+    metadata = build_result(params, None)
+    del metadata["story"]
+    return {"event": "metadata", **metadata}
+
+# NDJSON event for one finished batch item
+def batch_item_event(index, params=None, story_data=None, error=None):
+    if error is not None:
+        BATCH_ITEMS.labels(status='error').inc()
+        event = {"event": "error", "index": index, "error": getattr(error, 'message', str(error))}
+        if isinstance(error, UpstreamBusy):
+            event["retry_after"] = error.retry_after
+        return event
+
+    BATCH_ITEMS.labels(status='success').inc()
+    return {"event": "result", "index": index, **build_result(params, story_data)}
+
+# Error response for a rejected upstream slot
+def busy_response(e):
+    response = jsonify({"error": e.message})
+    response.status_code = e.status_code
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# Build a prompt, send it to the model backend and parse the JSON response,
+# timing each stage. call names the kind of prompt for the metrics.
+def call_model(params, call, build, max_tokens=MAX_TOKENS):
+    with timed_stage('prompt_build', params):
+        prompt = build()
+
+    queued_at = time.perf_counter()
+    with upstream_limiter.slot():
+        observe_stage('queue_wait', params, time.perf_counter() - queued_at)
+        with timed_stage('upstream', params):
+            completion = backend.create(build_message_request(prompt, max_tokens))
+
+    record_usage(completion.usage, params)
+    return parse_output(completion.text, params, call)
+
+# Generate a complete story with Anthropic Claude
+def generate_story(params):
+    if params.get("mode") == 'outline':
+        return generate_outlined_story(params)
+    return call_model(params, 'story', lambda: build_prompt(params))
+
+# Outline mode: one call for the outline, then page batches written in
+# parallel. Yields title and page events in page order as batches finish.
+def stream_outlined_story(params):
+    outline = call_model(params, 'outline', lambda: build_outline_prompt(params), OUTLINE_MAX_TOKENS)
+    batches = page_batches(outline)
+    if not batches:
+        raise StoryParseError("Failed to parse generated story: empty outline")
+
+    yield {"event": "title", "title": outline.get("title")}
+
+    def write_batch(batch):
+        written = call_model(params, 'pages', lambda: build_pages_prompt(params, outline, batch), PAGE_BATCH_MAX_TOKENS)
+        try:
+            return merge_outline_pages(batch, written)
+        except StoryParseError:
+            PARSE_FAILURES.labels(call='pages', **metric_labels(params)).inc()
+            raise
+
+    pages = []
+    with ThreadPoolExecutor(max_workers=min(len(batches), OUTLINE_MAX_PARALLEL)) as executor:
+        futures = [executor.submit(write_batch, batch) for batch in batches]
+        try:
+            for future in futures:
+                for page in future.result():
+                    pages.append(page)
+                    yield {"event": "page", "page": page}
+        finally:
+            for future in futures:
+                future.cancel()
+
+    yield {"event": "done", "story": {"title": outline.get("title"), "pages": pages}}
+
+def generate_outlined_story(params):
+    for event in stream_outlined_story(params):
+        if event["event"] == "done":
+            return event["story"]
+
+# Look up a cached story for the request, returning None on a miss or when a fresh story was asked for
+def get_cached_story(params):
+    if params["fresh"]:
+        return None
+
+    story_data, tier = story_cache.get(cache_key(params, MODEL_NAME))
+    if story_data is None:
+        CACHE_MISSES.inc()
+        return None
+
+    CACHE_HITS.labels(tier=tier).inc()
+    return story_data
+
+# Story that can be served without an upstream call: an unserved story from
+# the pre-generated stock, or else a cache hit. Stock goes first so the stories
+# pre-generated for popular combinations are used rather than left to expire
+# behind the cache; stock hits are not cached, as each is served at most once.
+def get_ready_story(params):
+    inventory.record_demand(params)
+
+    story_data = inventory.take(params)
+    if story_data is not None:
+        INVENTORY_HITS.inc()
+        return story_data
+    if inventory.enabled:
+        INVENTORY_MISSES.inc()
+
+    return get_cached_story(params)
+
+# Serve a story from the cache or stock, generating it on a miss. Concurrent
+# identical requests are coalesced onto a single upstream call.
+def get_story(params):
+    story_data = get_ready_story(params)
+    if story_data is not None:
+        return story_data
+
+    if params["fresh"]:
+        story_data = generate_story(params)
+    else:
+        key = cache_key(params, MODEL_NAME)
+
+        def generate_once():
+            # Another flight may have filled the cache while we waited to lead
+            cached, _ = story_cache.get(key)
+            return cached if cached is not None else generate_story(params)
+
+        story_data, shared = single_flight.do(key, generate_once)
+        if shared:
+            COALESCED_REQUESTS.inc()
+
+    story_cache.set(cache_key(params, MODEL_NAME), story_data)
+    return story_data
+
+# Pre-generated stock for the most requested combinations
+INVENTORY_ENABLED = os.environ.get('INVENTORY_ENABLED', 'true').lower() == 'true'
+
+inventory = StoryInventory(
+    redis_client=redis_client if INVENTORY_ENABLED else None,
+    model=MODEL_NAME,
+    stock_size=int(os.environ.get('INVENTORY_STOCK_SIZE', 3)),
+    top_n=int(os.environ.get('INVENTORY_TOP_N', 20)),
+    min_demand=int(os.environ.get('INVENTORY_MIN_DEMAND', 5)),
+    offpeak_hours=os.environ.get('INVENTORY_OFFPEAK_HOURS', '1-6'),
+    refill_interval=int(os.environ.get('INVENTORY_REFILL_INTERVAL', 300)),
+    refill_claim_ttl=int(os.environ.get('INVENTORY_REFILL_CLAIM_TTL', 900)),
+    on_refill=INVENTORY_REFILLS.inc,
+    character_universes=character_snapshot.universes
+)
+
+# Character catalog snapshot used for prompt building
+CHARACTER_SERVICE_URL = os.environ.get('CHARACTER_SERVICE_URL', 'http://character-database:8080')
+CHARACTER_REFRESH_INTERVAL = int(os.environ.get('CHARACTER_REFRESH_INTERVAL', 300))
+
+# Replay a cached story as stream events
+def replay_story(story_data):
+    if story_data.get("title") is not None:
+        yield {"event": "title", "title": story_data["title"]}
+    for page in story_data.get("pages", []):
+        yield {"event": "page", "page": page}
+    yield {"event": "done", "story": story_data}
+
+# Stream a story from the model backend, yielding title and page events as they
+# complete. The caller must hold an upstream slot.
+def stream_story(params):
+    with timed_stage('prompt_build', params):
+        prompt = build_prompt(params)
+
+    parser = StoryStreamParser()
+    with timed_stage('upstream', params):
+        opened_at = time.perf_counter()
+        with backend.stream(build_message_request(prompt)) as stream:
+            for text in stream.text_stream:
+                if opened_at is not None:
+                    TIME_TO_FIRST_TOKEN.labels(**metric_labels(params)).observe(time.perf_counter() - opened_at)
+                    opened_at = None
+                for event in parser.feed(text):
+                    yield event
+            record_usage(stream.usage, params)
+
+    story_data, complete = story_from_parser(parser, params)
+    yield {"event": "done", "story": story_data, "complete": complete}
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -96,134 +501,144 @@ def generate_text():
     start_time = time.time()
     
     try:
-        data = request.json
-        
-        # Validate request
-        if not data:
-            GENERATION_ERRORS.inc()
-            return jsonify({"error": "No data provided"}), 400
-        
-        characters = data.get('characters', [])
-        theme = data.get('theme', 'adventure')
-        moral_lesson = data.get('moral_lesson', 'friendship')
-        age_group = data.get('age_group', '6-8')
-        length = data.get('length', 'bedtime-short')
-        story_id = data.get('story_id', str(uuid.uuid4()))
-        
-        if not characters:
-            GENERATION_ERRORS.inc()
-            return jsonify({"error": "No characters provided"}), 400
-        
-        if not client:
-            GENERATION_ERRORS.inc()
-            return jsonify({"error": "Text generation service not configured"}), 500
-        
-        # Build character information for the prompt
-        character_details = []
-        for character in characters:
-            if character in CHARACTER_INFO:
-                info = CHARACTER_INFO[character]
-                character_details.append(f"{character.title()} from {info['universe']}: {', '.join(info['traits'])}")
-            else:
-                character_details.append(character)
-        
-        character_info = "\n".join(character_details)
-        
-        # Determine length based on story type
-        if length == "bedtime-short":
-            word_count = "300-400"
-            pages = "5-7"
-        elif length == "chapter-adventure":
-            word_count = "600-800"
-            pages = "10-15"
-        elif length == "mini-epic":
-            word_count = "1000-1200"
-            pages = "15-20"
-        else:
-            word_count = "300-400"
-            pages = "5-7"
-        
-        # Build the prompt
-        prompt = f"""
-        You are a children's story writer creating a {length} story for children in the {age_group} age group.
-        
-        Write a story featuring the following characters:
-        {character_info}
+        params = resolve_story_params(request.json)
+        story_data = get_story(params)
         
-        Theme: {theme}
-        Moral lesson: {moral_lesson}
+        return jsonify(build_result(params, story_data))
         
-        The story should be appropriate for {age_group} year olds, approximately {word_count} words, and divided into {pages} pages.
-        Each page should have a clear scene that could be illustrated.
-        
-        Format your response as a JSON object with the following structure:
-        {{
-            "title": "The story title",
-            "pages": [
-                {{
-                    "page_number": 1,
-                    "text": "Text for page 1",
-                    "scene_description": "Brief description of what should be illustrated on this page"
-                }},
-                ...
-            ]
-        }}
-        
-        Make the story engaging, age-appropriate, and incorporate the moral lesson naturally.
-        """
-        
-        # Generate text with Anthropic Claude
-        response = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=2000,
-            temperature=0.7,
-            system="You are a children's story writer who creates engaging, age-appropriate stories featuring characters from popular franchises.",
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": e.message}), e.status_code
+    except UpstreamBusy as e:
+        GENERATION_ERRORS.inc()
+        return busy_response(e)
+    except StoryParseError as e:
+        logger.exception("Error parsing generated story")
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": str(e)}), 500
+    except Exception as e:
+        logger.exception("Error generating text")
+        GENERATION_ERRORS.inc()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        GENERATION_TIME.observe(time.time() - start_time)
+
+# Streaming text generation endpoint (NDJSON, one event per line)
+@app.route('/api/generate/stream', methods=['POST'])
+def generate_text_stream():
+    GENERATION_REQUESTS.inc()
+    start_time = time.time()
+    
+    try:
+        params = resolve_story_params(request.json)
+        story_data = get_ready_story(params)
+        # Outline mode takes a slot per upstream call instead of one for the stream
+        holds_slot = story_data is None and params["mode"] != 'outline'
+        if holds_slot:
+            with timed_stage('queue_wait', params):
+                upstream_limiter.acquire()
+    except InvalidRequest as e:
+        GENERATION_ERRORS.inc()
+        GENERATION_TIME.observe(time.time() - start_time)
+        return jsonify({"error": e.message}), e.status_code
+    except UpstreamBusy as e:
+        GENERATION_ERRORS.inc()
+        GENERATION_TIME.observe(time.time() - start_time)
+        return busy_response(e)
+    
+    def events():
+        yield json.dumps(metadata_event(params)) + "\n"
         
-        # Extract JSON from response
         try:
-            content = response.content[0].text
-            # Find JSON in the response
-            start_idx = content.find('{')
-            end_idx = content.rfind('}') + 1
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = content[start_idx:end_idx]
-                story_data = json.loads(json_str)
+            if story_data is not None:
+                story_events = replay_story(story_data)
+            elif params["mode"] == 'outline':
+                story_events = stream_outlined_story(params)
             else:
-                # Fallback if JSON parsing fails
-                GENERATION_ERRORS.inc()
-                return jsonify({"error": "Failed to parse generated story"}), 500
+                story_events = stream_story(params)
+            
+            for event in story_events:
+                if event["event"] == "done":
+                    complete = event.get("complete", True)
+                    # A truncated story is returned but never cached as if it were whole
+                    if story_data is None and complete:
+                        story_cache.set(cache_key(params, MODEL_NAME), event["story"])
+                    event = {"event": "done", **build_result(params, event["story"])}
+                    if not complete:
+                        event["partial"] = True
+                yield json.dumps(event) + "\n"
         except Exception as e:
-            logger.exception("Error parsing generated story")
+            # Headers are already sent, so report the failure in-band
+            logger.exception("Error streaming text")
             GENERATION_ERRORS.inc()
-            return jsonify({"error": f"Failed to parse generated story: {str(e)}"}), 500
-        
-        # Add metadata
-        result = {
-            "story_id": story_id,
-            "characters": characters,
-            "theme": theme,
-            "moral_lesson": moral_lesson,
-            "age_group": age_group,
-            "length": length,
-            "story": story_data
-        }
-        
-        GENERATION_TIME.observe(time.time() - start_time)
-        return jsonify(result)
-        
-    except Exception as e:
-        logger.exception("Error generating text")
+            yield json.dumps({"event": "error", "error": str(e)}) + "\n"
+        finally:
+            GENERATION_TIME.observe(time.time() - start_time)
+    
+    response = Response(stream_with_context(events()), mimetype='application/x-ndjson')
+    if holds_slot:
+        # Release on close so the slot is freed even if the client goes away early
+        response.call_on_close(upstream_limiter.release)
+    return response
+
+# Batch text generation endpoint. Streams one NDJSON event per story as each
+# finishes; failed items are reported without failing the batch.
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_text_batch():
+    GENERATION_REQUESTS.inc()
+    start_time = time.time()
+    
+    try:
+        stories, concurrency = resolve_batch(request.json)
+    except InvalidRequest as e:
         GENERATION_ERRORS.inc()
-        return jsonify({"error": str(e)}), 500
+        GENERATION_TIME.observe(time.time() - start_time)
+        return jsonify({"error": e.message}), e.status_code
+    
+    def generate_item(index, spec):
+        try:
+            params = resolve_story_params(spec)
+            return batch_item_event(index, params, get_story(params))
+        except Exception as e:
+            if not isinstance(e, (InvalidRequest, UpstreamBusy)):
+                logger.exception(f"Error generating batch item {index}")
+            return batch_item_event(index, error=e)
+    
+    def events():
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        succeeded = 0
+        try:
+            futures = [executor.submit(generate_item, index, spec) for index, spec in enumerate(stories)]
+            for future in as_completed(futures):
+                event = future.result()
+                if event["event"] == "result":
+                    succeeded += 1
+                yield json.dumps(event) + "\n"
+            
+            yield json.dumps({
+                "event": "done",
+                "total": len(stories),
+                "succeeded": succeeded,
+                "failed": len(stories) - succeeded,
+                "duration_seconds": round(time.time() - start_time, 3)
+            }) + "\n"
+        finally:
+            # Drop queued items if the client went away
+            executor.shutdown(wait=False, cancel_futures=True)
+            GENERATION_TIME.observe(time.time() - start_time)
+    
+    return Response(stream_with_context(events()), mimetype='application/x-ndjson')
 
 if __name__ == '__main__':
     # Start metrics server in a separate thread
     metrics_thread = threading.Thread(target=start_metrics_server, daemon=True)
     metrics_thread.start()
     
+    # Load the character catalog and keep it fresh in the background
+    character_snapshot.start(CHARACTER_SERVICE_URL, CHARACTER_REFRESH_INTERVAL)
+
+    # Start background stock refills, sharing the upstream limit with requests
+    inventory.start(generate_story, has_capacity=lambda: upstream_limiter.waiting == 0)
+    
     # Start Flask app
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,205 @@
+import json
+import asyncio
+import time
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Deletes the lock only if this worker still owns it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# Raised in waiting callers when the call they were coalesced onto failed in another worker
+class SingleFlightError(Exception):
+    pass
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Coalesces concurrent calls for the same key onto a single execution.
+# Callers in the same process wait on an in-memory flight; with Redis configured,
+# workers in other processes wait on a lock and receive the result over pub/sub.
+class SingleFlight:
+    def __init__(self, redis_client=None, lock_ttl=120, prefix='textgen:flight:'):
+        self.redis_client = redis_client
+        self.lock_ttl = lock_ttl
+        self.prefix = prefix
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    # Run fn once for all concurrent callers of key; returns (result, shared)
+    def do(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+
+        if not leader:
+            if not flight.done.wait(self.lock_ttl):
+                return fn(), False
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result, shared = self._run_across_workers(key, fn)
+            return flight.result, shared
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def _run_across_workers(self, key, fn):
+        token, payload = self.claim(key)
+        if payload is not None:
+            return self.unwrap(payload), True
+        if token is None:
+            return fn(), False
+
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key, token, {"error": str(e)})
+            raise
+        self.finish(key, token, {"result": result})
+        return result, False
+
+    # Claim key across workers. Returns (token, None) when this worker owns the
+    # call, (None, payload) when another worker delivered its outcome, and
+    # (None, None) when the caller should do the work without coordination.
+    def claim(self, key):
+        if not self.redis_client:
+            return None, None
+
+        channel = self.prefix + key
+        lock_key = channel + ':lock'
+        result_key = channel + ':result'
+        token = str(uuid.uuid4())
+
+        try:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+        except Exception as e:
+            logger.warning(f"Single-flight subscribe failed, generating locally: {e}")
+            return None, None
+
+        try:
+            if self.redis_client.set(lock_key, token, nx=True, px=self.lock_ttl * 1000):
+                # Clear any result left over from an earlier flight for this key
+                self.redis_client.delete(result_key)
+                return token, None
+            # A None payload means the owning worker went away without publishing
+            return None, self._wait_remote(pubsub, lock_key, result_key)
+        except Exception as e:
+            logger.warning(f"Single-flight lock failed, generating locally: {e}")
+            return None, None
+        finally:
+            pubsub.close()
+
+    # Publish the outcome of an owned call and release its lock
+    def finish(self, key, token, payload):
+        channel = self.prefix + key
+        self._publish(channel, channel + ':result', payload)
+        try:
+            self.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, channel + ':lock', token)
+        except Exception as e:
+            logger.warning(f"Single-flight lock release failed: {e}")
+
+    @staticmethod
+    def unwrap(payload):
+        if 'error' in payload:
+            raise SingleFlightError(payload['error'])
+        return payload['result']
+
+    # Wait for the lock owner to publish, returning None if it disappears or times out
+    def _wait_remote(self, pubsub, lock_key, result_key):
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=1.0)
+            if message and message.get('type') == 'message':
+                return json.loads(message['data'])
+
+            # The result may have been published before we subscribed
+            stored = self.redis_client.get(result_key)
+            if stored:
+                return json.loads(stored)
+            if not self.redis_client.exists(lock_key):
+                return None
+        return None
+
+    def _publish(self, channel, result_key, payload):
+        try:
+            data = json.dumps(payload)
+            self.redis_client.set(result_key, data, px=30000)
+            self.redis_client.publish(channel, data)
+        except Exception as e:
+            logger.warning(f"Single-flight publish failed: {e}")
+
+
+# asyncio counterpart of SingleFlight for the ASGI serving mode. Callers in the
+# event loop share a future; cross-worker coordination reuses the Redis protocol
+# of the wrapped SingleFlight, with its blocking calls moved off the loop.
+class AsyncSingleFlight:
+    def __init__(self, remote):
+        self.remote = remote
+        self.flights = {}
+
+    # Await fn() once for all concurrent callers of key; returns (result, shared)
+    async def do(self, key, fn):
+        flight = self.flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight), True
+
+        flight = asyncio.get_running_loop().create_future()
+        # Mark failures as retrieved even when nobody else was waiting
+        flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.flights[key] = flight
+
+        try:
+            result, shared = await self._run_across_workers(key, fn)
+            flight.set_result(result)
+            return result, shared
+        except BaseException as e:
+            if isinstance(e, Exception):
+                flight.set_exception(e)
+            else:
+                flight.cancel()
+            raise
+        finally:
+            del self.flights[key]
+
+    async def _run_across_workers(self, key, fn):
+        token, payload = await asyncio.to_thread(self.remote.claim, key)
+        if payload is not None:
+            return self.remote.unwrap(payload), True
+        if token is None:
+            return await fn(), False
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # Release synchronously so other workers stop waiting on us
+            self.remote.finish(key, token, {"error": "Generation cancelled"})
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self.remote.finish, key, token, {"error": str(e)})
+            raise
+        await asyncio.to_thread(self.remote.finish, key, token, {"result": result})
+        return result, False
@@ -0,0 +1,94 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Reduce story parameters to a canonical form so equivalent requests share a cache entry
+def canonical_params(params):
+    return {
+        "characters": sorted(str(c).strip().lower() for c in params["characters"]),
+        "theme": str(params["theme"]).strip(),
+        "moral_lesson": str(params["moral_lesson"]).strip(),
+        "age_group": str(params["age_group"]).strip(),
+        "length": str(params["length"]).strip()
+    }
+
+
+# Stable cache key for a set of story parameters and the model that serves them
+def cache_key(params, model):
+    canonical = json.dumps(canonical_params(params), sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(f"{model}|{canonical}".encode('utf-8')).hexdigest()
+    return digest
+
+
+# Thread-safe in-process LRU cache with a per-entry TTL
+class LRUCache:
+    def __init__(self, max_size=512, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Two-tier story cache: in-process LRU in front of a shared Redis tier
+class StoryCache:
+    def __init__(self, redis_client=None, max_size=512, ttl=3600, redis_ttl=86400, prefix='textgen:story:'):
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.redis_client = redis_client
+        self.redis_ttl = redis_ttl
+        self.prefix = prefix
+
+    # Return (story_data, tier) on a hit, or (None, None) on a miss
+    def get(self, key):
+        story_data = self.local.get(key)
+        if story_data is not None:
+            return story_data, 'local'
+
+        if self.redis_client:
+            try:
+                cached = self.redis_client.get(self.prefix + key)
+            except Exception as e:
+                logger.warning(f"Redis cache read failed: {e}")
+                cached = None
+            if cached:
+                story_data = json.loads(cached)
+                self.local.set(key, story_data)
+                return story_data, 'redis'
+
+        return None, None
+
+    def set(self, key, story_data):
+        self.local.set(key, story_data)
+
+        if self.redis_client:
+            try:
+                self.redis_client.setex(self.prefix + key, self.redis_ttl, json.dumps(story_data))
+            except Exception as e:
+                logger.warning(f"Redis cache write failed: {e}")
@@ -0,0 +1,108 @@
+import json
+
+
+# Incremental parser for the {"title": ..., "pages": [...]} story structure.
+# Text deltas from a streamed model response are fed in as they arrive and the
+# parser returns events for the title and for each page object as soon as its
+# closing brace has been seen, without waiting for the rest of the document.
+class StoryStreamParser:
+    def __init__(self):
+        self.text = ''
+        self.position = 0
+        self.started = False
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.last_string = None
+        self.expecting_value = False
+        self.current_key = None
+        self.pages_depth = None
+        self.page_start = None
+        self.title = None
+        self.pages = []
+
+    # Feed a chunk of model output and return the events completed by it
+    def feed(self, chunk):
+        events = []
+        if not chunk:
+            return events
+
+        self.text += chunk
+        text = self.text
+
+        while self.position < len(text):
+            char = text[self.position]
+            index = self.position
+            self.position += 1
+
+            if not self.started:
+                if char == '{':
+                    self.started = True
+                    self.stack.append('{')
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    self._end_string(text, index, events)
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = index
+            elif char == ':':
+                if len(self.stack) == 1:
+                    self.current_key = self.last_string
+                self.expecting_value = True
+            elif char == ',':
+                self.expecting_value = False
+            elif char in '{[':
+                self.stack.append(char)
+                self.expecting_value = False
+                if char == '[' and len(self.stack) == 2 and self.current_key == 'pages':
+                    self.pages_depth = len(self.stack)
+                elif char == '{' and self.pages_depth and len(self.stack) == self.pages_depth + 1:
+                    self.page_start = index
+            elif char in '}]':
+                if not self.stack:
+                    continue
+                self.stack.pop()
+                if char == '}' and self.page_start is not None and len(self.stack) == self.pages_depth:
+                    self._end_page(text[self.page_start:index + 1], events)
+                    self.page_start = None
+                elif char == ']' and self.pages_depth and len(self.stack) == self.pages_depth - 1:
+                    self.pages_depth = None
+
+        return events
+
+    def _end_string(self, text, index, events):
+        value = text[self.string_start:index + 1]
+        if len(self.stack) != 1:
+            return
+
+        if self.expecting_value:
+            self.expecting_value = False
+            if self.current_key == 'title' and self.title is None:
+                try:
+                    self.title = json.loads(value)
+                except ValueError:
+                    return
+                events.append({"event": "title", "title": self.title})
+        else:
+            try:
+                self.last_string = json.loads(value)
+            except ValueError:
+                self.last_string = None
+
+    def _end_page(self, page_json, events):
+        try:
+            page = json.loads(page_json)
+        except ValueError:
+            return
+        self.pages.append(page)
+        events.append({"event": "page", "page": page})